@@ -1,47 +1,232 @@
-import google.generativeai as genai
+import asyncio
+import json
 import os
+import re
 from dotenv import load_dotenv
 import logging
+import time
+from cache import TTLCache
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from metrics import Counter, Histogram, register_cache
+from spotify_async import SpotifyAPIError, get_spotify_client
+from token_manager import DEFAULT_USER
 
 # Load environment variables
 load_dotenv()
 
-# Configure Gemini API Key
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+# Recommendations are cached per normalized mood/subject.
+AI_CACHE_TTL = float(os.getenv("AI_CACHE_TTL", "3600"))
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE", "256"))
+AI_CACHE_PATH = os.getenv("AI_CACHE_PATH")  # Optional JSON file for warm restarts
 
-def get_ai_playlist_recommendation(mood: str):
+# A mood whose suggestions all failed verification is retried sooner.
+AI_EMPTY_CACHE_TTL = float(os.getenv("AI_EMPTY_CACHE_TTL", "300"))
+
+recommendation_cache = TTLCache(maxsize=AI_CACHE_SIZE, ttl=AI_CACHE_TTL, path=AI_CACHE_PATH)
+register_cache("ai_recommendations", recommendation_cache)
+
+# Playlist ids suggested by Gemini are checked against Spotify once and remembered.
+MAX_SUGGESTED_PLAYLISTS = 3
+PLAYLIST_VALID_TTL = float(os.getenv("PLAYLIST_VALID_TTL", "86400"))
+PLAYLIST_INVALID_TTL = float(os.getenv("PLAYLIST_INVALID_TTL", str(7 * 86400)))
+PLAYLIST_FIELDS = "id,name,uri,external_urls.spotify,tracks.total"
+
+valid_playlists = TTLCache(maxsize=4096, ttl=PLAYLIST_VALID_TTL)
+invalid_playlists = TTLCache(maxsize=4096, ttl=PLAYLIST_INVALID_TTL)
+register_cache("valid_playlists", valid_playlists)
+register_cache("invalid_playlists", invalid_playlists)
+
+# Spotify ids are 22 base62 characters, in URI or open.spotify.com URL form.
+PLAYLIST_ID_PATTERN = re.compile(r"(?:spotify:playlist:|open\.spotify\.com/playlist/)([0-9A-Za-z]{22})(?![0-9A-Za-z])")
+
+# Gemini calls are abandoned after GEMINI_TIMEOUT_SECONDS. After
+# GEMINI_FAILURE_THRESHOLD consecutive failures or slow answers the circuit
+# opens and recommendations go straight to the Spotify fallback.
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "10"))
+GEMINI_SLOW_CALL_SECONDS = float(os.getenv("GEMINI_SLOW_CALL_SECONDS", "5"))
+GEMINI_FAILURE_THRESHOLD = int(os.getenv("GEMINI_FAILURE_THRESHOLD", "3"))
+GEMINI_BREAKER_RESET_SECONDS = float(os.getenv("GEMINI_BREAKER_RESET_SECONDS", "30"))
+
+gemini_breaker = CircuitBreaker(
+    "gemini", failure_threshold=GEMINI_FAILURE_THRESHOLD, slow_call_seconds=GEMINI_SLOW_CALL_SECONDS,
+    reset_seconds=GEMINI_BREAKER_RESET_SECONDS,
+)
+
+GEMINI_REQUEST_SECONDS = Histogram("gemini_request_seconds", "Latency of Gemini generate_content calls.")
+GEMINI_REQUESTS = Counter("gemini_requests_total", "Gemini generate_content calls by outcome.", ("outcome",))
+PLAYLIST_CHECKS = Counter("ai_playlist_checks_total", "Suggested playlists checked against Spotify by result.", ("result",))
+
+_model = None
+
+def get_model():
     """
-    Uses Gemini AI to generate a playlist recommendation based on mood.
+    Returns the shared Gemini model, creating it on first use.
+    The Gemini SDK is slow to import, so it is only loaded here.
     """
+    global _model
+    if _model is None:
+        import google.generativeai as genai
+        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        _model = genai.GenerativeModel("gemini-pro")
+    return _model
+
+def normalize_key(text: str) -> str:
+    return " ".join(text.lower().split())
+
+async def _generate(prompt: str) -> str:
+    if not gemini_breaker.allow():
+        GEMINI_REQUESTS.labels(outcome="short_circuit").inc()
+        raise CircuitOpenError("Gemini circuit is open")
+    start = time.perf_counter()
     try:
-        model = genai.GenerativeModel("gemini-pro")
-        response = model.generate_content(f"Suggest a Spotify playlist for someone feeling {mood}. suggest a relevant Spotify playlist that best matches their mood. " 
-                                          "The response should be concise, including only the playlist's name and its Spotify URI, in the format: spotify:playlist:<playlist_id>. Ensure the playlist aligns with the "
-                                          "user's current feelings, whether they seek motivation, relaxation, focus, or nostalgia.")
-
-        playlist_suggestion = response.text.strip()
-        return {"mood": mood, "suggested_playlist": playlist_suggestion}
-    
+        response = await asyncio.wait_for(get_model().generate_content_async(prompt), GEMINI_TIMEOUT_SECONDS)
+        text = response.text.strip()
+    except asyncio.CancelledError:
+        gemini_breaker.record_cancelled()
+        raise
     except Exception as e:
-        logging.error(f"AI Playlist Generation Failed: {e}")
-        return {"error": "Failed to generate playlist recommendation"}
-    
-def get_ai_podcast_recommendation(subject: str):
+        gemini_breaker.record_failure()
+        GEMINI_REQUESTS.labels(outcome="timeout" if isinstance(e, asyncio.TimeoutError) else "error").inc()
+        raise
+    finally:
+        GEMINI_REQUEST_SECONDS.observe(time.perf_counter() - start)
+    gemini_breaker.record_success(time.perf_counter() - start)
+    GEMINI_REQUESTS.labels(outcome="success").inc()
+    return text
+
+def _load_json(text: str):
+    """Parses a JSON answer, tolerating code fences and prose around the object."""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[-1].rsplit("```", 1)[0]
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    try:
+        return json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+
+def parse_playlist_ids(text: str) -> list:
     """
-    Uses Gemini AI to generate a podcast recommendation based on mood.
+    Extracts Spotify playlist ids from a Gemini answer.
+
+    Args:
+        - text (str): The model output, ideally {"playlists": [{"name", "uri"}]}.
+
+    Returns:
+        - list: Unique playlist ids in the order suggested, at most
+          MAX_SUGGESTED_PLAYLISTS. Falls back to scanning the raw text for
+          playlist URIs and URLs when the answer is not the expected JSON.
+    """
+    data = _load_json(text)
+    items = data.get("playlists") if isinstance(data, dict) else data
+    ids = []
+    if isinstance(items, list):
+        for item in items:
+            uri = item.get("uri") if isinstance(item, dict) else item
+            match = PLAYLIST_ID_PATTERN.search(uri) if isinstance(uri, str) else None
+            if match:
+                ids.append(match.group(1))
+    if not ids:
+        ids = PLAYLIST_ID_PATTERN.findall(text)
+    return list(dict.fromkeys(ids))[:MAX_SUGGESTED_PLAYLISTS]
+
+async def verify_playlists(playlist_ids: list, user_id: str = DEFAULT_USER):
+    """
+    Checks playlist ids against Spotify.
+
+    Ids already known to be valid or invalid are answered from cache; the
+    rest are looked up together in one concurrent batch. Missing playlists
+    and empty ones are remembered as invalid.
+
+    Returns:
+        - (list, int): The playable playlists ({'name', 'uri', 'url'}) in the
+          order given, and how many ids could not be checked because Spotify
+          returned an error.
     """
+    unknown = [pid for pid in playlist_ids if valid_playlists.get(pid) is None and invalid_playlists.get(pid) is None]
+    client = get_spotify_client(user_id)
+    results = await asyncio.gather(
+        *(client.playlist(pid, fields=PLAYLIST_FIELDS) for pid in unknown), return_exceptions=True
+    )
+    unresolved = 0
+    for pid, result in zip(unknown, results):
+        if isinstance(result, SpotifyAPIError) and result.status_code in (400, 404):
+            invalid_playlists.set(pid, True)
+            PLAYLIST_CHECKS.labels(result="invalid").inc()
+        elif isinstance(result, Exception):
+            logging.warning(f"Could not verify playlist {pid}: {result}")
+            unresolved += 1
+            PLAYLIST_CHECKS.labels(result="error").inc()
+        elif not (result.get("tracks") or {}).get("total"):
+            invalid_playlists.set(pid, True)
+            PLAYLIST_CHECKS.labels(result="empty").inc()
+        else:
+            valid_playlists.set(pid, {
+                "name": result.get("name"),
+                "uri": result.get("uri") or f"spotify:playlist:{pid}",
+                "url": (result.get("external_urls") or {}).get("spotify"),
+            })
+            PLAYLIST_CHECKS.labels(result="valid").inc()
+    playlists = [valid_playlists.peek(pid) for pid in playlist_ids]
+    return [playlist for playlist in playlists if playlist is not None], unresolved
+
+async def _recommend_playlists(mood: str, user_id: str) -> list:
+    prompt = (f"Suggest up to {MAX_SUGGESTED_PLAYLISTS} existing Spotify playlists for someone feeling {mood}, best match first. "
+              "Make sure the playlists align with the user's current feelings, whether they seek motivation, relaxation, focus, or nostalgia. "
+              "Respond with JSON only, without code fences or any other text, in exactly this form: "
+              '{"playlists": [{"name": "<playlist name>", "uri": "spotify:playlist:<22 character playlist id>"}]}')
+    text = await _generate(prompt)
+    playlists, unresolved = await verify_playlists(parse_playlist_ids(text), user_id)
+    if not playlists and unresolved:
+        # Spotify could not be asked; don't cache the mood as having no playlists.
+        raise RuntimeError(f"Could not verify suggested playlists for '{mood}'")
+    return playlists
+
+async def get_ai_playlist_recommendation(mood: str, user_id: str = DEFAULT_USER):
+    """
+    Uses Gemini AI to recommend playlists for a mood.
+    Only playlists verified to exist on Spotify are returned.
+
+    Returns:
+        - dict: {'mood', 'suggested_playlist': best URI, 'playlists': [...]},
+          or None when no suggested playlist could be verified.
+    """
+    mood = normalize_key(mood)
+    key = f"playlists:{mood}"
     try:
-        model = genai.GenerativeModel("gemini-pro")
-        response = model.generate_content(f"Suggest a podcast on Spotify for someone feeling {subject}. "
-                                          "Ensure the recommendation is engaging, well-reviewed,"
-                                          "and directly related to the chosen subject. Provide only the podcast’s name "
-                                          "and its Spotify URL. Make sure that the podcast URL is correct and valid.")
+        playlists = await recommendation_cache.get_or_load(
+            key, lambda: _recommend_playlists(mood, user_id),
+            ttl=lambda playlists: None if playlists else AI_EMPTY_CACHE_TTL,
+        )
+    except Exception as e:
+        logging.error(f"AI Playlist Generation Failed: {e}")
+        return None
 
+    if not playlists:
+        logging.warning(f"None of the playlists suggested for '{mood}' exist on Spotify.")
+        return None
+    return {"mood": mood, "suggested_playlist": playlists[0]["uri"], "playlists": playlists}
 
-        playlist_suggestion = response.text.strip()
+async def get_ai_podcast_recommendation(subject: str):
+    """
+    Uses Gemini AI to generate a podcast recommendation based on mood.
+    """
+    subject = normalize_key(subject)
+    try:
+        prompt = (f"Suggest a podcast on Spotify for someone feeling {subject}. "
+                  "Ensure the recommendation is engaging, well-reviewed,"
+                  "and directly related to the chosen subject. Provide only the podcast’s name "
+                  "and its Spotify URL. Make sure that the podcast URL is correct and valid.")
+        playlist_suggestion = await recommendation_cache.get_or_load(f"podcast:{subject}", lambda: _generate(prompt))
         return {"subject": subject, "suggested_podcast": playlist_suggestion}
-    
+
 
     except Exception as e:
         logging.error(f"AI Playlist Generation Failed: {e}")
-        return {"error": "Failed to generate playlist recommendation"}    
+        return {"error": "Failed to generate playlist recommendation"}
@@ -0,0 +1,246 @@
+import asyncio
+import json
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+import logging
+from array import array
+from collections import deque
+from metrics import Counter, Histogram
+
+AUDIT_LOG_PATH = os.getenv("AUDIT_LOG_PATH", "audit_log.db")
+
+# Events wait in memory for at most AUDIT_FLUSH_SECONDS before they are
+# written in one transaction. When more than AUDIT_BUFFER_SIZE events are
+# waiting, the oldest are dropped (and counted) rather than blocking callers.
+AUDIT_FLUSH_SECONDS = float(os.getenv("AUDIT_FLUSH_SECONDS", "1"))
+AUDIT_BUFFER_SIZE = int(os.getenv("AUDIT_BUFFER_SIZE", "100000"))
+AUDIT_RETENTION_DAYS = float(os.getenv("AUDIT_RETENTION_DAYS", "90"))
+
+# Columnar export: magic and version, then a zlib-compressed payload.
+EXPORT_MAGIC = b"TSLA\x01"
+
+AUDIT_EVENTS = Counter("audit_events_total", "Audit events recorded by kind.", ("kind",))
+AUDIT_DROPPED = Counter("audit_events_dropped_total", "Audit events dropped because the buffer was full.")
+AUDIT_WRITE_SECONDS = Histogram("audit_write_seconds", "Time to write a batch of audit events.")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    user_id TEXT,
+    subject TEXT,
+    outcome TEXT,
+    duration_ms REAL,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_events_ts ON events (ts);
+CREATE INDEX IF NOT EXISTS idx_events_user_ts ON events (user_id, ts);
+"""
+
+_COLUMNS = ("ts", "kind", "user_id", "subject", "outcome", "duration_ms", "detail")
+# Columns stored as indexes into the export's string table.
+_STRING_COLUMNS = ("kind", "user_id", "subject", "outcome", "detail")
+
+
+class AuditLog:
+    """
+    Write-behind log of structured events (playbacks, token refreshes,
+    recommendations served).
+
+    record() only appends to an in-memory ring buffer, so it never touches
+    the disk and is safe to call from any thread. flush() drains the buffer
+    into an append-only SQLite table in one transaction, off the event loop;
+    the app runs it every AUDIT_FLUSH_SECONDS. Events are indexed by time and
+    by (user, time) for range queries.
+    """
+
+    def __init__(self, path: str = AUDIT_LOG_PATH, buffer_size: int = AUDIT_BUFFER_SIZE):
+        self.path = path
+        self._buffer = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self) -> sqlite3.Connection:
+        # Opened on first use, under self._lock.
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def record(self, kind: str, user_id: str = None, subject: str = None, outcome: str = None,
+               duration: float = None, **detail):
+        """
+        Queues one event.
+
+        Args:
+            - kind (str): What happened, e.g. 'play', 'scheduled_play', 'token_refresh'.
+            - subject (str): What it happened to (playlist URI, mood, ...).
+            - outcome (str): e.g. 'started', 'skipped', 'failed'.
+            - duration (float): Seconds it took, if measured.
+            - detail: Extra JSON-serializable fields.
+        """
+        if len(self._buffer) == self._buffer.maxlen:
+            AUDIT_DROPPED.inc()
+        AUDIT_EVENTS.labels(kind=kind).inc()
+        self._buffer.append((
+            time.time(), kind, user_id, subject, outcome,
+            None if duration is None else duration * 1000,
+            json.dumps(detail, default=str) if detail else None,
+        ))
+
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def write_pending(self) -> int:
+        """Writes every queued event in one transaction. Returns how many were written."""
+        # popleft is atomic, so record() may keep appending meanwhile.
+        batch = [self._buffer.popleft() for _ in range(len(self._buffer))]
+        if not batch:
+            return 0
+        start = time.perf_counter()
+        with self._lock:
+            conn = self._db()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT INTO events (ts, kind, user_id, subject, outcome, duration_ms, detail) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    batch,
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        AUDIT_WRITE_SECONDS.observe(time.perf_counter() - start)
+        return len(batch)
+
+    async def flush(self):
+        """Writes the queued events from a worker thread."""
+        if self._buffer:
+            try:
+                await asyncio.to_thread(self.write_pending)
+            except sqlite3.Error as e:
+                logging.error(f"Writing audit events failed: {e}")
+
+    def query(self, start: float, end: float, user_id: str = None, kind: str = None, limit: int = 1000,
+              after=None):
+        """
+        Returns the events with start <= ts < end, oldest first, from the
+        (user_id, ts) index when a user is given and the ts index otherwise.
+
+        Args:
+            - after: (ts, id) of the last event of the previous page; the
+              next page starts right after it in the index.
+        """
+        query = "SELECT * FROM events WHERE ts >= ? AND ts < ?"
+        params = [start, end]
+        if after is not None:
+            query += " AND (ts, id) > (?, ?)"
+            params.extend(after)
+        if user_id is not None:
+            query += " AND user_id = ?"
+            params.append(user_id)
+        if kind is not None:
+            query += " AND kind = ?"
+            params.append(kind)
+        query += " ORDER BY ts, id LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._db().execute(query, params).fetchall()
+        events = []
+        for row in rows:
+            event = dict(row)
+            event["detail"] = json.loads(event["detail"]) if event["detail"] else None
+            events.append(event)
+        return events
+
+    def export(self, start: float, end: float, user_id: str = None) -> bytes:
+        """
+        Exports the events with start <= ts < end in a compact columnar form
+        (see read_export): timestamps and durations as packed doubles and
+        floats, text columns dictionary-encoded, the whole payload compressed.
+        """
+        strings = {None: 0}
+        ts = array("d")
+        durations = array("f")
+        codes = {column: array("I") for column in _STRING_COLUMNS}
+
+        query = "SELECT ts, kind, user_id, subject, outcome, duration_ms, detail FROM events WHERE ts >= ? AND ts < ?"
+        params = (start, end)
+        if user_id is not None:
+            query += " AND user_id = ?"
+            params += (user_id,)
+        with self._lock:
+            cursor = self._db().execute(query + " ORDER BY ts, id", params)
+            for row in cursor:
+                ts.append(row[0])
+                durations.append(float("nan") if row[5] is None else row[5])
+                for column, value in zip(_STRING_COLUMNS, (row[1], row[2], row[3], row[4], row[6])):
+                    codes[column].append(strings.setdefault(value, len(strings)))
+
+        columns = {"ts": ts, "duration_ms": durations, **codes}
+        if sys.byteorder == "big":
+            for values in columns.values():
+                values.byteswap()
+        header = json.dumps({
+            "count": len(ts),
+            "strings": list(strings)[1:],  # Index 0 is None
+            "columns": [[name, columns[name].typecode] for name in _COLUMNS],
+        }).encode("utf-8")
+        payload = b"".join([struct.pack("<I", len(header)), header, *(columns[name].tobytes() for name in _COLUMNS)])
+        return EXPORT_MAGIC + zlib.compress(payload)
+
+    def purge(self, older_than: float) -> int:
+        """Deletes the events recorded before `older_than`."""
+        with self._lock:
+            cursor = self._db().execute("DELETE FROM events WHERE ts < ?", (older_than,))
+        logging.info(f"Purged {cursor.rowcount} audit events.")
+        return cursor.rowcount
+
+    async def purge_expired(self):
+        await asyncio.to_thread(self.purge, time.time() - AUDIT_RETENTION_DAYS * 86400)
+
+    async def close(self):
+        """Writes what is still queued and closes the database."""
+        await self.flush()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def read_export(data: bytes) -> dict:
+    """
+    Decodes AuditLog.export output into columns: {'ts': array('d'),
+    'duration_ms': array('f') (NaN when unknown), and 'kind', 'user_id',
+    'subject', 'outcome', 'detail' as lists of strings or None}.
+    """
+    if not data.startswith(EXPORT_MAGIC):
+        raise ValueError("Not an audit log export.")
+    payload = zlib.decompress(data[len(EXPORT_MAGIC):])
+    header_size = struct.unpack_from("<I", payload)[0]
+    header = json.loads(payload[4:4 + header_size])
+    strings = [None, *header["strings"]]
+    offset = 4 + header_size
+    columns = {}
+    for name, typecode in header["columns"]:
+        values = array(typecode)
+        size = values.itemsize * header["count"]
+        values.frombytes(payload[offset:offset + size])
+        offset += size
+        if sys.byteorder == "big":
+            values.byteswap()
+        columns[name] = [strings[code] for code in values] if name in _STRING_COLUMNS else values
+    return columns
+
+
+audit_log = AuditLog()
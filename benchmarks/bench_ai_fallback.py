@@ -0,0 +1,155 @@
+"""
+Latency and behaviour of the Gemini -> Spotify fallback chain under a
+healthy, slow and down Gemini.
+
+Usage:
+    python benchmarks/bench_ai_fallback.py [--requests 40] [--concurrency 4] [--hedge 0.5]
+
+Each request is a cold mood (not in the recommendation table), so it goes
+through the AI recommendation and, if needed, the Spotify fallback. Gemini
+is the in-process fake model with injected latency; Spotify is the local
+mock server. Timeouts are scaled down: Gemini calls time out after
+`--timeout` seconds and count as slow after `--slow` seconds.
+
+Modes:
+  - baseline: no circuit breaker, no hedging (the previous behaviour),
+  - breaker: the circuit breaker opens after `--threshold` failures,
+  - hedged: breaker plus a Spotify request fired after `--hedge` seconds.
+
+The run ends with a list of checks (answers come from AI when Gemini is
+healthy and from Spotify when it is down, the breaker stops calling a dead
+model, hedging bounds latency). Exits non-zero if one fails.
+"""
+import argparse
+import asyncio
+import logging
+import math
+import sys
+import time
+
+from common import percentile
+
+import ai
+import recommendations
+import scheduled_playback
+import spotify_async
+from circuit_breaker import CircuitBreaker
+from fake_gemini import FakeModel
+from mock_spotify import start_mock_server
+from rate_limiter import RateLimiter
+
+MODES = ("baseline", "breaker", "hedged")
+
+
+def scenarios(args):
+    return {
+        "healthy": FakeModel(latency=args.timeout / 8),
+        "slow": FakeModel(latency=(args.slow + args.timeout) / 2),
+        "down": FakeModel(latency=args.timeout * 10),  # Hangs until our timeout
+    }
+
+
+def reset():
+    for cache in (ai.recommendation_cache, ai.valid_playlists, ai.invalid_playlists,
+                  scheduled_playback.category_cache, recommendations.recommendation_table):
+        cache.clear()
+
+
+async def run(base_url, scenario, model, mode, args):
+    async def token(*_):
+        return "mock"
+
+    spotify_async._client = spotify_async.AsyncSpotifyClient(
+        token_provider=token, base_url=f"{base_url}/v1", rate_limiter=RateLimiter(rate=0)
+    )
+    reset()
+    ai._model = model
+    model.calls = 0
+    ai.GEMINI_TIMEOUT_SECONDS = args.timeout
+    if mode == "baseline":
+        ai.gemini_breaker = CircuitBreaker("gemini", failure_threshold=math.inf, slow_call_seconds=math.inf)
+    else:
+        ai.gemini_breaker = CircuitBreaker("gemini", failure_threshold=args.threshold,
+                                           slow_call_seconds=args.slow, reset_seconds=args.reset)
+    recommendations.AI_HEDGE_SECONDS = args.hedge if mode == "hedged" else 0
+
+    latencies = []
+    sources = {"ai": 0, "spotify": 0, "error": 0}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                result = await recommendations.mood_recommendation(f"{scenario} mood {i}")
+                sources["ai" if isinstance(result, dict) else "spotify"] += 1
+            except Exception:
+                sources["error"] += 1
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one(i) for i in range(args.requests)))
+    # Let abandoned (hedged) Gemini calls finish before the next run.
+    while ai.recommendation_cache._inflight:
+        await asyncio.sleep(0.05)
+    await spotify_async.close_spotify_client()
+    return {"latencies": latencies, "sources": sources, "gemini_calls": model.calls}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=2)
+    parser.add_argument("--slow", type=float, default=1)
+    parser.add_argument("--threshold", type=int, default=3)
+    parser.add_argument("--reset", type=float, default=30)
+    parser.add_argument("--hedge", type=float, default=0.5)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.CRITICAL)
+    recommendations.recommendation_table.path = None
+
+    _, base_url = start_mock_server(latency=args.latency)
+    print(f"{args.requests} cold mood requests, {args.concurrency} at a time; Gemini timeout {args.timeout}s, "
+          f"slow after {args.slow}s, breaker threshold {args.threshold}, hedge after {args.hedge}s")
+
+    results = {}
+    for scenario, model in scenarios(args).items():
+        for mode in MODES:
+            result = results[scenario, mode] = asyncio.run(run(base_url, scenario, model, mode, args))
+            latencies = [s * 1000 for s in result["latencies"]]
+            sources = result["sources"]
+            print(
+                f"{scenario:>8} {mode:>8}: p50 {percentile(latencies, 50):6.0f}ms p99 {percentile(latencies, 99):6.0f}ms | "
+                f"ai {sources['ai']:3} spotify {sources['spotify']:3} errors {sources['error']} | "
+                f"{result['gemini_calls']} Gemini calls"
+            )
+
+    n = args.requests
+    spotify_bound = (args.hedge + 0.5) * 1000
+    checks = [
+        ("healthy: every mode answers from AI",
+         all(results["healthy", mode]["sources"]["ai"] == n for mode in MODES)),
+        ("healthy: the breaker stays closed (one Gemini call per request)",
+         results["healthy", "breaker"]["gemini_calls"] == n),
+        ("down: every mode falls back to Spotify without errors",
+         all(results["down", mode]["sources"]["spotify"] == n for mode in MODES)),
+        ("down: the breaker stops calling Gemini after the threshold",
+         results["down", "breaker"]["gemini_calls"] <= args.threshold + args.concurrency),
+        ("slow: slow answers open the breaker",
+         results["slow", "breaker"]["gemini_calls"] <= args.threshold + args.concurrency),
+        # The requests that trip the breaker still wait, so p99 stays; the median drops.
+        ("slow/down: the breaker cuts median latency to a Spotify round trip",
+         all(percentile(results[s, "breaker"]["latencies"], 50) * 1000 < spotify_bound
+             for s in ("slow", "down"))),
+        (f"slow/down: hedged requests never wait much past the hedge ({spotify_bound:.0f}ms)",
+         all(max(results[s, "hedged"]["latencies"]) * 1000 < spotify_bound for s in ("slow", "down"))),
+    ]
+    print()
+    for name, ok in checks:
+        print(f"{'PASS' if ok else 'FAIL'}: {name}")
+    sys.exit(0 if all(ok for _, ok in checks) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Request-path cost, write throughput, range queries and export size of the
+audit log.
+
+Usage:
+    python benchmarks/bench_audit_log.py [--events 2000000] [--users 10000] [--queries 1000]
+
+Measures:
+  - the time record() adds to a request vs. writing each event to SQLite
+    as it happens (one INSERT + COMMIT per event),
+  - how fast the background writer stores batches,
+  - on `--events` events of `--users` users over 30 days: "what happened
+    for this user in this day" from the (user_id, ts) index vs. a full scan,
+    a 1 minute window over all users, and paging through a user's month,
+  - the size of a columnar export vs. the same events as JSON.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from common import percentile
+
+from audit_log import AuditLog, read_export
+
+DAY = 86400
+KINDS = [("play", "started"), ("play", "skipped"), ("scheduled_play", "success"), ("token_refresh", "success"),
+         ("recommendation", "ai"), ("play", "failed")]
+
+
+def report(label, seconds, extra=""):
+    values = [s * 1000 for s in seconds]
+    print(f"{label:>26}: p50 {percentile(values, 50):8.3f}ms p99 {percentile(values, 99):8.3f}ms {extra}")
+
+
+def timed_calls(func, args_list):
+    latencies = []
+    results = []
+    for args in args_list:
+        start = time.perf_counter()
+        results.append(func(*args))
+        latencies.append(time.perf_counter() - start)
+    return latencies, results
+
+
+def synthetic_event(now, users):
+    kind, outcome = random.choice(KINDS)
+    detail = json.dumps({"job_id": f"{random.getrandbits(64):016x}"}) if kind == "scheduled_play" else None
+    return (now - random.random() * 30 * DAY, kind, random.choice(users),
+            f"spotify:playlist:p{random.randrange(5000)}", outcome, random.random() * 300, detail)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=2_000_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--queries", type=int, default=1000)
+    args = parser.parse_args()
+    users = [f"user{i}" for i in range(args.users)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        log = AuditLog(os.path.join(tmp, "audit.db"), buffer_size=args.events)
+
+        calls = [("play", random.choice(users), "spotify:playlist:p1", "started", 0.05) for _ in range(5000)]
+        latencies, _ = timed_calls(lambda *event: log.record(*event, device_id="d1"), calls)
+        report("record (write-behind)", latencies)
+        log.write_pending()
+
+        direct = sqlite3.connect(os.path.join(tmp, "direct.db"), isolation_level=None)
+        direct.execute("PRAGMA journal_mode=WAL")
+        direct.execute("PRAGMA synchronous=NORMAL")
+        direct.execute("CREATE TABLE events (id INTEGER PRIMARY KEY, ts REAL, kind TEXT, user_id TEXT, "
+                       "subject TEXT, outcome TEXT, duration_ms REAL, detail TEXT)")
+
+        def write_through(kind, user_id, subject, outcome, duration):
+            direct.execute("INSERT INTO events (ts, kind, user_id, subject, outcome, duration_ms, detail) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (time.time(), kind, user_id, subject, outcome, duration * 1000, '{"device_id": "d1"}'))
+        latencies, _ = timed_calls(write_through, calls[:1000])
+        report("write-through", latencies)
+        direct.close()
+
+        now = time.time()
+        written = 0
+        writing = 0
+        for first in range(0, args.events, 100_000):
+            log._buffer.extend(synthetic_event(now, users) for _ in range(min(100_000, args.events - first)))
+            start = time.perf_counter()
+            written += log.write_pending()
+            writing += time.perf_counter() - start
+        print(f"{written:,} events written by the background writer in batches of 100k: "
+              f"{written / writing:,.0f} events/s")
+
+        windows = [(random.choice(users), now - random.random() * 29 * DAY) for _ in range(args.queries)]
+        latencies, found = timed_calls(lambda user_id, t1: log.query(t1, t1 + DAY, user_id=user_id), windows)
+        report("user day (index)", latencies, f"| {sum(map(len, found)) / len(found):.1f} events per query")
+
+        def scan(user_id, t1):
+            with log._lock:
+                return log._db().execute("SELECT * FROM events NOT INDEXED WHERE user_id = ? AND ts >= ? AND ts < ?",
+                                         (user_id, t1, t1 + DAY)).fetchall()
+        latencies, _ = timed_calls(scan, windows[:max(1, args.queries // 100)])
+        report("user day (full scan)", latencies)
+
+        minutes = [(now - random.random() * 29 * DAY,) for _ in range(args.queries)]
+        latencies, found = timed_calls(lambda t1: log.query(t1, t1 + 60), minutes)
+        report("1 min, all users (index)", latencies, f"| {sum(map(len, found)) / len(found):.1f} events per query")
+
+        def page_through(user_id):
+            after, pages = None, 0
+            while True:
+                page = log.query(now - 31 * DAY, now + 1, user_id=user_id, limit=10, after=after)
+                pages += 1
+                if len(page) < 10:
+                    return pages
+                after = (page[-1]["ts"], page[-1]["id"])
+        latencies, pages = timed_calls(page_through, [(random.choice(users),) for _ in range(50)])
+        report("user month, pages of 10", latencies, f"| {sum(pages) / len(pages):.1f} pages")
+
+        for label, export_args in (("user month", (now - 31 * DAY, now + 1, users[0])),
+                                   ("all users, 1 day", (now - DAY, now))):
+            start = time.perf_counter()
+            data = log.export(*export_args)
+            elapsed = time.perf_counter() - start
+            columns = read_export(data)
+            count = len(columns["ts"])
+            as_json = len("\n".join(json.dumps(event) for event in log.query(*export_args[:2], *export_args[2:],
+                                                                             limit=count)).encode("utf-8"))
+            print(f"{label:>26}: {count:,} events exported in {elapsed * 1000:.0f}ms, {len(data) / count:.1f} B/event "
+                  f"vs. {as_json / count:.1f} B/event as JSON lines")
+        with log._lock:
+            log._db().execute("PRAGMA wal_checkpoint(TRUNCATE)")  # Count what is still in the WAL
+        size = os.path.getsize(log.path)
+        if os.path.exists(log.path + "-wal"):
+            size += os.path.getsize(log.path + "-wal")
+        print(f"database size: {size / written:.0f} B/event (with both indexes)")
+
+
+if __name__ == "__main__":
+    main()
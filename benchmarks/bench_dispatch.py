@@ -0,0 +1,133 @@
+"""
+Fire-time skew of scheduled playbacks when many are due at once.
+
+Usage:
+    python benchmarks/bench_dispatch.py [--jobs 10000] [--latency 0.02]
+
+`--jobs` playbacks are due at the same second (schedules on a round minute,
+e.g. everyone at 07:00) and are handed over PREFIRE seconds early, like the
+job store poller does. Each job looks up devices ahead of time and fires a
+start_playback against the local mock Spotify server.
+
+"before" replays the previous path: one APScheduler job per playback, each
+preparing, sleeping until its run time and firing on its own. "after" uses
+the Dispatcher (one timer heap, bounded worker pools, per-job deadline).
+Skew is the delay between run_at and the completed start_playback.
+"""
+import argparse
+import asyncio
+import time
+
+from common import percentile
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from dispatcher import Dispatcher
+from mock_spotify import start_mock_server
+from rate_limiter import RateLimiter
+from spotify_async import AsyncSpotifyClient
+
+PREFIRE_SECONDS = 5
+
+
+def report(label, skews, submit_seconds, total):
+    skews = [s * 1000 for s in skews]
+    print(
+        f"{label:>6}: {len(skews)}/{total} fired, hand-off {submit_seconds * 1000:.0f}ms | skew "
+        f"p50 {percentile(skews, 50):.0f}ms p90 {percentile(skews, 90):.0f}ms "
+        f"p99 {percentile(skews, 99):.0f}ms max {max(skews):.0f}ms"
+    )
+
+
+def make_client(base_url):
+    async def token():
+        return "mock"
+    return AsyncSpotifyClient(token_provider=token, base_url=f"{base_url}/v1", rate_limiter=RateLimiter(rate=0))
+
+
+async def prepare(client, job):
+    devices = await client.devices()
+    return {"device_id": devices[0]["id"]}
+
+
+async def fire(client, job, skews, device_id=None):
+    await client.start_playback(context_uri=job["playlist_uri"], device_id=device_id)
+    skews.append(time.time() - job["run_at"])
+
+
+async def run_before(base_url, count):
+    client = make_client(base_url)
+    skews = []
+    scheduler = AsyncIOScheduler()
+    scheduler.start()
+
+    async def run_job(job):
+        context = {}
+        try:
+            context = await prepare(client, job)
+        except Exception:
+            pass
+        wait = job["run_at"] - time.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await fire(client, job, skews, **context)
+
+    run_at = time.time() + PREFIRE_SECONDS
+    jobs = [{"id": str(i), "playlist_uri": f"spotify:playlist:{i}", "run_at": run_at} for i in range(count)]
+    start = time.perf_counter()
+    for job in jobs:
+        scheduler.add_job(run_job, args=[job], misfire_grace_time=None)
+    submit_seconds = time.perf_counter() - start
+
+    while len(skews) < count and time.time() < run_at + 120:
+        await asyncio.sleep(0.05)
+    scheduler.shutdown(wait=False)
+    await client.close()
+    return skews, submit_seconds
+
+
+async def run_after(base_url, count, workers):
+    client = make_client(base_url)
+    skews = []
+    done = asyncio.Event()
+    outcomes = []
+
+    def on_done(job, outcome):
+        outcomes.append(outcome)
+        if len(outcomes) == count:
+            done.set()
+
+    dispatcher = Dispatcher(lambda job, **context: fire(client, job, skews, **context),
+                            prepare=lambda job: prepare(client, job), on_done=on_done, workers=workers)
+    dispatcher.start()
+
+    run_at = time.time() + PREFIRE_SECONDS
+    jobs = [{"id": str(i), "playlist_uri": f"spotify:playlist:{i}", "run_at": run_at} for i in range(count)]
+    start = time.perf_counter()
+    dispatcher.submit(jobs)
+    submit_seconds = time.perf_counter() - start
+
+    try:
+        await asyncio.wait_for(done.wait(), PREFIRE_SECONDS + 120)
+    except asyncio.TimeoutError:
+        pass
+    await dispatcher.stop()
+    await client.close()
+    return skews, submit_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=10_000)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--workers", type=int, default=100)
+    args = parser.parse_args()
+
+    _, base_url = start_mock_server(latency=args.latency)
+    print(f"{args.jobs} playbacks due at the same second, {args.latency * 1000:.0f}ms upstream latency")
+    report("before", *asyncio.run(run_before(base_url, args.jobs)), args.jobs)
+    report("after", *asyncio.run(run_after(base_url, args.jobs, args.workers)), args.jobs)
+
+
+if __name__ == "__main__":
+    main()
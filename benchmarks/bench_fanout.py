@@ -0,0 +1,105 @@
+"""
+Start-time spread of one scheduled playback fanned out to many devices.
+
+Usage:
+    python benchmarks/bench_fanout.py [--devices 500] [--accounts 50] [--runs 5]
+                                      [--concurrency 100] [--latency 0.02]
+
+`--devices` devices spread over `--accounts` accounts on the local mock
+Spotify server all start the same playlist. Compares:
+  - "sequential": one start_playback after the other, the only way to cover
+    several devices before fan-out (one play_playlist call per device),
+  - "fan-out cold": play_fanout on a fresh connection pool,
+  - "fan-out warm": prepare_fanout (tokens, pooled connections) ahead of
+    play_fanout, as the scheduler does PREFIRE_SECONDS before a job is due.
+
+The spread is the time between the first and the last device starting, as
+reported by play_fanout and as seen by the mock. The rate limiter is
+disabled: with the default SPOTIFY_RATE_LIMIT the budget, not the fan-out,
+bounds how fast hundreds of devices can start.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+import common  # noqa: F401  (puts the repository root on sys.path)
+
+from mock_spotify import settings as mock, start_mock_server
+
+PLAYLIST = "spotify:playlist:fanout"
+
+
+async def run(mode, base_url, targets):
+    import scheduled_playback
+    import spotify_async
+    from rate_limiter import RateLimiter
+
+    async def token(user_id=None):
+        return f"token-{user_id}"
+
+    spotify_async._client = spotify_async.AsyncSpotifyClient(
+        token_provider=token, base_url=f"{base_url}/v1", rate_limiter=RateLimiter(rate=0)
+    )
+    mock.device_plays.clear()
+    if mode == "fan-out warm":
+        await scheduled_playback.prepare_fanout(targets)
+
+    start = time.perf_counter()
+    if mode == "sequential":
+        for user_id, device_id in targets:
+            await scheduled_playback.play_playlist(PLAYLIST, device_id=device_id, user_id=user_id)
+        result = None
+    else:
+        result = await scheduled_playback.play_fanout(PLAYLIST, targets)
+    elapsed = time.perf_counter() - start
+    await spotify_async.close_spotify_client()
+
+    seen = sorted(mock.device_plays.values())
+    return {
+        "total_ms": elapsed * 1000,
+        "spread_ms": result["spread_ms"] if result else None,
+        "mock_spread_ms": (seen[-1] - seen[0]) * 1000,
+        "started": len(seen),
+    }
+
+
+def report(mode, runs):
+    def median(key):
+        values = [run[key] for run in runs if run[key] is not None]
+        return f"{statistics.median(values):7.0f}ms" if values else "      -  "
+    print(f"{mode:>13}: total {median('total_ms')} | spread {median('spread_ms')} | "
+          f"spread at the mock {median('mock_spread_ms')} | {runs[0]['started']} devices started")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--accounts", type=int, default=50)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    _, base_url = start_mock_server(latency=args.latency)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SESSION_STORE_PATH"] = os.path.join(tmp, "sessions.db")
+        os.chdir(tmp)  # A token_info.json in the working directory would be imported
+        logging.getLogger().setLevel(logging.ERROR)
+        import scheduled_playback
+        scheduled_playback.FANOUT_CONCURRENCY = args.concurrency
+
+        targets = [(f"account{i % args.accounts}", f"device{i}") for i in range(args.devices)]
+        print(f"{args.devices} devices on {args.accounts} accounts, {args.concurrency} starts in flight, "
+              f"{args.latency * 1000:.0f}ms mock latency, median of {args.runs} runs")
+        for mode in ("sequential", "fan-out cold", "fan-out warm"):
+            runs = [asyncio.run(run(mode, base_url, targets)) for _ in range(1 if mode == "sequential" else args.runs)]
+            report(mode, runs)
+        print(f"connection warm-ups: {mock.warm_ups}")
+
+
+if __name__ == "__main__":
+    main()
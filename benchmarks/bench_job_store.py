@@ -0,0 +1,100 @@
+"""
+Scheduling throughput and firing skew of the SQLite job store.
+
+Usage:
+    python benchmarks/bench_job_store.py [--jobs 100000] [--workers 4]
+
+Inserts `--jobs` pending schedules, measures insert rate and next-due lookup
+latency, then lets `--workers` processes claim a burst of due jobs and reports
+fire skew and duplicate fires.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from common import percentile
+
+from job_store import JobStore
+
+
+def next_due_time(store):
+    """The run_at of the earliest pending job: a MIN over the (status, run_at) index."""
+    with store._lock:
+        return store._conn.execute("SELECT MIN(run_at) FROM scheduled_jobs WHERE status = 'pending'").fetchone()[0]
+
+
+def worker(path, worker_id, deadline, results):
+    store = JobStore(path)
+    fired = []
+    while time.time() < deadline:
+        jobs = store.claim_due_jobs(worker_id)
+        now = time.time()
+        for job in jobs:
+            fired.append((job["id"], now - job["run_at"]))
+        if jobs:
+            store.finish_many([(job["id"], "done", None) for job in jobs])
+        else:
+            time.sleep(0.01)
+    results.put(fired)
+    store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=100_000)
+    parser.add_argument("--burst", type=int, default=2_000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "jobs.db")
+        store = JobStore(path)
+
+        far_future = time.time() + 86400
+        start = time.perf_counter()
+        for i in range(args.jobs):
+            store.add("spotify:playlist:bench", far_future + random.random() * 86400, user_id=f"user{i % 5000}")
+        elapsed = time.perf_counter() - start
+        print(f"insert: {args.jobs} jobs in {elapsed:.2f}s ({args.jobs / elapsed:,.0f} jobs/s)")
+
+        lookups = []
+        for _ in range(1000):
+            t0 = time.perf_counter()
+            next_due_time(store)
+            lookups.append((time.perf_counter() - t0) * 1e6)
+        print(f"next-due lookup: p50 {percentile(lookups, 50):.1f}us p99 {percentile(lookups, 99):.1f}us")
+
+        fire_at = time.time() + 2
+        for i in range(args.burst):
+            store.add("spotify:playlist:burst", fire_at + (i % 10) * 0.1, user_id=f"user{i}")
+        store.close()
+
+        results = multiprocessing.Queue()
+        deadline = fire_at + 5
+        procs = [
+            multiprocessing.Process(target=worker, args=(path, f"w{i}", deadline, results))
+            for i in range(args.workers)
+        ]
+        for proc in procs:
+            proc.start()
+        fired = []
+        for _ in procs:
+            fired.extend(results.get())
+        for proc in procs:
+            proc.join()
+
+        ids = [job_id for job_id, _ in fired]
+        skews = [skew * 1000 for _, skew in fired]
+        print(f"fired: {len(ids)}/{args.burst} jobs, duplicates: {len(ids) - len(set(ids))}")
+        print(
+            f"fire skew: p50 {percentile(skews, 50):.1f}ms p99 {percentile(skews, 99):.1f}ms "
+            f"max {max(skews):.1f}ms mean {statistics.mean(skews):.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Mood lookups for 1M users in their own time zones, and how the mood changes
+(and the prefetches they trigger) spread over a day.
+
+Usage:
+    python benchmarks/bench_mood_engine.py [--users 1000000] [--custom 0.1] [--sample 100000]
+
+Users get a random IANA time zone; a `--custom` share of them also gets
+one of a few custom rule sets (minute windows, different weekend rules).
+Measures:
+  - time and memory to load the settings of every user,
+  - mood lookups from the precomputed transition tables vs. computing each
+    user's local time and window on every request (and the old global
+    hour check, which ignores time zones),
+  - mood changes per minute over a day with one server-local clock vs.
+    per-user time zones, and the prefetches each worker runs for them when
+    polling every MOOD_PREFETCH_POLL_SECONDS.
+"""
+import argparse
+import random
+import time
+import tracemalloc
+from bisect import bisect_right
+from collections import Counter
+from datetime import datetime
+from zoneinfo import ZoneInfo, available_timezones
+
+from common import percentile
+
+from mood_engine import MOOD_PREFETCH_POLL_SECONDS, MOOD_REBUILDS, MoodEngine, parse_rules
+from scheduled_playback import MOOD_WINDOWS, PREFETCH_LEAD_SECONDS
+
+CUSTOM_RULES = [
+    {"weekday": {"06:45": "energy boost", "09:00": "focus", "17:30": "chill", "23:15": "sleep"},
+     "weekend": {"09:30": "chill", "23:45": "sleep"}},
+    {"weekday": {"05:30": "workout", "07:00": "energy boost", "13:00": "focus", "21:00": "sleep"}},
+    {"weekday": {"08:00": "focus", "20:00": "party"}, "weekend": {"11:00": "chill", "20:00": "party"}},
+    {"weekday": {"22:00": "focus", "07:00": "sleep"}},  # Night shift
+]
+
+
+def report(label, seconds, extra=""):
+    values = [s * 1e6 for s in seconds]
+    print(f"{label:>34}: p50 {percentile(values, 50):6.2f}us p99 {percentile(values, 99):6.2f}us {extra}")
+
+
+def old_mood():
+    """The global time-of-day check the engine replaced (server-local hour)."""
+    hour = datetime.now().hour
+    mood = MOOD_WINDOWS[-1][1]
+    for start_hour, window_mood in MOOD_WINDOWS:
+        if hour >= start_hour:
+            mood = window_mood
+    return mood
+
+
+def computed_mood(zone, rules, now):
+    """The per-user mood computed on each request: local time, then the rule window."""
+    local = datetime.fromtimestamp(now, zone)
+    windows = rules["weekend" if local.weekday() >= 5 else "weekday"]
+    index = bisect_right(windows, (local.hour * 60 + local.minute, "\uffff")) - 1
+    return windows[index][1]  # Before the first window: today's last one, not yesterday's
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--custom", type=float, default=0.1)
+    parser.add_argument("--sample", type=int, default=100_000)
+    args = parser.parse_args()
+
+    random.seed(1)
+    zones = sorted(available_timezones() - {"Factory", "localtime"})
+    users = [f"user{i}" for i in range(args.users)]
+    settings = [(random.choice(zones), random.choice(CUSTOM_RULES) if random.random() < args.custom else None)
+                for _ in users]
+
+    engine = MoodEngine(timezone="UTC")
+    start = time.perf_counter()
+    for user_id, (timezone, rules) in zip(users, settings):
+        engine.set_user(user_id, timezone, rules)
+    elapsed = time.perf_counter() - start
+
+    # Memory on a slice, as tracing slows the load down several times.
+    traced = min(100_000, args.users)
+    tracemalloc.start()
+    sliced = MoodEngine(timezone="UTC")
+    for user_id, (timezone, rules) in zip(users[:traced], settings[:traced]):
+        sliced.set_user(user_id, timezone, rules)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del sliced
+    print(f"{args.users:,} users in {len(zones)} time zones, {engine.profile_count():,} profiles: loaded in "
+          f"{elapsed:.1f}s, {memory / traced:.0f} B/user")
+
+    now = time.time()
+    start = time.perf_counter()
+    for user_id in users:
+        engine.mood_for(user_id, now)
+    elapsed = time.perf_counter() - start
+    print(f"resolved all {args.users:,} users in {elapsed:.2f}s ({args.users / elapsed:,.0f}/s, "
+          f"first lookups build each profile's table)")
+
+    sample = random.sample(range(args.users), min(args.sample, args.users))
+    sampled_users = [users[i] for i in sample]
+    mood_for = engine.mood_for
+    latencies = []
+    for user_id in sampled_users:
+        t0 = time.perf_counter()
+        mood_for(user_id, now)
+        latencies.append(time.perf_counter() - t0)
+    start = time.perf_counter()
+    for user_id in sampled_users:
+        mood_for(user_id, now)
+    rate = len(sample) / (time.perf_counter() - start)
+    report("precomputed table", latencies, f"| {rate:,.0f} lookups/s")
+
+    # The same settings kept per user and evaluated on each request.
+    default_rules = parse_rules({"weekday": {f"{h:02d}:00": m for h, m in MOOD_WINDOWS}})
+    parsed = {id(rules): parse_rules(rules) for rules in CUSTOM_RULES}
+    zone_cache = {zone: ZoneInfo(zone) for zone in zones}
+    user_settings = {user_id: (zone_cache[timezone], parsed[id(rules)] if rules else default_rules)
+                     for user_id, (timezone, rules) in zip(users, settings)}
+
+    def computed(user_id):
+        zone, rules = user_settings[user_id]
+        return computed_mood(zone, rules, now)
+
+    latencies = []
+    for user_id in sampled_users:
+        t0 = time.perf_counter()
+        computed(user_id)
+        latencies.append(time.perf_counter() - t0)
+    start = time.perf_counter()
+    for user_id in sampled_users:
+        computed(user_id)
+    rate = len(sample) / (time.perf_counter() - start)
+    mismatches = sum(computed(user_id) != mood_for(user_id, now) for user_id in sampled_users)
+    report("computed per request", latencies, f"| {rate:,.0f} lookups/s, {mismatches} differ (no look back "
+                                              f"to the previous day)")
+
+    latencies = []
+    for _ in sample:
+        t0 = time.perf_counter()
+        old_mood()
+        latencies.append(time.perf_counter() - t0)
+    report("old global hour check", latencies, "| same mood in every time zone")
+
+    # A day of lookups: the tables are only rebuilt when they run out.
+    before = MOOD_REBUILDS.labels().value
+    start = time.perf_counter()
+    for hour in range(24):
+        at = now + hour * 3600
+        for user_id in sampled_users[:10_000]:
+            mood_for(user_id, at)
+    elapsed = time.perf_counter() - start
+    print(f"{'24 hours of lookups':>34}: {240_000 / elapsed:,.0f} lookups/s, "
+          f"{MOOD_REBUILDS.labels().value - before:,.0f} table rebuilds")
+
+    # Mood changes over the next day, per minute.
+    day_start = now - now % 60
+    transitions = engine.transitions_between(day_start, day_start + 86400)
+    per_minute = Counter()
+    for ts, _, count in transitions:
+        per_minute[int(ts // 60)] += count
+    busiest = per_minute.most_common(1)[0][1]
+    changes = sum(per_minute.values())
+    print(f"{'mood changes per day':>34}: {changes:,} over {len(per_minute):,} minutes, "
+          f"peak {busiest:,} users/minute (one server clock: {args.users:,} users in each of "
+          f"{len(MOOD_WINDOWS)} minutes)")
+
+    prefetches = 0
+    busiest_poll = 0
+    poll_seconds = []
+    polled_until = day_start
+    at = day_start
+    while at < day_start + 86400:
+        t0 = time.perf_counter()
+        end = at + PREFETCH_LEAD_SECONDS
+        moods = {mood for _, mood, _ in engine.transitions_between(max(at, polled_until), end)}
+        polled_until = end
+        poll_seconds.append(time.perf_counter() - t0)
+        prefetches += len(moods)
+        busiest_poll = max(busiest_poll, len(moods))
+        at += MOOD_PREFETCH_POLL_SECONDS
+    print(f"{'prefetches per day':>34}: {prefetches:,} ({busiest_poll} at most per {MOOD_PREFETCH_POLL_SECONDS:.0f}s "
+          f"poll, poll p99 {percentile(poll_seconds, 99) * 1000:.1f}ms) vs. {len(MOOD_WINDOWS)} bursts at one "
+          f"server-local time")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Spotify calls spent on showing playback state to several consumers per user
+and on recurring scheduled playbacks of a context that is already playing.
+
+Usage:
+    python benchmarks/bench_playback_state.py [--users 50] [--consumers 5] [--jobs 5]
+                                              [--duration 10] [--poll 1] [--latency 0.02]
+
+Every user is already playing their playlist. For `--duration` seconds,
+`--consumers` clients per user watch the playback state, and `--jobs`
+scheduled playbacks per user fire for that same playlist (e.g. a cron rule
+matching what is on).
+
+"before" replays the previous behaviour: each consumer polls GET /me/player
+itself every `--poll` seconds, and every job sends start_playback. "after"
+subscribes the consumers to the PlaybackStateTracker (one poller per user)
+and runs the jobs through prepare_playback / play_playlist, which skip the
+start_playback when the context is already playing.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+import common  # noqa: F401  (puts the repository root on sys.path)
+
+from mock_spotify import settings as mock, start_mock_server
+
+
+def report(label, player_calls, play_calls, updates, duration):
+    total = player_calls + play_calls
+    print(
+        f"{label:>6}: {player_calls} GET /me/player + {play_calls} start_playback = {total} Spotify calls "
+        f"({total / duration:.0f}/s) | {updates} state updates delivered"
+    )
+
+
+async def run(mode, base_url, args):
+    import playback_state
+    import scheduled_playback
+    import spotify_async
+    from rate_limiter import RateLimiter
+
+    async def token(user_id=None):
+        return f"token-{user_id}"
+
+    spotify_async._client = spotify_async.AsyncSpotifyClient(
+        token_provider=token, base_url=f"{base_url}/v1", rate_limiter=RateLimiter(rate=0)
+    )
+    tracker = playback_state.PlaybackStateTracker(poll_seconds=args.poll)
+    playback_state.playback_tracker = scheduled_playback.playback_tracker = tracker
+    scheduled_playback.device_cache.clear()
+
+    users = [f"user{i}" for i in range(args.users)]
+    mock.now_playing = {f"Bearer token-{user_id}": f"spotify:playlist:{user_id}" for user_id in users}
+    mock.player_calls = 0
+    mock.plays.clear()
+    updates = 0
+    deadline = time.perf_counter() + args.duration
+
+    async def consume(user_id):
+        nonlocal updates
+        client = spotify_async.get_spotify_client(user_id)
+        if mode == "before":
+            while time.perf_counter() < deadline:
+                await client.playback_state()
+                updates += 1
+                await asyncio.sleep(args.poll)
+            return
+        subscription = tracker.subscribe(user_id)
+        try:
+            while True:
+                await asyncio.wait_for(subscription.__anext__(), deadline - time.perf_counter())
+                updates += 1
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await subscription.aclose()
+
+    async def fire_jobs(user_id):
+        uri = f"spotify:playlist:{user_id}"
+        for i in range(args.jobs):
+            await asyncio.sleep(max(0, deadline - args.duration * (1 - i / args.jobs) - time.perf_counter()))
+            if mode == "before":
+                await scheduled_playback.play_playlist(uri, device_id="mock-device", user_id=user_id)
+            else:
+                context = await scheduled_playback.prepare_playback(uri, user_id=user_id)
+                await scheduled_playback.play_playlist(uri, user_id=user_id, **context)
+
+    await asyncio.gather(*(consume(user_id) for user_id in users for _ in range(args.consumers)),
+                         *(fire_jobs(user_id) for user_id in users))
+    await tracker.close()
+    await spotify_async.close_spotify_client()
+    return mock.player_calls, len(mock.plays), updates
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--consumers", type=int, default=5)
+    parser.add_argument("--jobs", type=int, default=5)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--poll", type=float, default=1)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    _, base_url = start_mock_server(latency=args.latency)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SESSION_STORE_PATH"] = os.path.join(tmp, "sessions.db")
+        os.chdir(tmp)  # A token_info.json in the working directory would be imported
+        logging.getLogger().setLevel(logging.ERROR)
+
+        print(f"{args.users} users x {args.consumers} consumers, {args.jobs} jobs per user for an already "
+              f"playing playlist, {args.duration:.0f}s, poll every {args.poll}s")
+        for mode in ("before", "after"):
+            report(mode, *asyncio.run(run(mode, base_url, args)), args.duration)
+
+
+if __name__ == "__main__":
+    main()
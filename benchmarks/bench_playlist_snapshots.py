@@ -0,0 +1,104 @@
+"""
+Fetch time, refresh cost and memory of playlist track-list snapshots.
+
+Usage:
+    python benchmarks/bench_playlist_snapshots.py [--playlists 20] [--tracks 2000] [--latency 0.02]
+
+Each of `--playlists` playlists on the local mock Spotify server holds
+`--tracks` tracks (pages of 100). Reports:
+  - the time to load a playlist with its pages fetched one after the other
+    vs. PAGE_CONCURRENCY at a time,
+  - the Spotify requests of a refresh after the TTL when the playlists are
+    unchanged (snapshot_id check only) and when they all changed,
+  - the memory held per track by a snapshot vs. one dict per track.
+"""
+import argparse
+import asyncio
+import logging
+import time
+import tracemalloc
+
+import common  # noqa: F401  (puts the repository root on sys.path)
+
+import playlist_snapshots
+import spotify_async
+from mock_spotify import settings as mock, start_mock_server
+from rate_limiter import RateLimiter
+
+
+def requests_made():
+    return mock.playlist_calls + mock.track_page_calls
+
+
+async def load_all(playlist_ids, user_id="bench"):
+    before = requests_made()
+    start = time.perf_counter()
+    snapshots = await asyncio.gather(*(playlist_snapshots.get_playlist_snapshot(pid, user_id) for pid in playlist_ids))
+    return snapshots, time.perf_counter() - start, requests_made() - before
+
+
+async def run(base_url, args):
+    async def token(*_):
+        return "mock"
+
+    spotify_async._client = spotify_async.AsyncSpotifyClient(
+        token_provider=token, base_url=f"{base_url}/v1", rate_limiter=RateLimiter(rate=0)
+    )
+    playlist_ids = [f"bench{i}" for i in range(args.playlists)]
+    concurrency = playlist_snapshots.PAGE_CONCURRENCY
+
+    for label, pages_at_once in (("sequential", 1), ("parallel", concurrency)):
+        playlist_snapshots.PAGE_CONCURRENCY = pages_at_once
+        playlist_snapshots.playlist_snapshots.clear()
+        playlist_snapshots._known_snapshots.clear()
+        latencies = []
+        for pid in playlist_ids:  # One at a time, so only the pages of one playlist overlap
+            snapshots, seconds, requests = await load_all([pid])
+            latencies.append(seconds)
+        print(f"{label:>10} pages: {sum(latencies) / len(latencies) * 1000:5.0f}ms per playlist "
+              f"({requests} requests, {len(snapshots[0])} tracks)")
+
+    # The TTL ran out: revalidate by snapshot_id.
+    playlist_snapshots.playlist_snapshots.clear()
+    _, seconds, requests = await load_all(playlist_ids)
+    print(f"{'unchanged':>10} refresh: {seconds * 1000:5.0f}ms, {requests} requests")
+
+    mock.playlist_version += 1
+    playlist_snapshots.playlist_snapshots.clear()
+    snapshots, seconds, requests = await load_all(playlist_ids)
+    print(f"{'changed':>10} refresh: {seconds * 1000:5.0f}ms, {requests} requests")
+
+    await spotify_async.close_spotify_client()
+    return snapshots[0]
+
+
+def measure(build):
+    tracemalloc.start()
+    value = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return value, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--playlists", type=int, default=20)
+    parser.add_argument("--tracks", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    _, base_url = start_mock_server(latency=args.latency)
+    mock.playlist_tracks = args.tracks
+    snapshot = asyncio.run(run(base_url, args))
+
+    tracks = [{"uri": f"spotify:track:mock{i}", "name": f"Mock track {i}", "duration_ms": 180000 + i}
+              for i in range(args.tracks)]
+    _, dict_size = measure(lambda: [dict(track) for track in tracks])
+    _, snapshot_size = measure(lambda: playlist_snapshots.PlaylistSnapshot(snapshot.playlist_id, "s", "n", tracks))
+    print(f"memory per track: dicts {dict_size / args.tracks:.0f} B, snapshot {snapshot_size / args.tracks:.0f} B "
+          f"(strings shared in both)")
+
+
+if __name__ == "__main__":
+    main()
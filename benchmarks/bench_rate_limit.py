@@ -0,0 +1,116 @@
+"""
+Contention benchmark for the Spotify rate limiter against a mock that answers 429.
+
+Usage:
+    python benchmarks/bench_rate_limit.py [--background 600] [--playbacks 50] [--mock-limit 100]
+
+A burst of `--background` browse/search calls is started together with
+`--playbacks` playback starts (a minute's worth of scheduled jobs firing at
+once) against a mock Spotify that accepts `--mock-limit` requests per second
+and answers 429 with Retry-After beyond that.
+
+"before" replays the old behaviour: no shared budget, and every request
+sleeps out its own Retry-After/backoff independently. "after" uses the
+shared RateLimiter (global Retry-After pause, playback priority, jitter).
+"""
+import argparse
+import asyncio
+import time
+
+from common import percentile
+
+from mock_spotify import settings, start_mock_server
+from rate_limiter import RateLimiter
+from spotify_async import AsyncSpotifyClient
+
+
+class PerRequestBackoff:
+    """Limiter stand-in reproducing the old per-request retry sleeps."""
+
+    def __init__(self):
+        self._pending = {}
+
+    def pause(self, seconds):
+        self._pending[asyncio.current_task()] = seconds
+
+    async def acquire(self, priority=None):
+        seconds = self._pending.pop(asyncio.current_task(), 0)
+        if seconds:
+            await asyncio.sleep(seconds)
+
+
+async def run(base_url, limiter, background, playbacks, retry_count):
+    async def token():
+        return "mock"
+
+    client = AsyncSpotifyClient(token_provider=token, base_url=f"{base_url}/v1", retry_count=retry_count,
+                                delay=0.2, rate_limiter=limiter)
+
+    async def call(coro_func):
+        started = time.perf_counter()
+        try:
+            await coro_func()
+            return time.perf_counter() - started
+        except Exception:
+            return None
+
+    background_calls = [
+        call(lambda i=i: client.category_playlists("focus") if i % 2 else client.search(f"show {i}"))
+        for i in range(background)
+    ]
+    playback_calls = [call(lambda: client.start_playback(context_uri="spotify:playlist:mock")) for _ in range(playbacks)]
+
+    throttled_before = settings.throttled
+    start = time.perf_counter()
+    results = await asyncio.gather(*background_calls, *playback_calls)
+    elapsed = time.perf_counter() - start
+    await client.close()
+
+    background_results, playback_results = results[:background], results[background:]
+    ok = [r for r in results if r is not None]
+    playback_ok = [r for r in playback_results if r is not None]
+    return {
+        "elapsed": elapsed,
+        "ok": len(ok),
+        "failed": len(results) - len(ok),
+        "throttled": settings.throttled - throttled_before,
+        "playback_ok": len(playback_ok),
+        "playback_p50": percentile(playback_ok, 50),
+        "playback_p99": percentile(playback_ok, 99),
+        "background_ok": sum(1 for r in background_results if r is not None),
+    }
+
+
+def report(label, stats):
+    print(
+        f"{label:>6}: {stats['ok'] / stats['elapsed']:,.0f} ok req/s, {stats['failed']} failed, "
+        f"{stats['throttled']} 429s | playback {stats['playback_ok']} ok, "
+        f"time-to-playback p50 {stats['playback_p50'] * 1000:.0f}ms p99 {stats['playback_p99'] * 1000:.0f}ms "
+        f"| total {stats['elapsed']:.2f}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--background", type=int, default=600)
+    parser.add_argument("--playbacks", type=int, default=50)
+    parser.add_argument("--mock-limit", type=int, default=100, help="requests/s the mock accepts")
+    parser.add_argument("--client-rate", type=float, default=90, help="RateLimiter tokens/s")
+    parser.add_argument("--client-burst", type=int, default=10, help="RateLimiter bucket size")
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    _, base_url = start_mock_server(latency=args.latency)
+    settings.rate_limit = args.mock_limit
+    print(f"{args.background} browse/search + {args.playbacks} playback starts at once, "
+          f"mock accepts {args.mock_limit} req/s, {args.retries} attempts per request")
+
+    report("before", asyncio.run(run(base_url, PerRequestBackoff(), args.background, args.playbacks, args.retries)))
+    time.sleep(1.5)  # let the mock's rate window reset
+    limiter = RateLimiter(rate=args.client_rate, burst=args.client_burst)
+    report("after", asyncio.run(run(base_url, limiter, args.background, args.playbacks, args.retries)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Request latency of /ai-playlist-style mood lookups, computed on the request
+path vs. served from the precomputed recommendation table.
+
+Usage:
+    python benchmarks/bench_recommendations.py [--requests 2000] [--duration 20] [--ttl 5]
+                                               [--gemini-latency 1.5] [--latency 0.02]
+
+Requests for the time-of-day moods plus a few extra moods arrive at a steady
+rate for `--duration` seconds. Gemini is replaced by a fake model that
+answers after `--gemini-latency` seconds; Spotify is the local mock server.
+The AI cache TTL is compressed to `--ttl` seconds so entries expire during the
+run, like they do every AI_CACHE_TTL in production.
+
+"before" replays the previous route: AI recommendation, then verification or
+the Spotify fallback, on the request path. "after" precomputes the table at
+start-up and every `--ttl / 2` seconds and serves requests from it.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+
+from common import percentile
+
+import ai
+import recommendations
+import scheduled_playback
+import spotify_async
+from fake_gemini import FakeModel
+from mock_spotify import start_mock_server
+from rate_limiter import RateLimiter
+
+EXTRA_MOODS = ["happy", "workout", "rainy day", "party"]
+
+
+def report(label, latencies, model):
+    latencies = [s * 1000 for s in latencies]
+    print(
+        f"{label:>6}: p50 {percentile(latencies, 50):.2f}ms p90 {percentile(latencies, 90):.2f}ms "
+        f"p99 {percentile(latencies, 99):.2f}ms max {max(latencies):.2f}ms | {model.calls} Gemini calls"
+    )
+
+
+def reset():
+    for cache in (ai.recommendation_cache, ai.valid_playlists, ai.invalid_playlists,
+                  scheduled_playback.category_cache, recommendations.recommendation_table):
+        cache.clear()
+
+
+async def run_traffic(handler, moods, count, duration):
+    latencies = []
+
+    async def one(mood, at):
+        await asyncio.sleep(max(0, at - time.perf_counter()))
+        start = time.perf_counter()
+        await handler(mood)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(random.choice(moods), start + i * duration / count) for i in range(count)))
+    return latencies
+
+
+async def run(mode, base_url, args, moods):
+    async def token(*_):
+        return "mock"
+
+    spotify_async._client = spotify_async.AsyncSpotifyClient(
+        token_provider=token, base_url=f"{base_url}/v1", rate_limiter=RateLimiter(rate=0)
+    )
+    ai._model = model = FakeModel(args.gemini_latency)
+    reset()
+
+    refresher = None
+    if mode == "before":
+        handler = recommendations._compute_mood
+    else:
+        handler = recommendations.mood_recommendation
+        await recommendations.precompute_recommendations()  # run_now at start-up
+
+        async def refresh():
+            while True:
+                await asyncio.sleep(args.ttl / 2)
+                await recommendations.precompute_recommendations()
+        refresher = asyncio.ensure_future(refresh())
+
+    try:
+        latencies = await run_traffic(handler, moods, args.requests, args.duration)
+    finally:
+        if refresher is not None:
+            refresher.cancel()
+        await spotify_async.close_spotify_client()
+    return latencies, model
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--ttl", type=float, default=5)
+    parser.add_argument("--gemini-latency", type=float, default=1.5)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    _, base_url = start_mock_server(latency=args.latency)
+    with tempfile.TemporaryDirectory() as tmp:
+        ai.recommendation_cache.ttl = args.ttl
+        recommendations.RECOMMENDATION_MOODS[:] = EXTRA_MOODS
+        recommendations.recommendation_table.ttl = args.ttl * 3
+        recommendations.recommendation_table.path = os.path.join(tmp, "recommendations.json")
+        moods = recommendations.precomputed_moods()
+
+        print(f"{args.requests} requests over {args.duration:.0f}s for {len(moods)} moods, "
+              f"Gemini {args.gemini_latency * 1000:.0f}ms, AI cache TTL {args.ttl:.0f}s")
+        for mode in ("before", "after"):
+            report(mode, *asyncio.run(run(mode, base_url, args, moods)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+"""
+End-to-end load scenarios against the FastAPI app in main.py, fully offline.
+
+Usage:
+    python benchmarks/bench_scenarios.py [--scenarios mood-spike,schedule-burst,token-expiry]
+                                         [--latency 0.02] [--error-rate 0.01]
+                                         [--gemini-latency 0.5] [--gemini-error-rate 0]
+                                         [--output results.json] [--compare previous.json]
+
+Spotify is the local mock server, answering after `--latency` seconds and
+with a 503 for `--error-rate` of the requests; Gemini is the in-process fake
+model. The app runs with its lifespan (scheduler poller, dispatcher,
+precompute job) on throwaway databases in a temporary directory and is
+called in-process through httpx's ASGI transport. `--users` Spotify users are
+logged in up front and requests carry their session keys.
+
+Scenarios:
+  - mood-spike: the time-of-day window changes and `--requests` /mood-playlist
+    calls for the new mood arrive within `--spike-seconds`,
+  - mood-spike-cold: the same, with the new mood's precomputed entry and the
+    AI caches dropped first (e.g. the table expired while Gemini was down),
+  - schedule-burst: `--jobs` schedules posted through /schedule-batch, all due
+    at the same second (overlaps allowed, as a user gets several of them);
+    the scheduler claims, prepares and fires them,
+  - token-expiry: steady /search-podcast traffic for `--duration` seconds;
+    halfway through, every user's access token expires.
+
+The results are written to stdout (and `--output`) as JSON: per scenario the
+request count, errors, throughput, latency percentiles, fire skew for
+schedule-burst and upstream call counts. With `--compare`, headline numbers
+are compared to an earlier result file and the run exits non-zero if one
+regressed by more than `--tolerance`.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from common import summarize
+
+import httpx
+
+from fake_gemini import FakeModel
+from mock_spotify import settings as mock, start_mock_server
+
+SCENARIOS = ("mood-spike", "mood-spike-cold", "schedule-burst", "token-expiry")
+
+# (metric, higher is better) compared by --compare.
+HEADLINE_METRICS = (
+    ("throughput_rps", True),
+    ("latency_ms.p99", False),
+    ("fire_skew_ms.p99", False),
+)
+
+
+def upstream_calls():
+    return {"gemini": ai_model().calls, "spotify_token": mock.token_calls, "spotify_browse": mock.browse_calls,
+            "spotify_search": mock.search_calls, "spotify_playlist": mock.playlist_calls,
+            "spotify_errors": mock.errors}
+
+
+def calls_since(before):
+    return {name: count - before[name] for name, count in upstream_calls().items()}
+
+
+def ai_model():
+    import ai
+    return ai._model
+
+
+async def run_traffic(client, requests, duration):
+    """
+    Sends `requests` ((method, url, kwargs) tuples) spread evenly over
+    `duration` seconds, each on its own task. A response >= 400 or an
+    exception counts as an error.
+    """
+    latencies = []
+    errors = 0
+
+    async def one(method, url, kwargs, at):
+        nonlocal errors
+        await asyncio.sleep(max(0, at - time.perf_counter()))
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            failed = response.status_code >= 400
+        except Exception:
+            failed = True
+        latencies.append(time.perf_counter() - start)
+        errors += failed
+
+    start = time.perf_counter()
+    step = duration / len(requests)
+    await asyncio.gather(*(one(method, url, kwargs, start + i * step)
+                           for i, (method, url, kwargs) in enumerate(requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": len(requests),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(requests) / elapsed, 1),
+        "latency_ms": summarize(latencies),
+    }
+
+
+def seed_users(count):
+    """Stores a valid session for `count` users (and the default user); returns their session keys."""
+    from token_manager import DEFAULT_USER, token_manager
+    users = [f"bench-user-{i}" for i in range(count)]
+    expires_at = time.time() + 3600
+    token_manager.store().put_many(
+        (user_id, {"access_token": f"access-{user_id}", "refresh_token": f"refresh-{user_id}",
+                   "expires_at": expires_at})
+        for user_id in users + [DEFAULT_USER]
+    )
+    return {user_id: token_manager.create_session(user_id) for user_id in users}
+
+
+async def wait_for_precompute(timeout=60):
+    """Waits until the start-up precompute run has filled every time-of-day mood."""
+    import recommendations
+    keys = [f"mood:{mood}" for mood in recommendations.precomputed_moods()]
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if all(recommendations.recommendation_table.get(key) is not None for key in keys):
+            return
+        await asyncio.sleep(0.05)
+    logging.critical("Start-up precompute did not finish; mood scenarios start cold.")
+
+
+async def mood_spike(client, args, sessions, cold=False):
+    import ai
+    import main
+    import recommendations
+    import scheduled_playback
+
+    new_mood = scheduled_playback.MOOD_WINDOWS[1][1]
+    get_time_based_mood = main.get_time_based_mood
+    if cold:
+        recommendations.recommendation_table.delete(f"mood:{ai.normalize_key(new_mood)}")
+        for cache in (ai.recommendation_cache, ai.valid_playlists, scheduled_playback.category_cache):
+            cache.clear()
+
+    keys = list(sessions.values())
+    requests = [("GET", "/mood-playlist", {"headers": {"X-Session-Key": keys[i % len(keys)]}})
+                for i in range(args.requests)]
+    before = upstream_calls()
+    main.get_time_based_mood = lambda user_id=None: new_mood
+    try:
+        result = await run_traffic(client, requests, args.spike_seconds)
+    finally:
+        main.get_time_based_mood = get_time_based_mood
+    result["upstream_calls"] = calls_since(before)
+    return result
+
+
+async def mood_spike_cold(client, args, sessions):
+    return await mood_spike(client, args, sessions, cold=True)
+
+
+async def schedule_burst(client, args, sessions):
+    import scheduler
+
+    keys = list(sessions.values())
+    requests = []
+    for batch, first in enumerate(range(0, args.jobs, args.batch_size)):
+        items = [{"playlist_uri": f"spotify:playlist:burst{i}", "play_time": "07:00"}
+                 for i in range(first, min(first + args.batch_size, args.jobs))]
+        requests.append(("POST", "/schedule-batch", {"params": {"allow_overlap": "true"}, "json": items,
+                                                     "headers": {"X-Session-Key": keys[batch % len(keys)]}}))
+    before = upstream_calls()
+    result = await run_traffic(client, requests, 0)
+    result["schedules_per_second"] = round(args.jobs / result["seconds"], 1)
+
+    # Everyone picked the same minute; move it a few seconds ahead instead of waiting for 07:00.
+    store = scheduler.get_job_store()
+    job_ids = await asyncio.to_thread(lambda: [job["id"] for user_id in sessions
+                                               for job in store.jobs_for_user(user_id, limit=args.jobs)])
+    run_at = time.time() + scheduler.PREFIRE_SECONDS + scheduler.POLL_INTERVAL_SECONDS + 3
+    await asyncio.to_thread(store.finish_many, [(job_id, "pending", run_at) for job_id in job_ids])
+
+    mock.plays.clear()
+    deadline = run_at + scheduler.FIRE_DEADLINE_SECONDS
+    while len(mock.plays) < len(job_ids) and time.time() < deadline:
+        await asyncio.sleep(0.1)
+    skews = [played_at - run_at for played_at, uri in mock.plays if uri and uri.startswith("spotify:playlist:burst")]
+
+    result["jobs"] = len(job_ids)
+    result["fired"] = len(skews)
+    result["fire_skew_ms"] = summarize(skews)
+    result["upstream_calls"] = calls_since(before)
+    return result
+
+
+async def token_expiry(client, args, sessions):
+    from token_manager import token_manager
+
+    users = list(sessions)
+    requests = [("GET", "/search-podcast", {"params": {"query": f"expiry {i}"},
+                                            "headers": {"X-Session-Key": sessions[users[i % len(users)]]}})
+                for i in range(args.requests)]
+
+    def expire_all():
+        now = time.time()
+        for user_id in users:
+            token_manager.set_token_info({"access_token": f"expired-{user_id}", "refresh_token": f"refresh-{user_id}",
+                                          "expires_at": now - 1}, user_id)
+
+    async def expire_midway():
+        await asyncio.sleep(args.duration / 2)
+        await asyncio.to_thread(expire_all)
+
+    before = upstream_calls()
+    expiry = asyncio.ensure_future(expire_midway())
+    result = await run_traffic(client, requests, args.duration)
+    await expiry
+    result["users"] = len(users)
+    result["token_refreshes"] = mock.token_calls - before["spotify_token"]
+    result["upstream_calls"] = calls_since(before)
+    return result
+
+
+SCENARIO_FUNCS = {
+    "mood-spike": mood_spike,
+    "mood-spike-cold": mood_spike_cold,
+    "schedule-burst": schedule_burst,
+    "token-expiry": token_expiry,
+}
+
+
+async def run(args, scenarios):
+    import ai
+    import main
+
+    ai._model = FakeModel(args.gemini_latency, jitter=args.gemini_latency / 2, error_rate=args.gemini_error_rate)
+    sessions = seed_users(args.users)
+    results = {}
+    async with main.lifespan(main.app):
+        await wait_for_precompute()
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for name in scenarios:
+                results[name] = await SCENARIO_FUNCS[name](client, args, sessions)
+                report(name, results[name])
+    return results
+
+
+def report(name, result):
+    latency = result["latency_ms"]
+    line = (f"{name:>16}: {result['requests']} requests, {result['errors']} errors, "
+            f"{result['throughput_rps']} req/s | p50 {latency['p50']}ms p99 {latency['p99']}ms")
+    if "fire_skew_ms" in result and result["fire_skew_ms"]:
+        skew = result["fire_skew_ms"]
+        line += f" | {result['fired']}/{result['jobs']} fired, skew p50 {skew['p50']}ms p99 {skew['p99']}ms"
+    if "token_refreshes" in result:
+        line += f" | {result['token_refreshes']} refreshes for {result['users']} users"
+    print(line, file=sys.stderr)
+
+
+def _lookup(result, metric):
+    for part in metric.split("."):
+        result = (result or {}).get(part)
+    return result
+
+
+def compare(results, previous, tolerance):
+    """
+    Prints the change of each headline metric against an earlier run.
+
+    Returns:
+        - List of "<scenario> <metric>" that got worse by more than `tolerance`.
+    """
+    regressions = []
+    for name, result in results.items():
+        old = previous.get("scenarios", {}).get(name)
+        if not old:
+            continue
+        for metric, higher_is_better in HEADLINE_METRICS:
+            new_value, old_value = _lookup(result, metric), _lookup(old, metric)
+            if not new_value or not old_value:
+                continue
+            change = (new_value - old_value) / old_value
+            worse = -change if higher_is_better else change
+            flag = "REGRESSION" if worse > tolerance else ""
+            if flag:
+                regressions.append(f"{name} {metric}")
+            print(f"{name:>16} {metric:<17} {old_value:>10} -> {new_value:>10} ({change:+.0%}) {flag}",
+                  file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--spike-seconds", type=float, default=1)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--jobs", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--gemini-latency", type=float, default=0.5)
+    parser.add_argument("--gemini-error-rate", type=float, default=0)
+    parser.add_argument("--spotify-rate", type=float, default=0, help="SPOTIFY_RATE_LIMIT of the app (0 = unlimited)")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    parser.add_argument("--compare", help="earlier JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIO_FUNCS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))} (choose from {', '.join(SCENARIOS)})")
+    output = os.path.abspath(args.output) if args.output else None
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    _, base_url = start_mock_server(latency=args.latency)
+    mock.error_rate = args.error_rate
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Configuration is read at import time, so the app is imported only now.
+        os.environ.update({
+            "SPOTIFY_API_BASE": f"{base_url}/v1",
+            "SPOTIFY_TOKEN_URL": f"{base_url}/api/token",
+            "SPOTIFY_RATE_LIMIT": str(args.spotify_rate),
+            "JOB_STORE_PATH": os.path.join(tmp, "scheduled_jobs.db"),
+            "SESSION_STORE_PATH": os.path.join(tmp, "sessions.db"),
+            "RECOMMENDATION_SNAPSHOT_PATH": os.path.join(tmp, "recommendations.json"),
+        })
+        os.chdir(tmp)  # A token_info.json in the working directory would be imported
+        importlib.import_module("main")  # Configures logging, which is then quieted
+        logging.getLogger().setLevel(logging.CRITICAL)
+
+        started_at = datetime.now().astimezone().isoformat(timespec="seconds")
+        results = asyncio.run(run(args, scenarios))
+
+    document = {
+        "started_at": started_at,
+        "config": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+        "scenarios": results,
+    }
+    text = json.dumps(document, indent=2)
+    print(text)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+
+    if previous is not None:
+        regressions = compare(results, previous, args.tolerance)
+        if regressions:
+            print(f"Regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
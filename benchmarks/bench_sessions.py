@@ -0,0 +1,129 @@
+"""
+Memory and lookup latency of the multi-user session layer.
+
+Usage:
+    python benchmarks/bench_sessions.py [--sessions 10000] [--lookups 50000] [--cache-size 1000]
+
+Stores `--sessions` Spotify sessions in a temporary SQLite session store and
+reports:
+  - memory held per session once all of them are cached, and per pooled
+    per-user Spotify client,
+  - token lookup latency when the session is in memory (hot) and when the
+    in-memory LRU is capped at `--cache-size` so most lookups hit SQLite (cold),
+  - the memory held at that cap.
+"""
+import argparse
+import asyncio
+import gc
+import os
+import sqlite3
+import random
+import secrets
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import common  # noqa: F401  (puts the repository root on sys.path)
+
+import spotify_async
+from token_manager import TokenManager
+
+
+def make_token():
+    # Spotify access tokens are ~200 characters, refresh tokens ~130.
+    return {
+        "access_token": secrets.token_urlsafe(150),
+        "refresh_token": secrets.token_urlsafe(98),
+        "expires_at": time.time() + 3600,
+        "scope": "user-modify-playback-state user-read-playback-state user-read-currently-playing",
+        "token_type": "Bearer",
+    }
+
+
+def load_all(manager, users):
+    for user_id in users:
+        manager.get_token_info(user_id)
+
+
+def pool_clients(users):
+    for user_id in users:
+        spotify_async.get_spotify_client(user_id)
+
+
+def measure(func):
+    """Returns the bytes still allocated after running func()."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+async def lookup_latencies(manager, users, count):
+    latencies = []
+    for _ in range(count):
+        user_id = random.choice(users)
+        start = time.perf_counter_ns()
+        await manager.get_valid_token_info(user_id)
+        latencies.append(time.perf_counter_ns() - start)
+    latencies.sort()
+    return latencies
+
+
+def describe(latencies):
+    p99 = latencies[int(len(latencies) * 0.99)]
+    return f"p50 {statistics.median(latencies) / 1000:.1f}µs p99 {p99 / 1000:.1f}µs"
+
+
+def disk_size(path):
+    """Size of a WAL-mode database once its write-ahead log is checkpointed into it."""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    wal = path + "-wal"
+    return os.path.getsize(path) + (os.path.getsize(wal) if os.path.exists(wal) else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=10_000)
+    parser.add_argument("--lookups", type=int, default=50_000)
+    parser.add_argument("--cache-size", type=int, default=1_000)
+    args = parser.parse_args()
+
+    users = [f"spotify-user-{i}" for i in range(args.sessions)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sessions.db")
+        manager = TokenManager(path=path, cache_size=args.sessions)
+
+        start = time.perf_counter()
+        manager.store().put_many((user_id, make_token()) for user_id in users)
+        elapsed = time.perf_counter() - start
+        print(f"stored {args.sessions:,} sessions in {elapsed * 1000:.0f}ms, "
+              f"{disk_size(path) / args.sessions:,.0f} bytes/session on disk")
+
+        used, _ = measure(lambda: load_all(manager, users))
+        print(f"all sessions cached: {used / 1024 / 1024:.1f} MiB, {used / args.sessions:,.0f} bytes/session")
+
+        spotify_async._client = spotify_async.AsyncSpotifyClient(token_provider=manager.get_valid_token_info)
+        used, _ = measure(lambda: pool_clients(users))
+        print(f"pooled per-user clients: {used / 1024 / 1024:.1f} MiB, {used / args.sessions:,.0f} bytes/client")
+
+        hot = asyncio.run(lookup_latencies(manager, users, args.lookups))
+        print(f"hot lookup (in memory): {describe(hot)}")
+
+        capped = TokenManager(path=path, cache_size=args.cache_size)
+        used, _ = measure(lambda: load_all(capped, users))
+        cold = asyncio.run(lookup_latencies(capped, users, args.lookups))
+        print(f"cold lookup (LRU of {args.cache_size:,}, {capped.sessions.stats()['misses']:,} misses): "
+              f"{describe(cold)}, {used / 1024 / 1024:.1f} MiB held")
+        manager.close()
+        capped.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Load test of blocking vs. async Spotify calls against the local mock server.
+
+Usage:
+    python benchmarks/bench_spotify_client.py [--requests 4000] [--concurrency 200]
+
+"before" replays the old pattern: blocking `requests` calls, one new
+connection per call, on a 40-thread pool (Starlette's default for sync
+routes). "after" uses AsyncSpotifyClient with its pooled keep-alive
+connections on a single event loop.
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from common import percentile
+
+from mock_spotify import start_mock_server
+from rate_limiter import RateLimiter
+from spotify_async import AsyncSpotifyClient
+
+THREADPOOL_SIZE = 40
+
+
+def report(label, latencies, elapsed):
+    print(
+        f"{label:>6}: {len(latencies) / elapsed:,.0f} req/s  "
+        f"p50 {percentile(latencies, 50) * 1000:.1f}ms  p99 {percentile(latencies, 99) * 1000:.1f}ms"
+    )
+
+
+def run_blocking(base_url, total, concurrency):
+    url = f"{base_url}/v1/browse/categories/focus/playlists"
+
+    def call(submitted_at):
+        requests.get(url, headers={"Authorization": "Bearer mock"}, params={"limit": 5})
+        return time.perf_counter() - submitted_at
+
+    start = time.perf_counter()
+    latencies = []
+    with ThreadPoolExecutor(max_workers=THREADPOOL_SIZE) as pool:
+        for offset in range(0, total, concurrency):
+            batch = [pool.submit(call, time.perf_counter()) for _ in range(min(concurrency, total - offset))]
+            latencies.extend(f.result() for f in batch)
+    return latencies, time.perf_counter() - start
+
+
+async def run_async(base_url, total, concurrency):
+    async def token():
+        return "mock"
+
+    # rate=0: measure the transport, not the request budget.
+    client = AsyncSpotifyClient(token_provider=token, base_url=f"{base_url}/v1", rate_limiter=RateLimiter(rate=0))
+
+    async def call():
+        started = time.perf_counter()
+        await client.category_playlists("focus")
+        return time.perf_counter() - started
+
+    start = time.perf_counter()
+    latencies = []
+    for offset in range(0, total, concurrency):
+        latencies.extend(await asyncio.gather(*(call() for _ in range(min(concurrency, total - offset)))))
+    elapsed = time.perf_counter() - start
+    await client.close()
+    return latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    _, base_url = start_mock_server(latency=args.latency)
+    print(f"{args.requests} browse requests, {args.concurrency} concurrent, {args.latency * 1000:.0f}ms upstream latency")
+    report("before", *run_blocking(base_url, args.requests, args.concurrency))
+    report("after", *asyncio.run(run_async(base_url, args.requests, args.concurrency)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Import-time benchmark for the app's cold start.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 5] [--budget-ms 750] [--top 15]
+
+Imports `main` in fresh interpreters with `python -X importtime`, prints the
+slowest top-level imports (cumulative time) and the median total, and checks
+that the heavy SDKs (Gemini, spotipy) were not loaded. Exits non-zero when
+the median import of `main` exceeds `--budget-ms` or a lazy SDK was imported.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+from common import ROOT
+
+# Loaded on the first request that needs them, never at startup.
+LAZY_MODULES = ("google.generativeai", "spotipy")
+
+PROBE = (
+    "import sys, main; "
+    f"print('LOADED', *[m for m in {LAZY_MODULES!r} if m in sys.modules])"
+)
+
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_once():
+    """Returns ({top-level module: cumulative µs}, main's cumulative µs, eagerly loaded lazy modules)."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE],
+        cwd=ROOT, capture_output=True, text=True,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    if result.returncode != 0:
+        sys.exit(f"import main failed:\n{result.stderr[-2000:]}")
+
+    children = {}
+    pending = {}
+    main_us = None
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, name = match.groups()
+        if len(indent) == 3:
+            # Nested imports are reported before the top-level module that triggered them.
+            pending[name] = int(cumulative)
+        elif len(indent) == 1:
+            if name == "main":
+                main_us = int(cumulative)
+                children = pending
+            pending = {}
+    loaded = next(line.split()[1:] for line in result.stdout.splitlines() if line.startswith("LOADED"))
+    return children, main_us, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=750)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    totals = []
+    per_module = {}
+    loaded = set()
+    for _ in range(args.runs):
+        children, main_us, eager = import_once()
+        totals.append(main_us / 1000)
+        loaded.update(eager)
+        for name, us in children.items():
+            per_module.setdefault(name, []).append(us / 1000)
+
+    print(f"slowest imports of main (median of {args.runs} runs, cumulative):")
+    ranked = sorted(per_module.items(), key=lambda item: statistics.median(item[1]), reverse=True)
+    for name, times in ranked[:args.top]:
+        print(f"  {statistics.median(times):8.1f}ms  {name}")
+
+    median = statistics.median(totals)
+    print(f"import main: median {median:.0f}ms, min {min(totals):.0f}ms, max {max(totals):.0f}ms "
+          f"(budget {args.budget_ms:.0f}ms)")
+
+    failed = False
+    if loaded:
+        print(f"FAIL: loaded at import time: {', '.join(sorted(loaded))}")
+        failed = True
+    if median > args.budget_ms:
+        print("FAIL: over the startup budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
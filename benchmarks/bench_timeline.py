@@ -0,0 +1,107 @@
+"""
+Range queries, conflict checks and cancellation on a timeline of 1M
+scheduled playbacks.
+
+Usage:
+    python benchmarks/bench_timeline.py [--jobs 1000000] [--users 10000] [--queries 2000]
+
+Stores `--jobs` pending playbacks for `--users` users over the next 30 days
+(slots of 1-60 minutes), then measures:
+  - "what plays between T1 and T2" for a random user and a 2 hour window,
+    from the (user_id, run_at) index vs. scanning every job (what finding
+    jobs in APScheduler's job list amounts to),
+  - conflict-checked single inserts (schedule_playlist),
+  - the conflict check of a 1,000 item batch,
+  - cancellation by id.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from common import percentile
+
+DAY = 86400
+WINDOW = 2 * 3600
+
+
+def report(label, seconds, extra=""):
+    values = [s * 1000 for s in seconds]
+    print(f"{label:>22}: p50 {percentile(values, 50):8.3f}ms p99 {percentile(values, 99):8.3f}ms {extra}")
+
+
+def timed_calls(func, args_list):
+    latencies = []
+    results = []
+    for args in args_list:
+        start = time.perf_counter()
+        results.append(func(*args))
+        latencies.append(time.perf_counter() - start)
+    return latencies, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["JOB_STORE_PATH"] = os.path.join(tmp, "jobs.db")
+        import scheduler
+
+        store = scheduler.get_job_store()
+        now = time.time()
+        users = [f"user{i}" for i in range(args.users)]
+        jobs = []
+        for i in range(args.jobs):
+            run_at = now + 3600 + random.random() * 30 * DAY
+            jobs.append((f"spotify:playlist:p{i}", run_at, users[i % args.users], None,
+                         run_at + random.randint(1, 60) * 60))
+        start = time.perf_counter()
+        for first in range(0, len(jobs), 50_000):
+            store.add_many(jobs[first:first + 50_000])
+        elapsed = time.perf_counter() - start
+        print(f"{args.jobs:,} playbacks for {args.users:,} users stored in {elapsed:.1f}s "
+              f"({args.jobs / elapsed:,.0f}/s)")
+
+        windows = [(random.choice(users), now + random.random() * 30 * DAY) for _ in range(args.queries)]
+        latencies, found = timed_calls(lambda user_id, t1: store.jobs_between(user_id, t1, t1 + WINDOW),
+                                       windows)
+        report("range query (index)", latencies, f"| {sum(map(len, found)) / len(found):.2f} jobs per window")
+
+        def scan(user_id, t1):
+            return [job for job in jobs if job[2] == user_id and job[1] < t1 + WINDOW and job[4] > t1]
+        latencies, _ = timed_calls(scan, windows[:max(1, args.queries // 100)])
+        report("range query (scan)", latencies)
+
+        inserts = [(None, f"spotify:playlist:new{i}", f"{random.randrange(24):02d}:{random.randrange(60):02d}",
+                    random.choice(users)) for i in range(args.queries)]
+        conflicts = 0
+
+        def insert(*call):
+            nonlocal conflicts
+            try:
+                return scheduler.schedule_playlist(*call)
+            except scheduler.ScheduleConflict:
+                conflicts += 1
+        latencies, inserted = timed_calls(insert, inserts)
+        report("checked insert", latencies, f"| {conflicts} conflicts")
+
+        batch = [{"playlist_uri": f"spotify:playlist:batch{i}",
+                  "play_time": f"{random.randrange(24):02d}:{random.randrange(60):02d}"} for i in range(1000)]
+        latencies, results = timed_calls(scheduler.schedule_playlists_batch,
+                                         [(batch, users[i], False) for i in range(20)])
+        batch_conflicts = sum(result["status"] == "conflict" for batch_results in results for result in batch_results)
+        report("1k item batch", latencies, f"| {batch_conflicts / len(results):.0f} conflicts per batch")
+
+        job_ids = [(result["job_id"],) for result in inserted if result]
+        latencies, cancelled = timed_calls(store.cancel, job_ids)
+        report("cancel by id", latencies, f"| {sum(cancelled)} cancelled")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Single-flight check for the token manager.
+
+Usage:
+    python benchmarks/bench_token_refresh.py [--callers 1000]
+
+Starts `--callers` concurrent requests for an expired token against the local
+mock Spotify token endpoint and reports how many refresh POSTs were sent
+(exactly one is expected) and how long callers waited. Exits non-zero if more
+than one refresh was made.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import common  # noqa: F401  (puts the repository root on sys.path)
+
+from mock_spotify import settings, start_mock_server
+from spotify_async import AsyncSpotifyClient
+from token_manager import TokenManager
+
+
+async def run(base_url, callers, path):
+    client = AsyncSpotifyClient(token_url=f"{base_url}/api/token")
+
+    async def refresh(refresh_token):
+        return await client.refresh_access_token(refresh_token, "client-id", "client-secret")
+
+    manager = TokenManager(path=path, refresh_func=refresh)
+    manager.set_token_info({"access_token": "expired", "refresh_token": "r", "expires_at": time.time() - 1})
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(manager.get_valid_token_info() for _ in range(callers)))
+    elapsed = time.perf_counter() - start
+    await client.close()
+
+    tokens = {info["access_token"] for info in results}
+    reloaded = TokenManager(path=path).get_token_info()
+    return elapsed, tokens, reloaded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--callers", type=int, default=1000)
+    args = parser.parse_args()
+
+    _, base_url = start_mock_server(latency=0.05)
+    with tempfile.TemporaryDirectory() as tmp:
+        elapsed, tokens, reloaded = asyncio.run(run(base_url, args.callers, os.path.join(tmp, "sessions.db")))
+
+    print(f"{args.callers} concurrent callers served in {elapsed * 1000:.1f}ms")
+    print(f"refresh calls: {settings.token_calls}, distinct tokens returned: {len(tokens)}")
+    print(f"persisted token: {reloaded['access_token']}")
+    if settings.token_calls != 1 or len(tokens) != 1:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
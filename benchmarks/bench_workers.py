@@ -0,0 +1,192 @@
+"""
+HTTP throughput of the app with 1 vs. N uvicorn worker processes, and the
+shared-state guarantees of multi-worker mode.
+
+Usage:
+    python benchmarks/bench_workers.py [--workers 4] [--clients 4] [--concurrency 32]
+                                       [--duration 10] [--jobs 300]
+
+For each worker count, starts `uvicorn main:app --workers <n>` against the
+local mock Spotify server, with all workers sharing one job store, session
+store and audit log. `--clients` load-generator processes then request
+/playlist-tracks (served from the snapshot cache) and /schedules/next (a
+job store read) for `--duration` seconds. Reports:
+  - requests/s and latency percentiles,
+  - Spotify token refreshes sent for a token that every worker finds about
+    to expire (1 expected: one worker refreshes, the others share it),
+  - how many of `--jobs` jobs scheduled for the same second were played, and
+    how often (each exactly once expected, by the single leader),
+  - the holder of the scheduler leader lease.
+Exits non-zero if a job was not played or was played twice.
+
+Throughput only scales with the number of cores; on a single core extra
+workers add context switches and no capacity.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from common import ROOT, percentile
+
+from mock_spotify import settings as mock, start_mock_server
+
+PATHS = ["/playlist-tracks?playlist_uri=spotify:playlist:bench", "/schedules/next"]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _load(base_url, duration, concurrency, results):
+    """Load-generator process: `concurrency` connections looping over PATHS until the deadline."""
+    import aiohttp
+
+    async def run():
+        latencies = []
+        errors = 0
+        deadline = time.perf_counter() + duration
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+            async def loop(offset):
+                nonlocal errors
+                i = offset
+                while time.perf_counter() < deadline:
+                    start = time.perf_counter()
+                    async with session.get(base_url + PATHS[i % len(PATHS)]) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                    latencies.append(time.perf_counter() - start)
+                    i += 1
+            await asyncio.gather(*(loop(i) for i in range(concurrency)))
+        return latencies, errors
+
+    results.put(asyncio.run(run()))
+
+
+def _wait_ready(base_url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(base_url + "/metrics", timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Server did not start.")
+
+
+def run(workers, mock_url, args):
+    import job_store
+    import session_store
+
+    mock.token_calls = 0
+    mock.plays.clear()
+    # What the previous run left playing would make skip_if_playing skip a job here.
+    mock.now_playing.clear()
+    mock.device_plays.clear()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            **os.environ,
+            "PYTHONPATH": ROOT,
+            "SPOTIFY_API_BASE": f"{mock_url}/v1",
+            "SPOTIFY_TOKEN_URL": f"{mock_url}/api/token",
+            "SPOTIFY_RATE_LIMIT": "0",
+            "JOB_STORE_PATH": os.path.join(tmp, "jobs.db"),
+            "SESSION_STORE_PATH": os.path.join(tmp, "sessions.db"),
+            "AUDIT_LOG_PATH": os.path.join(tmp, "audit.db"),
+            "RECOMMENDATION_SNAPSHOT_PATH": os.path.join(tmp, "recommendations.json"),
+            "RECOMMENDATION_REFRESH_SECONDS": "86400",
+        }
+        # A token every worker sees within its refresh margin on first use.
+        store = session_store.SessionStore(env["SESSION_STORE_PATH"])
+        store.put("default", {"access_token": "stale", "refresh_token": "r", "expires_at": time.time() + 30})
+        store.close()
+
+        port = _free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers),
+             "--log-level", "warning"],
+            cwd=tmp, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            _wait_ready(base_url)
+            results = multiprocessing.Queue()
+            clients = [multiprocessing.Process(target=_load, args=(base_url, args.duration, args.concurrency, results))
+                       for _ in range(args.clients)]
+            for client in clients:
+                client.start()
+            outcomes = [results.get() for _ in clients]
+            for client in clients:
+                client.join()
+            latencies = [latency for client_latencies, _ in outcomes for latency in client_latencies]
+            errors = sum(client_errors for _, client_errors in outcomes)
+
+            # Straight into the shared job store, due in 3 seconds.
+            jobs = job_store.JobStore(env["JOB_STORE_PATH"])
+            run_at = time.time() + 3
+            jobs.add_many([(f"spotify:playlist:w{i}", run_at, "default", None) for i in range(args.jobs)])
+            jobs.close()
+            deadline = time.time() + 60
+            while time.time() < deadline and len(mock.plays) < args.jobs:
+                time.sleep(0.5)
+            time.sleep(3)  # Duplicates would arrive right after
+            played = [uri for _, uri in mock.plays if uri and uri.startswith("spotify:playlist:w")]
+
+            db = sqlite3.connect(env["JOB_STORE_PATH"])
+            leaders = db.execute("SELECT holder FROM leases WHERE name LIKE 'scheduler-leader:%'").fetchall()
+            db.close()
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    return {
+        "workers": workers,
+        "requests_per_second": len(latencies) / args.duration,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "errors": errors,
+        "token_refreshes": mock.token_calls,
+        "jobs_played": len(set(played)),
+        "duplicate_plays": len(played) - len(set(played)),
+        "leaders": [holder for holder, in leaders],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--jobs", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    _, mock_url = start_mock_server(latency=args.latency)
+    print(f"{os.cpu_count()} cores, {args.clients} load processes x {args.concurrency} connections, "
+          f"{args.duration:.0f}s per run")
+    failed = False
+    for workers in sorted({1, args.workers}):
+        result = run(workers, mock_url, args)
+        failed |= result["jobs_played"] < args.jobs or result["duplicate_plays"] > 0
+        print(f"{workers} worker(s): {result['requests_per_second']:7.0f} req/s, p50 {result['p50_ms']:.1f}ms "
+              f"p99 {result['p99_ms']:.1f}ms, {result['errors']} errors | token refreshes: "
+              f"{result['token_refreshes']} | jobs played {result['jobs_played']}/{args.jobs}, "
+              f"{result['duplicate_plays']} duplicates | leader: {', '.join(result['leaders']) or '-'}")
+    if failed:
+        print("FAIL: a job was lost or played more than once")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+Helpers shared by the benchmark scripts.
+
+Importing this module puts the repository root on sys.path, so scripts run
+as `python benchmarks/bench_<name>.py` can import the app modules after it.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values` (pct in 0-100), or NaN if there are none."""
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def summarize(seconds):
+    """Milliseconds percentiles of a list of durations in seconds, or None if empty."""
+    if not seconds:
+        return None
+    values = [s * 1000 for s in seconds]
+    return {
+        "p50": round(percentile(values, 50), 2),
+        "p90": round(percentile(values, 90), 2),
+        "p99": round(percentile(values, 99), 2),
+        "max": round(max(values), 2),
+    }
@@ -0,0 +1,38 @@
+"""
+In-process stand-in for the Gemini model used by the benchmarks.
+
+Install it with `ai._model = FakeModel(...)`. It answers playlist prompts with
+JSON naming one playlist that the mock Spotify server accepts, derived from
+the prompt so each mood gets its own id.
+"""
+import asyncio
+import hashlib
+import random
+
+
+class FakeModelError(Exception):
+    pass
+
+
+class FakeModel:
+    """
+    Args:
+        - latency (float): Seconds before each answer.
+        - jitter (float): Extra random seconds, uniform in [0, jitter].
+        - error_rate (float): Fraction of calls that fail after the latency.
+    """
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0, error_rate: float = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+
+    async def generate_content_async(self, prompt):
+        self.calls += 1
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if random.random() < self.error_rate:
+            raise FakeModelError("503 The model is overloaded.")
+        playlist_id = hashlib.sha256(prompt.encode()).hexdigest()[:22]
+        text = '{"playlists": [{"name": "Fake", "uri": "spotify:playlist:%s"}]}' % playlist_id
+        return type("Response", (), {"text": text})
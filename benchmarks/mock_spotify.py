@@ -0,0 +1,248 @@
+"""
+Local stand-in for the Spotify Web API used by the benchmarks.
+
+Run standalone with:
+    python benchmarks/mock_spotify.py --port 8765 --latency 0.02 [--rate-limit 100] [--error-rate 0.01]
+
+or start it in-process with `start_mock_server()`. Point the app at it with
+SPOTIFY_API_BASE=http://127.0.0.1:<port>/v1 and
+SPOTIFY_TOKEN_URL=http://127.0.0.1:<port>/api/token.
+"""
+import argparse
+import asyncio
+import random
+import socket
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+
+class MockSettings:
+    latency = 0.02
+    token_calls = 0
+    browse_calls = 0
+    search_calls = 0
+    playlist_calls = 0
+    search_total = 50
+    # Tracks of every playlist, and the version reported as its snapshot_id.
+    playlist_tracks = 25
+    playlist_version = 1
+    track_page_calls = 0
+    # Requests per second accepted before answering 429 (0 = unlimited).
+    rate_limit = 0
+    retry_after = 1
+    throttled = 0
+    # Fraction of requests answered with a 503.
+    error_rate = 0
+    errors = 0
+    # (time, context_uri) of every accepted start_playback.
+    plays = []
+    # device_id -> time of its last accepted start_playback.
+    device_plays = {}
+    # Connection warm-up requests (HEAD /v1/).
+    warm_ups = 0
+    player_calls = 0
+    # access token -> context_uri last started with it, served by GET /me/player.
+    now_playing = {}
+    _window = 0
+    _window_count = 0
+
+
+settings = MockSettings()
+app = FastAPI()
+
+
+@app.middleware("http")
+async def inject_errors(request: Request, call_next):
+    if settings.error_rate and random.random() < settings.error_rate:
+        settings.errors += 1
+        await asyncio.sleep(settings.latency)
+        return JSONResponse({"error": {"status": 503, "message": "Service unavailable"}}, status_code=503)
+    return await call_next(request)
+
+
+def _throttled():
+    """Returns a 429 response once more than `settings.rate_limit` requests arrive in one second."""
+    if not settings.rate_limit:
+        return None
+    window = int(time.time())
+    if window != settings._window:
+        settings._window, settings._window_count = window, 0
+    settings._window_count += 1
+    if settings._window_count > settings.rate_limit:
+        settings.throttled += 1
+        return Response(status_code=429, headers={"Retry-After": str(settings.retry_after)})
+    return None
+
+
+def _playlist(i):
+    return {
+        "name": f"Mock playlist {i}",
+        "uri": f"spotify:playlist:mock{i}",
+        "external_urls": {"spotify": f"https://open.spotify.com/playlist/mock{i}"},
+    }
+
+
+def _show(i):
+    return {
+        "name": f"Mock show {i}",
+        "description": "A mock podcast",
+        "external_urls": {"spotify": f"https://open.spotify.com/show/mock{i}"},
+    }
+
+
+@app.post("/api/token")
+async def token():
+    settings.token_calls += 1
+    await asyncio.sleep(settings.latency)
+    return {"access_token": f"mock-token-{settings.token_calls}", "token_type": "Bearer", "expires_in": 3600}
+
+
+@app.head("/v1/")
+async def warm_up():
+    settings.warm_ups += 1
+    return Response(status_code=401)
+
+
+@app.get("/v1/me")
+async def me(request: Request):
+    await asyncio.sleep(settings.latency)
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    return {"id": f"user-{token}", "display_name": "Mock user"}
+
+
+@app.get("/v1/me/player/devices")
+async def devices():
+    if (throttled := _throttled()) is not None:
+        return throttled
+    await asyncio.sleep(settings.latency)
+    return {"devices": [{"id": "mock-device", "name": "Mock speaker", "is_active": True, "type": "Speaker"}]}
+
+
+@app.put("/v1/me/player/play")
+async def play(request: Request):
+    if (throttled := _throttled()) is not None:
+        return throttled
+    body = await request.json() if await request.body() else {}
+    await asyncio.sleep(settings.latency)
+    settings.plays.append((time.time(), body.get("context_uri")))
+    if device_id := request.query_params.get("device_id"):
+        settings.device_plays[device_id] = time.time()
+    settings.now_playing[request.headers.get("Authorization")] = body.get("context_uri")
+    return Response(status_code=204)
+
+
+@app.get("/v1/me/player")
+async def player(request: Request):
+    if (throttled := _throttled()) is not None:
+        return throttled
+    settings.player_calls += 1
+    await asyncio.sleep(settings.latency)
+    context_uri = settings.now_playing.get(request.headers.get("Authorization"))
+    if context_uri is None:
+        return Response(status_code=204)
+    return {
+        "is_playing": True,
+        "progress_ms": 1000,
+        "device": {"id": "mock-device", "name": "Mock speaker"},
+        "context": {"uri": context_uri},
+        "item": {"uri": "spotify:track:mock", "name": "Mock track", "duration_ms": 180000},
+    }
+
+
+@app.get("/v1/browse/categories/{category_id}/playlists")
+async def category_playlists(request: Request, category_id: str, limit: int = 5):
+    if (throttled := _throttled()) is not None:
+        return throttled
+    settings.browse_calls += 1
+    await asyncio.sleep(settings.latency)
+    etag = f'"{category_id}-{limit}"'
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse({"playlists": {"items": [_playlist(i) for i in range(limit)]}}, headers={"ETag": etag})
+
+
+def _track_items(offset, limit):
+    end = min(offset + limit, settings.playlist_tracks)
+    return [{"track": {"uri": f"spotify:track:mock{i}", "name": f"Mock track {i}", "duration_ms": 180000 + i}}
+            for i in range(offset, end)]
+
+
+@app.get("/v1/playlists/{playlist_id}")
+async def playlist(playlist_id: str, fields: str = None):
+    """Playlists whose id starts with "x" do not exist."""
+    if (throttled := _throttled()) is not None:
+        return throttled
+    settings.playlist_calls += 1
+    await asyncio.sleep(settings.latency)
+    if playlist_id.startswith("x"):
+        return JSONResponse({"error": {"status": 404, "message": "Not found."}}, status_code=404)
+    snapshot_id = f"{playlist_id}-v{settings.playlist_version}"
+    if fields == "snapshot_id":
+        return {"snapshot_id": snapshot_id}
+    return {
+        "id": playlist_id,
+        "name": f"Mock playlist {playlist_id}",
+        "uri": f"spotify:playlist:{playlist_id}",
+        "snapshot_id": snapshot_id,
+        "external_urls": {"spotify": f"https://open.spotify.com/playlist/{playlist_id}"},
+        "tracks": {"total": settings.playlist_tracks, "items": _track_items(0, 100)},
+    }
+
+
+@app.get("/v1/playlists/{playlist_id}/tracks")
+async def playlist_tracks(playlist_id: str, offset: int = 0, limit: int = 100):
+    if (throttled := _throttled()) is not None:
+        return throttled
+    settings.track_page_calls += 1
+    await asyncio.sleep(settings.latency)
+    return {"items": _track_items(offset, limit), "total": settings.playlist_tracks, "offset": offset}
+
+
+@app.get("/v1/search")
+async def search(q: str, type: str = "show", limit: int = 5, offset: int = 0):
+    if (throttled := _throttled()) is not None:
+        return throttled
+    settings.search_calls += 1
+    await asyncio.sleep(settings.latency)
+    count = max(0, min(limit, settings.search_total - offset))
+    return {"shows": {"items": [_show(offset + i) for i in range(count)], "total": settings.search_total, "offset": offset}}
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mock_server(port: int = None, latency: float = 0.02):
+    """
+    Starts the mock server on a background thread.
+
+    Returns:
+        - (server, base_url) where base_url is e.g. "http://127.0.0.1:8765".
+    """
+    settings.latency = latency
+    port = port or _free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, f"http://127.0.0.1:{port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--rate-limit", type=int, default=0, help="requests/s before answering 429")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests answered with 503")
+    args = parser.parse_args()
+    settings.latency = args.latency
+    settings.rate_limit = args.rate_limit
+    settings.error_rate = args.error_rate
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Bounded in-memory cache with per-entry TTL and LRU eviction.
+
+    Concurrent misses for the same key are coalesced by `get_or_load`: the
+    first caller runs the loader and the others await its result. With a
+    `path`, entries are written through to a JSON file and reloaded on
+    start-up, so warm entries survive restarts (values must be JSON-serializable).
+    When several processes share the file, `save_if` (a callable) picks the
+    one that writes it; the others only read it back with reload().
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 3600, path: str = None, save_if=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.save_if = save_if
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._file_mtime = None
+        if path:
+            self.load()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                self._data.pop(key, None)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def peek(self, key, default=None):
+        """Like get, but leaves the hit/miss counters and LRU order untouched."""
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.time():
+            return default
+        return entry[1]
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+    async def get_or_load(self, key, loader, ttl: float = None):
+        """
+        Returns the cached value for `key`, or awaits `loader()` to produce it.
+        Errors raised by the loader are propagated and not cached. `ttl` may
+        be a callable returning the TTL for the loaded value.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load_and_store(key, loader, ttl))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _load_and_store(self, key, loader, ttl):
+        value = await loader()
+        self.set(key, value, ttl(value) if callable(ttl) else ttl)
+        if self.path and (self.save_if is None or self.save_if()):
+            await asyncio.to_thread(self.save)
+        return value
+
+    def load(self):
+        """
+        Reads unexpired entries from `path`. An entry already in memory is
+        kept when it expires later than the file's (it is the fresher one).
+        """
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            self._file_mtime = os.path.getmtime(self.path)
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Could not read cache file {self.path}: {e}")
+            return
+        now = time.time()
+        for key, (expires_at, value) in entries.items():
+            current = self._data.get(key)
+            if expires_at > now and (current is None or current[0] < expires_at):
+                self._data[key] = (expires_at, value)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def reload(self):
+        """Re-reads `path` if another process rewrote it since this cache last read or wrote it."""
+        try:
+            changed = os.path.getmtime(self.path) != self._file_mtime
+        except (OSError, TypeError):
+            return
+        if changed:
+            self.load()
+
+    def save(self):
+        """Atomically writes the current entries to `path`."""
+        if not self.path:
+            return
+        with self._lock:
+            snapshot = json.dumps({key: list(entry) for key, entry in list(self._data.items())})
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".cache.")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(snapshot)
+                os.replace(tmp_path, self.path)
+                self._file_mtime = os.path.getmtime(self.path)
+            except OSError as e:
+                logging.error(f"Could not write cache file {self.path}: {e}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+
+_MISSING = object()
@@ -0,0 +1,86 @@
+import time
+import logging
+from metrics import Counter
+
+CIRCUIT_TRANSITIONS = Counter("circuit_breaker_transitions_total", "Circuit breaker state changes.", ("name", "state"))
+CIRCUIT_REJECTED = Counter("circuit_breaker_rejected_total", "Calls short-circuited by an open breaker.", ("name",))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a dependency that keeps failing or answering slowly.
+
+    After `failure_threshold` consecutive failures (a call slower than
+    `slow_call_seconds` counts as one), the breaker opens and `allow()`
+    returns False for `reset_seconds`. Then a single probe call is let
+    through: its success closes the breaker, its failure opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, slow_call_seconds: float = 5,
+                 reset_seconds: float = 30):
+        """
+        Args:
+            - name (str): Label used in logs and metrics.
+            - failure_threshold (int): Consecutive failures that open the breaker.
+            - slow_call_seconds (float): Successful calls slower than this
+              count as failures.
+            - reset_seconds (float): How long the breaker stays open before probing.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        """Returns whether a call may go ahead now."""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        CIRCUIT_REJECTED.labels(name=self.name).inc()
+        return False
+
+    def record_success(self, seconds: float = 0):
+        if seconds > self.slow_call_seconds:
+            self.record_failure()
+            return
+        self._failures = 0
+        self._probing = False
+        if self.state != CLOSED:
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        self._failures += 1
+        self._probing = False
+        if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            if self.state != OPEN:
+                self._set_state(OPEN)
+
+    def record_cancelled(self):
+        """The call was given up by its caller; its outcome says nothing about the dependency."""
+        self._probing = False
+
+    def _set_state(self, state: str):
+        self.state = state
+        CIRCUIT_TRANSITIONS.labels(name=self.name, state=state).inc()
+        if state == OPEN:
+            logging.warning(f"{self.name} circuit opened after {self._failures} failures; "
+                            f"skipping calls for {self.reset_seconds:.0f}s.")
+        else:
+            logging.info(f"{self.name} circuit {state.replace('_', '-')}.")
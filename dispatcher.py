@@ -0,0 +1,153 @@
+import asyncio
+import heapq
+import itertools
+import time
+import logging
+
+
+class _Entry:
+    __slots__ = ("run_at", "job", "context", "done")
+
+    def __init__(self, run_at, job):
+        self.run_at = run_at
+        self.job = job
+        self.context = {}
+        self.done = False
+
+
+class Dispatcher:
+    """
+    Fires claimed jobs at their run_at from a single timer.
+
+    Jobs wait in a min-heap keyed by (run_at, arrival order). One timer task
+    sleeps until the head is due and moves every due job, already in fire
+    order, onto a queue served by `workers` asyncio tasks. That bounds the
+    number of playbacks in flight however many jobs share a tick. Each job
+    has a deadline of run_at + `deadline`. A job that cannot finish by then is
+    given up as missed instead of playing late. The optional `prepare` step runs
+    ahead of run_at on its own bounded pool and never delays firing.
+    """
+
+    def __init__(self, fire, prepare=None, on_done=None, workers: int = 100,
+                 prepare_workers: int = 16, deadline: float = 120):
+        """
+        Args:
+            - fire: Coroutine function called as fire(job, **context).
+            - prepare: Optional coroutine function called as prepare(job)
+              before run_at; it returns the context dict passed to fire.
+            - on_done: Optional callable on_done(job, outcome) with outcome
+              "success", "failure" or "missed".
+            - workers (int): Max jobs firing at the same time.
+            - prepare_workers (int): Max jobs preparing at the same time.
+            - deadline (float): Seconds after run_at by which a job must
+              have fired.
+        """
+        self.fire = fire
+        self.prepare = prepare
+        self.on_done = on_done
+        self.workers = workers
+        self.prepare_workers = prepare_workers
+        self.deadline = deadline
+        self._heap = []
+        self._sequence = itertools.count()
+        self._ready = None
+        self._to_prepare = None
+        self._wakeup = None
+        self._tasks = []
+
+    def __len__(self):
+        return len(self._heap) + (self._ready.qsize() if self._ready else 0)
+
+    def start(self):
+        """Starts the timer and worker tasks on the running event loop."""
+        self._ready = asyncio.Queue()
+        self._to_prepare = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._timer())]
+        self._tasks += [asyncio.ensure_future(self._fire_worker()) for _ in range(self.workers)]
+        if self.prepare is not None:
+            self._tasks += [asyncio.ensure_future(self._prepare_worker()) for _ in range(self.prepare_workers)]
+
+    def unfired(self):
+        """Returns the submitted jobs that have not started firing (waiting or being prepared)."""
+        waiting = [entry for _, _, entry in self._heap]
+        if self._ready is not None:
+            waiting += list(self._ready._queue)
+        return [entry.job for entry in waiting]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, jobs):
+        """
+        Queues claimed jobs (dicts with a 'run_at' timestamp). Must be called
+        from the event loop thread.
+        """
+        head = self._heap[0][0] if self._heap else None
+        for job in jobs:
+            entry = _Entry(job["run_at"], job)
+            heapq.heappush(self._heap, (entry.run_at, next(self._sequence), entry))
+            if self.prepare is not None:
+                self._to_prepare.put_nowait(entry)
+        if self._heap and (head is None or self._heap[0][0] < head):
+            self._wakeup.set()
+
+    async def _timer(self):
+        while True:
+            if not self._heap:
+                await self._wait(None)
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                await self._wait(delay)
+                continue
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                self._ready.put_nowait(heapq.heappop(self._heap)[2])
+
+    async def _wait(self, timeout):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _fire_worker(self):
+        while True:
+            entry = await self._ready.get()
+            remaining = entry.run_at + self.deadline - time.time()
+            if remaining <= 0:
+                self._finish(entry, "missed")
+                continue
+            try:
+                await asyncio.wait_for(self.fire(entry.job, **entry.context), remaining)
+                outcome = "success"
+            except asyncio.TimeoutError:
+                logging.error(f"Job {entry.job.get('id')} missed its deadline.")
+                outcome = "missed"
+            except Exception as e:
+                logging.error(f"Scheduled job {entry.job.get('id')} failed: {e}")
+                outcome = "failure"
+            self._finish(entry, outcome)
+
+    async def _prepare_worker(self):
+        while True:
+            entry = await self._to_prepare.get()
+            remaining = entry.run_at - time.time()
+            if entry.done or remaining <= 0:
+                continue
+            try:
+                # Preparation that is not ready by run_at is abandoned; the job fires unprepared.
+                entry.context = await asyncio.wait_for(self.prepare(entry.job), remaining) or {}
+            except asyncio.TimeoutError:
+                logging.debug(f"Job {entry.job.get('id')} was not prepared by its run time.")
+            except Exception as e:
+                logging.warning(f"Preparing job {entry.job.get('id')} failed, firing unprepared: {e!r}")
+
+    def _finish(self, entry, outcome):
+        entry.done = True
+        if self.on_done is not None:
+            self.on_done(entry.job, outcome)
@@ -0,0 +1,286 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+import logging
+from leases import SCHEMA as LEASES_SCHEMA, acquire_lease, release_lease
+
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "scheduled_jobs.db")
+
+# Jobs are spread over a fixed space of virtual shards so that workers can
+# split the table between them (see SCHEDULER_SHARD in scheduler.py).
+VIRTUAL_SHARDS = 1024
+
+# A job claimed by another worker that is not completed within this many
+# seconds is considered abandoned (e.g. the worker crashed) and becomes
+# claimable again. Kept below the scheduler's fire deadline
+# (SCHEDULER_DEADLINE_SECONDS), so a re-claimed job can still fire.
+CLAIM_LEASE_SECONDS = 60
+
+# A job occupies its user's timeline from run_at to end_at. Without a known
+# length it takes SCHEDULE_SLOT_SECONDS; no slot is longer than
+# SCHEDULE_MAX_SLOT_SECONDS, which bounds the index scan of range queries.
+SCHEDULE_SLOT_SECONDS = float(os.getenv("SCHEDULE_SLOT_SECONDS", "60"))
+SCHEDULE_MAX_SLOT_SECONDS = float(os.getenv("SCHEDULE_MAX_SLOT_SECONDS", str(4 * 3600)))
+
+# Jobs still to fire; claimed ones are about to.
+ACTIVE_STATUSES = ("pending", "claimed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scheduled_jobs (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    playlist_uri TEXT NOT NULL,
+    run_at REAL NOT NULL,
+    shard INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    claimed_by TEXT,
+    claimed_at REAL,
+    cron TEXT,
+    end_at REAL,
+    targets TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_due ON scheduled_jobs (status, run_at);
+CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_user ON scheduled_jobs (user_id, run_at);
+"""
+
+
+def slot_end(run_at: float, end_at: float = None) -> float:
+    """Returns the end of a job's slot: end_at if given, capped at SCHEDULE_MAX_SLOT_SECONDS."""
+    if end_at is None or end_at <= run_at:
+        return run_at + SCHEDULE_SLOT_SECONDS
+    return min(end_at, run_at + SCHEDULE_MAX_SLOT_SECONDS)
+
+
+def shard_for_user(user_id: str) -> int:
+    """Maps a user id onto one of the virtual shards."""
+    return zlib.crc32(user_id.encode("utf-8")) % VIRTUAL_SHARDS
+
+
+class JobStore:
+    """
+    SQLite-backed store of scheduled playbacks.
+
+    Jobs are indexed by (status, run_at) and (user_id, run_at), so inserts and
+    next-due lookups are B-tree operations. Claims run inside an IMMEDIATE
+    transaction, which makes them atomic across threads and processes sharing
+    the same database file: a job is handed to exactly one worker.
+    """
+
+    def __init__(self, path: str = JOB_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA + LEASES_SCHEMA)
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(scheduled_jobs)")}
+        if "cron" not in columns:
+            self._conn.execute("ALTER TABLE scheduled_jobs ADD COLUMN cron TEXT")
+        if "end_at" not in columns:
+            self._conn.execute("ALTER TABLE scheduled_jobs ADD COLUMN end_at REAL")
+            self._conn.execute("UPDATE scheduled_jobs SET end_at = run_at + ?", (SCHEDULE_SLOT_SECONDS,))
+        if "targets" not in columns:
+            self._conn.execute("ALTER TABLE scheduled_jobs ADD COLUMN targets TEXT")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def add(self, playlist_uri: str, run_at: float, user_id: str = "default", cron: str = None,
+            end_at: float = None, targets=None) -> str:
+        """Stores a new pending job and returns its id."""
+        return self.add_many([(playlist_uri, run_at, user_id, cron, end_at, targets)])[0]
+
+    def add_many(self, jobs) -> list:
+        """
+        Stores many pending jobs in a single transaction.
+
+        Args:
+            - jobs: Iterable of (playlist_uri, run_at, user_id, cron[, end_at[,
+              targets]]) tuples; cron is None for one-off jobs. end_at
+              defaults to run_at + SCHEDULE_SLOT_SECONDS and is capped at
+              run_at + SCHEDULE_MAX_SLOT_SECONDS. targets is None, or a list
+              of (user_id, device_id) pairs the job plays on at once.
+
+        Returns:
+            - List of the new job ids, in input order.
+        """
+        rows = []
+        for playlist_uri, run_at, user_id, cron, *extra in jobs:
+            end_at = extra[0] if extra else None
+            targets = extra[1] if len(extra) > 1 else None
+            rows.append((uuid.uuid4().hex, user_id, playlist_uri, run_at, shard_for_user(user_id), cron,
+                         slot_end(run_at, end_at), json.dumps(targets) if targets else None))
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO scheduled_jobs (id, user_id, playlist_uri, run_at, shard, cron, end_at, targets) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [row[0] for row in rows]
+
+    def pending_count(self) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*) FROM scheduled_jobs WHERE status = 'pending'").fetchone()
+        return row[0]
+
+    def jobs_for_user(self, user_id: str, limit: int = 100):
+        """Returns the next pending jobs of a user, ordered by fire time."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM scheduled_jobs WHERE user_id = ? AND status = 'pending' ORDER BY run_at LIMIT ?",
+                (user_id, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def jobs_between(self, user_id: str, start: float, end: float, limit: int = None):
+        """
+        Returns the user's pending or claimed jobs whose slot overlaps
+        [start, end), ordered by run_at.
+
+        Slots are at most SCHEDULE_MAX_SLOT_SECONDS long, so only run_at in
+        [start - SCHEDULE_MAX_SLOT_SECONDS, end) has to be read from the
+        (user_id, run_at) index: O(log n) plus the jobs in that range.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM scheduled_jobs WHERE user_id = ? AND run_at >= ? AND run_at < ? AND end_at > ? "
+                "AND status IN (?, ?) ORDER BY run_at LIMIT ?",
+                (user_id, start - SCHEDULE_MAX_SLOT_SECONDS, end, start, *ACTIVE_STATUSES,
+                 -1 if limit is None else limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get(self, job_id: str):
+        """Returns a job by id, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM scheduled_jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def claim_due_jobs(self, worker_id: str, now: float = None, limit: int = 100,
+                       shard_index: int = 0, shard_count: int = 1, horizon: float = 0, lease: str = None):
+        """
+        Atomically claims up to `limit` jobs that are due by `now + horizon`.
+
+        Jobs claimed by another worker are taken over once their claim is
+        CLAIM_LEASE_SECONDS old, or right away if that worker no longer
+        holds `lease`. The caller's own claims are never taken over.
+
+        Args:
+            - worker_id (str): Identifier recorded on the claimed rows.
+            - horizon (float): Seconds of look-ahead, so callers can prepare
+              jobs before they are due.
+            - shard_index, shard_count: Only claim jobs whose virtual shard
+              falls into this worker's slice.
+            - lease (str): Optional name of the lease (see leases.py) that
+              workers must hold for their claims to stay valid.
+
+        Returns:
+            - List of claimed job dictionaries, ordered by run_at.
+        """
+        now = time.time() if now is None else now
+        stale_before = now - CLAIM_LEASE_SECONDS
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT * FROM scheduled_jobs "
+                    "WHERE ((status = 'pending' AND run_at <= ?) "
+                    "    OR (status = 'claimed' AND claimed_by != ? AND (claimed_at < ? OR (? IS NOT NULL "
+                    "        AND claimed_by NOT IN (SELECT holder FROM leases WHERE name = ? AND expires_at >= ?))))) "
+                    "AND shard % ? = ? "
+                    "ORDER BY run_at LIMIT ?",
+                    (now + horizon, worker_id, stale_before, lease, lease, now, shard_count, shard_index, limit),
+                ).fetchall()
+                if rows:
+                    self._conn.executemany(
+                        "UPDATE scheduled_jobs SET status = 'claimed', claimed_by = ?, claimed_at = ? WHERE id = ?",
+                        [(worker_id, now, row["id"]) for row in rows],
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [dict(row) for row in rows]
+
+    def finish_many(self, results):
+        """
+        Records the outcome of many fired jobs in a single transaction.
+
+        Args:
+            - results: Iterable of (job_id, status, next_run_at). status is
+              'done' or 'failed'; with a next_run_at the job is put back as
+              pending for its next run instead (recurring jobs).
+        """
+        finished = []
+        rescheduled = []
+        for job_id, status, next_run_at in results:
+            if next_run_at is None:
+                finished.append((status, job_id))
+            else:
+                rescheduled.append((next_run_at, next_run_at, job_id))
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("UPDATE scheduled_jobs SET status = ? WHERE id = ?", finished)
+                self._conn.executemany(
+                    "UPDATE scheduled_jobs SET status = 'pending', end_at = end_at + (? - run_at), run_at = ?, "
+                    "claimed_by = NULL, claimed_at = NULL WHERE id = ?",
+                    rescheduled,
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def release_claims(self, job_ids, worker_id: str):
+        """Puts jobs claimed by `worker_id` back as pending, e.g. when it stops before firing them."""
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE scheduled_jobs SET status = 'pending', claimed_by = NULL, claimed_at = NULL "
+                "WHERE id = ? AND status = 'claimed' AND claimed_by = ?",
+                [(job_id, worker_id) for job_id in job_ids],
+            )
+
+    def cancel(self, job_id: str, user_id: str = None) -> bool:
+        """
+        Removes a pending job (by primary key), only if it belongs to
+        `user_id` when one is given. Returns False if no such job was pending.
+        """
+        query = "DELETE FROM scheduled_jobs WHERE id = ? AND status = 'pending'"
+        params = (job_id,)
+        if user_id is not None:
+            query += " AND user_id = ?"
+            params += (user_id,)
+        with self._lock:
+            cursor = self._conn.execute(query, params)
+        return cursor.rowcount > 0
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """Takes or renews a named lease shared by every process using this store (see leases.py)."""
+        with self._lock:
+            return acquire_lease(self._conn, name, holder, ttl)
+
+    def release_lease(self, name: str, holder: str):
+        with self._lock:
+            release_lease(self._conn, name, holder)
+
+    def purge_finished(self, older_than: float) -> int:
+        """Deletes done/failed jobs whose fire time is before `older_than`."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM scheduled_jobs WHERE status IN ('done', 'failed') AND run_at < ?", (older_than,)
+            )
+        logging.info(f"Purged {cursor.rowcount} finished jobs.")
+        return cursor.rowcount
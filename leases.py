@@ -0,0 +1,38 @@
+import os
+import socket
+import time
+
+# Identifies this process in claims and leases ("host:pid").
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def acquire_lease(conn, name: str, holder: str, ttl: float, now: float = None) -> bool:
+    """
+    Takes the lease `name` for `ttl` seconds if it is free, expired or
+    already held by `holder` (which renews it). A single UPSERT, so it is
+    atomic across every process sharing the database.
+
+    Returns:
+        - True if `holder` now holds the lease.
+    """
+    now = time.time() if now is None else now
+    cursor = conn.execute(
+        "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+        "ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+        "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+        (name, holder, now + ttl, now),
+    )
+    return cursor.rowcount > 0
+
+
+def release_lease(conn, name: str, holder: str):
+    """Gives up the lease `name` if `holder` holds it."""
+    conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
@@ -1,67 +1,141 @@
-from fastapi import FastAPI, Request, Query, HTTPException
+from fastapi import Depends, FastAPI, Request, Response, Query, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from contextlib import asynccontextmanager
-from uvicorn import run
-from ai import get_ai_playlist_recommendation, get_ai_podcast_recommendation
-from auth import callback
-from scheduled_playback import (
-    get_spotify_playlists,
+from audit_log import audit_log, AUDIT_FLUSH_SECONDS
+from mood_engine import (
     get_time_based_mood,
-    initialize_spotify_client,
-    refresh_token_if_needed,
-    play_playlist,
-    sp_oauth
+    mood_engine,
+    prefetch_upcoming_moods,
+    save_mood_settings,
+    sync_mood_settings,
+    MOOD_PREFETCH_POLL_SECONDS,
+    MOOD_SYNC_SECONDS
+)
+from recommendations import (
+    mood_recommendation,
+    podcast_recommendation,
+    precompute_recommendations,
+    reload_recommendations,
+    RECOMMENDATION_RELOAD_SECONDS,
+    RECOMMENDATION_REFRESH_SECONDS
+)
+from scheduled_playback import (
+    get_oauth,
+    prepare_playback,
+    refresh_devices,
+    DEVICE_REFRESH_SECONDS,
+    play_playlist
+)
+from scheduler import (
+    cancel_schedule,
+    list_schedules,
+    next_schedules,
+    purge_finished_jobs,
+    schedule_periodic,
+    schedule_playlist,
+    schedule_playlists_batch,
+    start_scheduler,
+    stop_scheduler,
+    ScheduleConflict
 )
-from scheduler import schedule_playlist, start_scheduler, stop_scheduler
-from podcast import search_podcast
+from playback_state import playback_tracker
+from playlist_snapshots import get_playlist_snapshot, refresh_playlist_snapshot
+from podcast import iter_podcasts, search_podcast, MAX_SEARCH_OFFSET
+from spotify_async import SpotifyAPIError, close_spotify_client, get_spotify_client
+from fastapi.concurrency import run_in_threadpool
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import json
 import logging
+import metrics
+import os
+import time
 
 from spotify_client import clear_token_info, save_token_info
+from token_manager import DEFAULT_USER, refresh_token_if_needed, token_manager
+
+# Cookie holding the session key issued by /callback.
+SESSION_COOKIE = "spotify_session"
+SESSION_COOKIE_MAX_AGE = 30 * 24 * 3600
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    start_scheduler()
+    # Every worker process runs this; jobs marked leader_only (and job
+    # dispatch) only run in the one holding the scheduler lease. The device
+    # and mood prefetches fill per-process caches, so every worker runs them.
+    start_scheduler(play_playlist, prepare_func=prepare_playback)
+    schedule_periodic(refresh_devices, DEVICE_REFRESH_SECONDS, "refresh-devices")
+    schedule_periodic(sync_mood_settings, MOOD_SYNC_SECONDS, "sync-mood-settings", run_now=True)
+    schedule_periodic(prefetch_upcoming_moods, MOOD_PREFETCH_POLL_SECONDS, "prefetch-moods")
+    schedule_periodic(precompute_recommendations, RECOMMENDATION_REFRESH_SECONDS, "precompute-recommendations",
+                      run_now=True, leader_only=True)
+    schedule_periodic(reload_recommendations, RECOMMENDATION_RELOAD_SECONDS, "reload-recommendations")
+    schedule_periodic(audit_log.flush, AUDIT_FLUSH_SECONDS, "flush-audit-log")
+    schedule_periodic(audit_log.purge_expired, 86400, "purge-audit-log", leader_only=True)
+    schedule_periodic(purge_finished_jobs, 86400, "purge-finished-jobs", leader_only=True)
     yield
     # Shutdown
-    stop_scheduler()
+    await stop_scheduler()
+    await audit_log.close()
+    await playback_tracker.close()
+    await close_spotify_client()
+    token_manager.close()
 
 app = FastAPI(lifespan=lifespan)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# APScheduler logs every dispatcher poll at INFO.
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
+
+def _session_key(request: Request):
+    return request.cookies.get(SESSION_COOKIE) or request.headers.get("X-Session-Key")
 
-sp = None 
+async def current_user(request: Request) -> str:
+    """
+    Resolves the Spotify user id of a request from its session cookie (or the
+    X-Session-Key header). Requests without a session act for the default user.
+    """
+    key = _session_key(request)
+    if not key:
+        return DEFAULT_USER
+    user_id = token_manager.user_for_session(key)
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Unknown session. Please log in again.")
+    return user_id
 
 @app.get("/login")
-async def login():
-    logging.info("Login endpoint accessed.")
+async def login(user_id: str = Depends(current_user)):
+    logging.debug("Login endpoint accessed.")
 
     # Check if a valid token already exists
-    token_info = refresh_token_if_needed()
+    token_info = await refresh_token_if_needed(user_id)
     if token_info:
-        logging.info("Token information found. User is already authenticated.")
+        logging.debug("Token information found. User is already authenticated.")
         return {"message": "Already authenticated", "token_info": token_info}
 
     # If no valid token, request a new one
-    auth_url = sp_oauth.get_authorize_url()
-    logging.info(f"Auth URL generated: {auth_url}")
+    auth_url = get_oauth().get_authorize_url()
+    logging.debug("Auth URL generated.")
 
     return {"auth_url": auth_url}
 
 @app.get("/logout")
-def logout():
+def logout(request: Request, response: Response, user_id: str = Depends(current_user)):
     """
-    Clears stored Spotify authentication tokens and forces user to log in again.
+    Clears the user's stored Spotify authentication tokens and forces them to log in again.
     """
-    clear_token_info()
+    clear_token_info(user_id)
+    key = _session_key(request)
+    if key:
+        token_manager.end_session(key)
+    response.delete_cookie(SESSION_COOKIE)
     logging.info("✅ User logged out successfully.")
     return {"message": "Logged out successfully"}
 
 @app.get("/callback")
-async def callback(request: Request):
-    logging.info(f"🚀 Callback accessed. Full request URL: {request.url}")
-
-    query_params = request.query_params
-    logging.info(f"🔍 Query parameters received: {query_params}")
+async def callback(request: Request, response: Response):
+    logging.debug("🚀 Callback accessed.")
 
     code = request.query_params.get("code")
     if not code:
@@ -69,24 +143,29 @@ async def callback(request: Request):
         return {"error": "Authorization failed: No code received.", "full_url": str(request.url)}
 
     try:
-        logging.info("🔄 Attempting to exchange authorization code for token...")
+        logging.debug("🔄 Attempting to exchange authorization code for token...")
 
         # Exchange authorization code for access token
-        token_info = sp_oauth.get_access_token(code)
-        logging.info(f"✅ Token received: {token_info}")
+        token_info = get_oauth().get_access_token(code)
+        logging.debug("✅ Token received.")
 
-        save_token_info(token_info)
-        initialize_spotify_client()
-        logging.info("✅ Spotify authentication successful.")
+        # Sessions are keyed by the Spotify user id.
+        profile = await get_spotify_client().with_token(token_info["access_token"]).me()
+        user_id = profile["id"]
+        save_token_info(token_info, user_id)
+        session_key = token_manager.create_session(user_id)
+        response.set_cookie(SESSION_COOKIE, session_key, max_age=SESSION_COOKIE_MAX_AGE, httponly=True, samesite="lax")
+        logging.info(f"✅ Spotify authentication successful for user {user_id}.")
 
-        return {"message": "Authentication successful!", "token_info": token_info}
+        return {"message": "Authentication successful!", "user_id": user_id, "session_key": session_key,
+                "token_info": token_info}
 
     except Exception as e:
         logging.error(f"❌ Error during callback: {e}")
 
         # Try logging the full response from Spotify
         try:
-            error_response = sp_oauth.get_access_token(code)
+            error_response = get_oauth().get_access_token(code)
             logging.error(f"🔴 Spotify API Error Response: {error_response}")
         except Exception as inner_e:
             logging.error(f"⚠️ Failed to log error response: {inner_e}")
@@ -94,73 +173,296 @@ async def callback(request: Request):
         return {"error": f"Authentication failed: {e}"}
 
 @app.get("/schedule-playlist")
-def schedule_playlist_route(playlist_uri: str, play_time: str = Query(..., pattern="^([0-9]{2}):([0-9]{2})$")):
+async def schedule_playlist_route(playlist_uri: str, play_time: str = Query(..., pattern="^([0-9]{2}):([0-9]{2})$"),
+                                  allow_overlap: bool = False, device_id: list[str] = Query(None),
+                                  user_id: str = Depends(current_user)):
+    """
+    Schedules a playlist. Its slot lasts as long as the playlist; answers 409
+    with the overlapping playbacks unless allow_overlap is set. Repeat
+    device_id to start it on all of those devices at once.
+    """
+    if playlist_uri.startswith("spotify:playlist:"):
+        try:
+            await get_playlist_snapshot(playlist_uri, user_id)  # Known length for the slot
+        except Exception as e:
+            logging.debug(f"No track list for {playlist_uri}: {e}")
     try:
-        return schedule_playlist(play_playlist, playlist_uri, play_time)
+        return await run_in_threadpool(schedule_playlist, play_playlist, playlist_uri, play_time, user_id=user_id,
+                                       allow_overlap=allow_overlap, devices=device_id)
+    except ScheduleConflict as e:
+        raise HTTPException(status_code=409, detail={"message": str(e), "conflicts": e.conflicts})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logging.error(f"Error scheduling playlist: {e}")
         raise HTTPException(status_code=500, detail="Scheduling failed")
 
-@app.get("/ai-playlist")
-def ai_playlist_route(mood: str):
+@app.post("/schedule-batch")
+async def schedule_batch_route(request: Request, allow_overlap: bool = False, user_id: str = Depends(current_user)):
+    """
+    Schedules many playlists at once for the session's user. The body is
+    either a JSON array or an NDJSON stream (Content-Type: application/x-ndjson)
+    of objects like {"playlist_uri": "...", "play_time": "07:30"} or
+    {"playlist_uri": "...", "cron": "30 7 * * mon-fri"}, optionally with
+    "devices": [...] to play on a group of the user's devices at once.
+    Returns one result per item; overlapping items get status "conflict"
+    unless allow_overlap is set.
+    """
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        items = []
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            items.extend(_parse_ndjson_line(line) for line in lines if line.strip())
+        if buffer.strip():
+            items.append(_parse_ndjson_line(buffer))
+    else:
+        try:
+            items = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Body must be a JSON array of schedules.")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Body must be a JSON array of schedules.")
+
+    try:
+        results = await run_in_threadpool(schedule_playlists_batch, items, user_id, False, allow_overlap)
+    except Exception as e:
+        logging.error(f"Error scheduling batch: {e}")
+        raise HTTPException(status_code=500, detail="Scheduling failed")
+
+    scheduled = sum(1 for result in results if result["status"] == "scheduled")
+    return {"scheduled": scheduled, "failed": len(results) - scheduled, "results": results}
+
+@app.get("/schedules")
+async def schedules_route(start: datetime = None, end: datetime = None, limit: int = Query(100, ge=1, le=1000),
+                          user_id: str = Depends(current_user)):
     """
-    Fetches an AI-generated playlist recommendation based on mood.
-    Falls back to Spotify's curated playlists if AI fails.
+    Lists the user's scheduled playbacks that play between start and end
+    (ISO 8601; default: the next 24 hours), in fire order.
     """
+    start_ts = start.timestamp() if start else time.time()
+    end_ts = end.timestamp() if end else start_ts + 86400
+    if end_ts <= start_ts:
+        raise HTTPException(status_code=400, detail="'end' must be after 'start'.")
+    return {"schedules": await run_in_threadpool(list_schedules, user_id, start_ts, end_ts, limit)}
+
+@app.get("/schedules/next")
+async def next_schedules_route(limit: int = Query(10, ge=1, le=1000), user_id: str = Depends(current_user)):
+    """Returns the user's next pending playbacks."""
+    return {"schedules": await run_in_threadpool(next_schedules, user_id, limit)}
+
+@app.delete("/schedules/{job_id}")
+async def cancel_schedule_route(job_id: str, user_id: str = Depends(current_user)):
+    """Cancels one of the user's pending playbacks."""
+    if not await run_in_threadpool(cancel_schedule, job_id, user_id):
+        raise HTTPException(status_code=404, detail="No pending schedule with this id.")
+    return {"message": "Schedule cancelled", "job_id": job_id}
+
+def _history_range(start: datetime, end: datetime):
+    end_ts = end.timestamp() if end else time.time()
+    start_ts = start.timestamp() if start else end_ts - 86400
+    if end_ts <= start_ts:
+        raise HTTPException(status_code=400, detail="'end' must be after 'start'.")
+    return start_ts, end_ts
+
+@app.get("/history")
+async def history_route(start: datetime = None, end: datetime = None, kind: str = None,
+                        limit: int = Query(100, ge=1, le=10000), cursor: str = None,
+                        user_id: str = Depends(current_user)):
+    """
+    The user's audit events (playbacks, scheduled jobs, retries, token
+    refreshes, recommendations) between start and end (ISO 8601; default:
+    the last 24 hours), oldest first. A full page comes with a next_cursor
+    to pass as cursor for the next one.
+    """
+    start_ts, end_ts = _history_range(start, end)
+    after = None
+    if cursor:
+        try:
+            ts, event_id = cursor.split(":")
+            after = (float(ts), int(event_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor.")
+    await audit_log.flush()
+    events = await run_in_threadpool(audit_log.query, start_ts, end_ts, user_id, kind, limit, after)
+    next_cursor = f"{events[-1]['ts']!r}:{events[-1]['id']}" if len(events) == limit else None
+    return {"events": events, "next_cursor": next_cursor}
+
+@app.get("/history/export")
+async def history_export_route(start: datetime = None, end: datetime = None, user_id: str = Depends(current_user)):
+    """The user's audit events between start and end in the compact columnar format (audit_log.read_export)."""
+    start_ts, end_ts = _history_range(start, end)
+    await audit_log.flush()
+    data = await run_in_threadpool(audit_log.export, start_ts, end_ts, user_id)
+    return Response(content=data, media_type="application/octet-stream")
+
+def _parse_ndjson_line(line: bytes):
     try:
-        ai_playlist = get_ai_playlist_recommendation(mood)
-        if not ai_playlist:
-            logging.warning(f"AI failed for mood '{mood}', falling back to Spotify.")
-            return get_spotify_playlists(mood)
+        return json.loads(line)
+    except ValueError:
+        return None  # Reported as an invalid item
 
-        return ai_playlist
+@app.get("/ai-playlist")
+async def ai_playlist_route(mood: str, user_id: str = Depends(current_user)):
+    """
+    Returns the precomputed playlist recommendation for a mood: verified AI
+    suggestions, or Spotify's curated playlists if AI fails. Moods that are
+    not precomputed are resolved on the request.
+    """
+    try:
+        return await mood_recommendation(mood, user_id=user_id)
     except Exception as e:
-        logging.error(f"AI Playlist Request Failed: {e}, using Spotify instead.")
-        return get_spotify_playlists(mood)
+        logging.error(f"AI Playlist Request Failed: {e}")
+        raise HTTPException(status_code=500, detail="Failed to fetch playlist recommendation")
     
 @app.get("/ai-podcast")
-def ai_podcast_route(subject: str):
+async def ai_podcast_route(subject: str, user_id: str = Depends(current_user)):
     """
     Fetches an AI-generated podcast recommendation based on subject.
     """
     try:
-        return get_ai_podcast_recommendation(subject)
+        return await podcast_recommendation(subject, user_id=user_id)
     except Exception as e:
         logging.error(f"AI Podcast Request Failed: {e}")
         raise HTTPException(status_code=500, detail="AI Podcast Request Failed")
 
 @app.get("/search-podcast")
-def search_podcast_route(query: str):
-
-    global sp
+async def search_podcast_route(query: str, stream: bool = False,
+                               max_results: int = Query(MAX_SEARCH_OFFSET, ge=1, le=MAX_SEARCH_OFFSET),
+                               user_id: str = Depends(current_user)):
+    """
+    Searches podcasts. With stream=true, results are sent as NDJSON and further
+    pages are fetched from Spotify only as the client keeps reading.
+    """
+    if stream:
+        return StreamingResponse(_stream_podcasts(query, max_results, user_id), media_type="application/x-ndjson")
     try:
-        return search_podcast(sp, refresh_token_if_needed, query)
+        return await search_podcast(get_spotify_client(user_id), query)
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error searching podcast: {e}")
         raise HTTPException(status_code=500, detail="Podcast search failed")   
     
+async def _stream_podcasts(query: str, max_results: int, user_id: str):
+    try:
+        async for podcast in iter_podcasts(get_spotify_client(user_id), query, max_results):
+            yield json.dumps(podcast) + "\n"
+    except Exception as e:
+        logging.error(f"Error streaming podcast search: {e}")
+        yield json.dumps({"error": "Podcast search failed"}) + "\n"
+
 @app.get("/mood-playlist")
-def mood_playlist_route():
+async def mood_playlist_route(user_id: str = Depends(current_user)):
     """
-    Automatically selects a playlist based on the time of day.
-    Falls back to Spotify if AI fails.
+    Automatically selects a playlist based on the time of day in the user's
+    time zone (see /mood). Falls back to Spotify if AI fails.
     """
-    mood = get_time_based_mood()
-    logging.info(f"Selected mood: {mood}")
+    mood = get_time_based_mood(user_id)
+    logging.debug(f"Selected mood: {mood}")
 
     try:
-        # Try AI-based recommendation first
-        ai_playlist = get_ai_playlist_recommendation(mood)
-        if ai_playlist:
-            return ai_playlist
-
-        # If AI fails, fallback to Spotify's curated playlists
-        logging.warning(f"AI failed for mood '{mood}', falling back to Spotify.")
-        return get_spotify_playlists(mood)
-
+        return await mood_recommendation(mood, user_id=user_id)
     except Exception as e:
         logging.error(f"Error fetching mood-based playlist: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch mood-based playlist")
 
+@app.get("/mood")
+async def mood_route(transitions: int = Query(5, ge=0, le=100), user_id: str = Depends(current_user)):
+    """The user's current mood and their next mood changes, in their time zone."""
+    settings = mood_engine.settings(user_id)
+    zone = ZoneInfo(settings["timezone"])
+    return {
+        "mood": get_time_based_mood(user_id),
+        "timezone": settings["timezone"],
+        "next_transitions": [
+            {"at": datetime.fromtimestamp(ts, zone).isoformat(), "mood": mood}
+            for ts, mood in mood_engine.next_transitions(user_id, transitions)
+        ],
+    }
+
+@app.get("/mood/settings")
+async def mood_settings_route(user_id: str = Depends(current_user)):
+    """The user's time zone and mood rules (the defaults unless they set their own)."""
+    return mood_engine.settings(user_id)
+
+@app.put("/mood/settings")
+async def put_mood_settings_route(request: Request, user_id: str = Depends(current_user)):
+    """
+    Sets the user's time zone and/or mood rules from a JSON body like
+    {"timezone": "Europe/Amsterdam", "rules": {"weekday": {"07:00": "energy boost", ...},
+    "weekend": {...}}}. Missing fields use the defaults; an empty body resets both.
+    """
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be a JSON object.")
+    if not isinstance(body, dict) or set(body) - {"timezone", "rules"}:
+        raise HTTPException(status_code=400, detail="Body must be an object with 'timezone' and/or 'rules'.")
+    timezone = body.get("timezone")
+    if timezone is not None and not isinstance(timezone, str):
+        raise HTTPException(status_code=400, detail="'timezone' must be an IANA time zone name.")
+    try:
+        return await save_mood_settings(user_id, timezone, body.get("rules"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/playlist-tracks")
+async def playlist_tracks_route(playlist_uri: str, refresh: bool = False, user_id: str = Depends(current_user)):
+    """
+    Returns the track list and total duration of a playlist from the snapshot
+    cache. With refresh=true, its snapshot_id is checked with Spotify first.
+    """
+    try:
+        if refresh:
+            snapshot = await refresh_playlist_snapshot(playlist_uri, user_id)
+        else:
+            snapshot = await get_playlist_snapshot(playlist_uri, user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except SpotifyAPIError as e:
+        if e.status_code == 404:
+            raise HTTPException(status_code=404, detail="Playlist not found")
+        logging.error(f"Error fetching playlist tracks: {e}")
+        raise HTTPException(status_code=500, detail="Failed to fetch playlist tracks")
+    return snapshot.to_dict()
+
+@app.get("/playback-state")
+async def playback_state_route(user_id: str = Depends(current_user)):
+    """
+    Returns what the user is playing. Recent states are shared between
+    callers instead of asking Spotify for each one.
+    """
+    try:
+        return await playback_tracker.get(user_id)
+    except Exception as e:
+        logging.error(f"Error fetching playback state: {e}")
+        raise HTTPException(status_code=500, detail="Failed to fetch playback state")
+
+@app.get("/playback-state/stream")
+async def playback_state_stream_route(user_id: str = Depends(current_user)):
+    """
+    Server-sent events with the user's playback state: the current one, then
+    every change. All streams of a user share one Spotify poller.
+    """
+    return StreamingResponse(_stream_playback_state(user_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+async def _stream_playback_state(user_id: str):
+    async for state in playback_tracker.subscribe(user_id):
+        yield f"data: {json.dumps(state)}\n\n"
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_route():
+    """
+    Exposes latency histograms, retry and status counters and cache hit rates
+    in the Prometheus text format.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
-    run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    from uvicorn import run
+    # WEB_CONCURRENCY > 1 runs that many worker processes (without auto-reload).
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    run("main:app", host="0.0.0.0", port=8000, workers=workers, reload=workers == 1)
\ No newline at end of file
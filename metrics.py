@@ -0,0 +1,158 @@
+import asyncio
+import functools
+import time
+from bisect import bisect_left
+
+# Latency buckets in seconds, from cache hits up to slow upstream calls.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_metrics = []
+_caches = {}
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        _metrics.append(self)
+
+    def labels(self, **labels):
+        """Returns the child for a label combination; keep the result to skip the lookup on hot paths."""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label_text(self, key, extra: str = ""):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in list(self._children.items()):
+            lines.extend(self._render_child(key, child))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _render_child(self, key, child):
+        return [f"{self.name}{self._label_text(key)} {child.value}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, key, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, child.counts):
+            cumulative += count
+            labels = self._label_text(key, 'le="%s"' % bound)
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = self._label_text(key, 'le="+Inf"')
+        lines.append(f"{self.name}_bucket{labels} {child.count}")
+        lines.append(f"{self.name}_sum{self._label_text(key)} {child.sum}")
+        lines.append(f"{self.name}_count{self._label_text(key)} {child.count}")
+        return lines
+
+
+def timed(histogram: Histogram, **labels):
+    """Decorator observing the wall time of a sync or async function."""
+    child = histogram.labels(**labels)
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+
+    return decorator
+
+
+def register_cache(name: str, cache):
+    """Exposes the hit/miss counters and size of a cache.TTLCache."""
+    _caches[name] = cache
+
+
+def render() -> str:
+    """Returns every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+
+    if _caches:
+        for name, kind, attribute in (("cache_hits_total", "counter", "hits"),
+                                      ("cache_misses_total", "counter", "misses")):
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f'{name}{{cache="{cache_name}"}} {getattr(cache, attribute)}'
+                         for cache_name, cache in _caches.items())
+        lines.append("# TYPE cache_entries gauge")
+        lines.extend(f'cache_entries{{cache="{cache_name}"}} {len(cache)}' for cache_name, cache in _caches.items())
+    return "\n".join(lines) + "\n"
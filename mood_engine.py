@@ -0,0 +1,437 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import logging
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from metrics import Counter
+from scheduled_playback import MOOD_WINDOWS, PREFETCH_LEAD_SECONDS, prefetch_mood_playlists
+from token_manager import DEFAULT_USER, token_manager
+
+# Time zone of users who have not set one (default: the server's).
+MOOD_TIMEZONE = os.getenv("MOOD_TIMEZONE")
+
+# Default mood rules as JSON, e.g. {"weekday": {"06:30": "energy boost", ...},
+# "weekend": {"09:00": "chill", ...}}. Without it, MOOD_WINDOWS apply every day.
+MOOD_RULES = os.getenv("MOOD_RULES")
+
+# Days of transitions precomputed per profile; the table is rebuilt when it runs out.
+MOOD_HORIZON_DAYS = int(os.getenv("MOOD_HORIZON_DAYS", "2"))
+
+# How often the upcoming transitions are checked for moods to prefetch, and
+# how often mood settings saved by other worker processes are picked up.
+MOOD_PREFETCH_POLL_SECONDS = float(os.getenv("MOOD_PREFETCH_POLL_SECONDS", "30"))
+MOOD_SYNC_SECONDS = float(os.getenv("MOOD_SYNC_SECONDS", "30"))
+
+# Distinct (time zone, rules) combinations kept at once; settings that
+# would add another are rejected. Profiles nobody uses are freed.
+MOOD_MAX_PROFILES = int(os.getenv("MOOD_MAX_PROFILES", "10000"))
+
+MAX_RULES_PER_DAY = 96
+MAX_MOOD_LENGTH = 100
+DAY_TYPES = ("weekday", "weekend")
+
+MOOD_REBUILDS = Counter("mood_profile_rebuilds_total", "Transition tables precomputed for mood profiles.")
+MOOD_PREFETCHES = Counter("mood_prefetches_total", "Moods prefetched ahead of a transition.")
+
+
+def parse_rules(rules: dict) -> dict:
+    """
+    Validates mood rules and returns them as {'weekday': [(minute, mood), ...],
+    'weekend': [...]}, sorted by minute of the day.
+
+    Args:
+        - rules (dict): {'weekday': {'HH:MM': mood, ...}, 'weekend': {...}}.
+          A missing 'weekend' uses the weekday rules.
+
+    Raises:
+        - ValueError: If the rules are malformed.
+    """
+    if not isinstance(rules, dict) or not rules:
+        raise ValueError("Mood rules must be an object with 'weekday' and/or 'weekend' windows.")
+    unknown = set(rules) - set(DAY_TYPES)
+    if unknown:
+        raise ValueError(f"Unknown mood rule day types: {', '.join(sorted(unknown))}.")
+    parsed = {}
+    for day_type in DAY_TYPES:
+        windows = rules.get(day_type)
+        if windows is None:
+            continue
+        if not isinstance(windows, dict) or not windows or len(windows) > MAX_RULES_PER_DAY:
+            raise ValueError(f"'{day_type}' must map 1 to {MAX_RULES_PER_DAY} 'HH:MM' start times to moods.")
+        day = []
+        for start, mood in windows.items():
+            try:
+                hour, minute = (int(part) for part in start.split(":"))
+            except ValueError:
+                raise ValueError(f"Invalid start time '{start}', expected HH:MM.")
+            if not (0 <= hour < 24 and 0 <= minute < 60):
+                raise ValueError(f"Invalid start time '{start}', expected HH:MM.")
+            if not isinstance(mood, str) or not mood.strip() or len(mood) > MAX_MOOD_LENGTH:
+                raise ValueError(f"Invalid mood for {start}.")
+            day.append((hour * 60 + minute, mood.strip()))
+        parsed[day_type] = sorted(day)
+    parsed.setdefault("weekend", parsed.get("weekday"))
+    parsed.setdefault("weekday", parsed["weekend"])
+    return parsed
+
+
+def format_rules(parsed: dict) -> dict:
+    """The inverse of parse_rules."""
+    return {day_type: {f"{minute // 60:02d}:{minute % 60:02d}": mood for minute, mood in parsed[day_type]}
+            for day_type in DAY_TYPES}
+
+
+def _zone(name: str) -> ZoneInfo:
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown time zone '{name}'.")
+
+
+def _server_timezone() -> str:
+    if MOOD_TIMEZONE:
+        return MOOD_TIMEZONE
+    from tzlocal import get_localzone_name  # Installed with APScheduler
+    return get_localzone_name() or "UTC"
+
+
+DEFAULT_RULES = json.loads(MOOD_RULES) if MOOD_RULES else {
+    "weekday": {f"{start_hour:02d}:00": mood for start_hour, mood in MOOD_WINDOWS},
+}
+
+
+class MoodProfile:
+    """
+    One time zone and set of rules, shared by every user who has them.
+
+    The mood transitions of the next `horizon_days` days are precomputed as
+    absolute timestamps in a sorted table, so the current mood is read at
+    the table's cursor and the cursor only moves forward as time passes.
+    Local times are resolved with the zone's DST rules.
+    """
+
+    __slots__ = ("timezone", "rules", "users", "horizon_days", "_zone", "_times", "_moods", "_valid_until",
+                 "_position", "current_mood", "current_from", "current_until")
+
+    def __init__(self, timezone: str, rules: dict, horizon_days: int = MOOD_HORIZON_DAYS):
+        self.timezone = timezone
+        self.rules = rules
+        self.users = 0
+        self.horizon_days = horizon_days
+        self._zone = _zone(timezone)
+        self._times = array("d")
+        self._moods = []
+        self._valid_until = 0.0
+        self._position = 0
+        # The window at the cursor, checked inline by MoodEngine.mood_for.
+        self.current_mood = None
+        self.current_from = self.current_until = 0.0
+
+    def _table(self, now: float):
+        """
+        Returns (times, moods, valid_until): the transitions from yesterday
+        (whose last window may still be running) to the end of the horizon.
+        """
+        MOOD_REBUILDS.inc()
+        today = datetime.fromtimestamp(now, self._zone).date()
+        times = array("d")
+        moods = []
+        for offset in range(-1, self.horizon_days + 1):
+            day = today + timedelta(days=offset)
+            for minute, mood in self.rules["weekend" if day.weekday() >= 5 else "weekday"]:
+                if moods and moods[-1] == mood:
+                    continue  # Not a change
+                local = datetime(day.year, day.month, day.day, minute // 60, minute % 60, tzinfo=self._zone)
+                times.append(local.timestamp())
+                moods.append(mood)
+        end = today + timedelta(days=self.horizon_days + 1)
+        return times, moods, datetime(end.year, end.month, end.day, tzinfo=self._zone).timestamp()
+
+    def _seek(self, now: float) -> int:
+        """Moves the cursor to the transition in effect at `now` and returns it."""
+        times = self._times
+        if not times or now < times[0] or now >= self._valid_until:
+            self._times, self._moods, self._valid_until = self._table(now)
+            self._position = 0
+            times = self._times
+        position = self._position
+        if now < times[position]:
+            position = bisect_right(times, now) - 1
+        while position + 1 < len(times) and times[position + 1] <= now:
+            position += 1
+        self._position = position
+        return position
+
+    def mood_at(self, now: float) -> str:
+        if self.current_from <= now < self.current_until:
+            return self.current_mood
+        position = self._seek(now)
+        times = self._times
+        self.current_mood = self._moods[position]
+        self.current_from = times[position]
+        self.current_until = times[position + 1] if position + 1 < len(times) else self._valid_until
+        return self.current_mood
+
+    def transitions(self, start: float, end: float):
+        """
+        Yields (timestamp, mood) of each transition with start <= timestamp < end,
+        extending past the horizon with throwaway tables (the cursor stays put).
+        """
+        position = self._seek(start)
+        times, moods, valid_until = self._times, self._moods, self._valid_until
+        last, last_mood = times[position], moods[position]
+        if last == start < end:
+            yield last, last_mood  # A change right at start
+        while True:
+            position += 1
+            if position == len(times):
+                # Rules repeat weekly: no change in over a week means none ever.
+                if valid_until >= end or valid_until - last > 8 * 86400:
+                    return
+                times, moods, valid_until = self._table(valid_until)
+                position = bisect_right(times, last)
+                if position < len(times) and moods[position] == last_mood:
+                    position += 1  # The table's first window, not a change
+                if position == len(times):
+                    position -= 1  # No change in this table either
+                    continue
+            if times[position] >= end:
+                return
+            last, last_mood = times[position], moods[position]
+            yield last, last_mood
+
+
+class MoodEngine:
+    """
+    Resolves each user's time-of-day mood in their own time zone.
+
+    Users are rows in a table pointing at a MoodProfile, and users with the
+    same time zone and rules share one profile (and its precomputed
+    transitions), so a lookup is a dict access plus a read at the profile's
+    cursor. Users without settings use the default profile.
+    """
+
+    def __init__(self, rules: dict = None, timezone: str = None, horizon_days: int = MOOD_HORIZON_DAYS,
+                 max_profiles: int = MOOD_MAX_PROFILES):
+        self.horizon_days = horizon_days
+        self.max_profiles = max_profiles
+        # Profile id -> MoodProfile (None once freed) and its key in _profile_ids.
+        self._profiles = []
+        self._profile_keys = []
+        self._profile_ids = {}
+        self._free_profiles = []
+        self._user_rows = {}
+        self._user_profiles = array("I")
+        self._free_rows = []
+        parsed = parse_rules(rules or DEFAULT_RULES)
+        self._default_rules_key = json.dumps(parsed)
+        self.default_profile = self._profile((timezone or _server_timezone(), self._default_rules_key), parsed)
+
+    def _profile(self, key: tuple, rules: dict) -> int:
+        """Returns the id of the profile with `key` ((timezone, rules JSON)), creating it if needed."""
+        profile_id = self._profile_ids.get(key)
+        if profile_id is None:
+            profile = MoodProfile(key[0], rules, self.horizon_days)
+            if self._free_profiles:
+                profile_id = self._free_profiles.pop()
+                self._profiles[profile_id] = profile
+                self._profile_keys[profile_id] = key
+            else:
+                profile_id = len(self._profiles)
+                self._profiles.append(profile)
+                self._profile_keys.append(key)
+            self._profile_ids[key] = profile_id
+        return profile_id
+
+    def _release(self, profile_id: int):
+        """Drops a user's reference to a profile, freeing the profile with its last user."""
+        profile = self._profiles[profile_id]
+        profile.users -= 1
+        if profile.users == 0 and profile_id != self.default_profile:
+            del self._profile_ids[self._profile_keys[profile_id]]
+            self._profiles[profile_id] = self._profile_keys[profile_id] = None
+            self._free_profiles.append(profile_id)
+
+    def profile_count(self) -> int:
+        return len(self._profile_ids)
+
+    def profile_for(self, user_id: str) -> MoodProfile:
+        row = self._user_rows.get(user_id)
+        return self._profiles[self.default_profile if row is None else self._user_profiles[row]]
+
+    def set_user(self, user_id: str, timezone: str = None, rules: dict = None):
+        """
+        Sets a user's time zone and rules; None keeps the default for that
+        part, and neither resets the user to the default profile.
+
+        Args:
+            - rules (dict): Unparsed rules, see parse_rules.
+
+        Raises:
+            - ValueError: If the time zone is unknown, the rules are malformed
+              or they would add a profile beyond `max_profiles`.
+        """
+        default = self._profiles[self.default_profile]
+        if rules is None:
+            parsed, rules_key = default.rules, self._default_rules_key
+        else:
+            parsed = parse_rules(rules)
+            rules_key = json.dumps(parsed)
+        key = (timezone or default.timezone, rules_key)
+        row = self._user_rows.get(user_id)
+        old_id = self.default_profile if row is None else self._user_profiles[row]
+        if key not in self._profile_ids:
+            # The user's current profile is freed if they were its last user.
+            freed = old_id != self.default_profile and self._profiles[old_id].users == 1
+            if len(self._profile_ids) - freed >= self.max_profiles:
+                raise ValueError("Too many distinct mood settings; please use an existing time zone and rules.")
+        profile_id = self._profile(key, parsed)
+        if profile_id == old_id:
+            return
+        if row is not None:
+            self._release(old_id)
+        if profile_id == self.default_profile:
+            del self._user_rows[user_id]
+            self._free_rows.append(row)
+            return
+        if row is None:
+            if self._free_rows:
+                row = self._free_rows.pop()
+            else:
+                row = len(self._user_profiles)
+                self._user_profiles.append(0)
+            self._user_rows[user_id] = row
+        self._user_profiles[row] = profile_id
+        self._profiles[profile_id].users += 1
+
+    def settings(self, user_id: str) -> dict:
+        profile = self.profile_for(user_id)
+        return {"timezone": profile.timezone, "rules": format_rules(profile.rules),
+                "default": user_id not in self._user_rows}
+
+    def mood_for(self, user_id: str = DEFAULT_USER, now: float = None) -> str:
+        """Returns the user's current mood."""
+        if now is None:
+            now = time.time()
+        row = self._user_rows.get(user_id)
+        profile = self._profiles[self.default_profile if row is None else self._user_profiles[row]]
+        if profile.current_from <= now < profile.current_until:
+            return profile.current_mood
+        return profile.mood_at(now)
+
+    def next_transitions(self, user_id: str, count: int = 5, now: float = None):
+        """Returns the user's next `count` mood changes as (timestamp, mood) pairs."""
+        now = time.time() if now is None else now
+        profile = self.profile_for(user_id)
+        upcoming = []
+        for transition in profile.transitions(now, float("inf")):
+            upcoming.append(transition)
+            if len(upcoming) == count:
+                break
+        return upcoming
+
+    def transitions_between(self, start: float, end: float):
+        """
+        Returns every profile's mood changes with start <= timestamp < end, as
+        sorted (timestamp, mood, users) tuples. Profiles nobody uses are
+        skipped, except the default one.
+        """
+        found = []
+        for profile_id, profile in enumerate(self._profiles):
+            if profile is not None and (profile.users or profile_id == self.default_profile):
+                found.extend((ts, mood, profile.users) for ts, mood in profile.transitions(start, end))
+        found.sort()
+        return found
+
+    def default_moods(self) -> list:
+        """The moods of the default rules, in order."""
+        rules = self._profiles[self.default_profile].rules
+        return list(dict.fromkeys(mood for day_type in DAY_TYPES for _, mood in rules[day_type]))
+
+    def __len__(self):
+        return len(self._user_rows)
+
+    def apply_stored(self, rows) -> int:
+        """
+        Applies settings rows read from the session store, skipping invalid
+        ones. Returns how many were applied.
+
+        Args:
+            - rows: Iterable of (user_id, timezone, rules_json) tuples.
+        """
+        applied = 0
+        for user_id, timezone, rules in rows:
+            try:
+                self.set_user(user_id, timezone, json.loads(rules) if rules else None)
+                applied += 1
+            except ValueError as e:
+                logging.warning(f"Ignoring stored mood settings of {user_id}: {e}")
+        return applied
+
+
+mood_engine = MoodEngine()
+_prefetched_until = 0.0
+_synced_at = 0.0
+
+
+def get_time_based_mood(user_id: str = DEFAULT_USER):
+    """
+    Returns the mood of the time of day in the user's time zone, following
+    their mood rules (or the defaults).
+    """
+    return mood_engine.mood_for(user_id)
+
+
+async def save_mood_settings(user_id: str, timezone: str = None, rules: dict = None) -> dict:
+    """
+    Validates, applies and stores a user's mood settings; without a time zone
+    and rules the user is reset to the defaults.
+
+    Raises:
+        - ValueError: If the time zone is unknown or the rules are malformed.
+    """
+    mood_engine.set_user(user_id, timezone, rules)
+    stored_rules = json.dumps(rules) if rules is not None else None
+    await asyncio.to_thread(token_manager.store().put_mood_settings, user_id, timezone, stored_rules)
+    return mood_engine.settings(user_id)
+
+
+async def sync_mood_settings():
+    """Applies the mood settings stored since the last sync, by this or any other worker process."""
+    global _synced_at
+    now = time.time()
+    try:
+        # A second of overlap for rows written while the previous sync ran.
+        rows = await asyncio.to_thread(token_manager.store().mood_settings_since, _synced_at - 1)
+    except sqlite3.Error as e:
+        logging.error(f"Loading mood settings failed: {e}")
+        return
+    _synced_at = now
+    applied = mood_engine.apply_stored(rows)
+    if applied:
+        logging.debug(f"Applied mood settings of {applied} users.")
+
+
+async def prefetch_upcoming_moods():
+    """
+    Prefetches the playlists of every mood some users switch to in the next
+    PREFETCH_LEAD_SECONDS. Users in different time zones change mood at
+    different times, so the prefetches spread over the day, and a mood
+    several profiles switch to at once is fetched once.
+    """
+    global _prefetched_until
+    now = time.time()
+    start = max(now, _prefetched_until)
+    end = now + PREFETCH_LEAD_SECONDS
+    if end <= start:
+        return
+    moods = dict.fromkeys(mood for _, mood, _ in mood_engine.transitions_between(start, end))
+    _prefetched_until = end
+    for mood in moods:
+        MOOD_PREFETCHES.inc()
+        await prefetch_mood_playlists(mood)
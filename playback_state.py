@@ -0,0 +1,204 @@
+import asyncio
+import os
+import time
+import logging
+from cache import TTLCache
+from metrics import Counter, register_cache
+from spotify_async import get_spotify_client
+from token_manager import DEFAULT_USER
+
+# Poll interval while something is playing, and the ceiling it backs off to while idle.
+PLAYBACK_POLL_SECONDS = float(os.getenv("PLAYBACK_POLL_SECONDS", "5"))
+PLAYBACK_POLL_MAX_SECONDS = float(os.getenv("PLAYBACK_POLL_MAX_SECONDS", "30"))
+
+# A known state younger than this is reused instead of asking Spotify again,
+# and is trusted by scheduled jobs to skip a redundant start_playback.
+PLAYBACK_STATE_MAX_AGE = float(os.getenv("PLAYBACK_STATE_MAX_AGE", "10"))
+
+# Fields that make a state change; progress alone does not.
+_STATE_FIELDS = ("is_playing", "context_uri", "item_uri", "device_id")
+
+PLAYBACK_STATE_REQUESTS = Counter("playback_state_requests_total", "Playback state lookups sent to Spotify.",
+                                  ("outcome",))
+SKIPPED_PLAYBACKS = Counter("playback_skipped_total",
+                            "Scheduled playbacks skipped because their context was already playing.")
+
+
+def summarize_state(player: dict) -> dict:
+    """
+    Reduces Spotify's GET /me/player payload to the fields we track. An
+    empty payload (nothing playing) gives an idle state.
+    """
+    player = player or {}
+    item = player.get("item") or {}
+    context = player.get("context") or {}
+    device = player.get("device") or {}
+    return {
+        "is_playing": bool(player.get("is_playing")),
+        "context_uri": context.get("uri"),
+        "item_uri": item.get("uri"),
+        "item_name": item.get("name"),
+        "device_id": device.get("id"),
+        "progress_ms": player.get("progress_ms"),
+        "duration_ms": item.get("duration_ms"),
+    }
+
+
+def _changed(old: dict, new: dict) -> bool:
+    return old is None or any(old[field] != new[field] for field in _STATE_FIELDS)
+
+
+async def _fetch_from_spotify(user_id: str):
+    return summarize_state(await get_spotify_client(user_id).playback_state())
+
+
+class PlaybackStateTracker:
+    """
+    Shares each user's Spotify playback state between all consumers.
+
+    A lookup reuses a state younger than its `max_age`, and concurrent
+    lookups for one user await a single request. While a user has
+    subscribers, one poller refreshes their state: every `poll_seconds`
+    while playing (sooner if the track ends first), backing off up to
+    `max_poll_seconds` while idle. Subscribers are only sent states that
+    changed in more than playback progress.
+    """
+
+    def __init__(self, poll_seconds: float = PLAYBACK_POLL_SECONDS,
+                 max_poll_seconds: float = PLAYBACK_POLL_MAX_SECONDS, fetch=None, maxsize: int = 10000):
+        """
+        Args:
+            - fetch: Async callable taking a user id and returning a state
+              dict (see summarize_state). Defaults to asking Spotify.
+            - maxsize (int): Max users whose last state is kept.
+        """
+        self.poll_seconds = poll_seconds
+        self.max_poll_seconds = max_poll_seconds
+        self.fetch = fetch or _fetch_from_spotify
+        # user id -> (fetched_at, state)
+        self.states = TTLCache(maxsize=maxsize, ttl=max(PLAYBACK_STATE_MAX_AGE, max_poll_seconds) * 2)
+        self._inflight = {}
+        self._subscribers = {}
+        self._pollers = {}
+
+    def peek(self, user_id: str = DEFAULT_USER, max_age: float = PLAYBACK_STATE_MAX_AGE):
+        """Returns the user's last known state if it is at most `max_age` seconds old, otherwise None."""
+        entry = self.states.peek(user_id)
+        if entry is None or time.time() - entry[0] > max_age:
+            return None
+        return entry[1]
+
+    async def get(self, user_id: str = DEFAULT_USER, max_age: float = PLAYBACK_STATE_MAX_AGE) -> dict:
+        """Returns the user's playback state, asking Spotify only if the known one is older than `max_age`."""
+        state = self.peek(user_id, max_age)
+        if state is not None:
+            return state
+
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh(user_id))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def _refresh(self, user_id: str) -> dict:
+        try:
+            state = await self.fetch(user_id)
+        except Exception:
+            PLAYBACK_STATE_REQUESTS.labels(outcome="error").inc()
+            raise
+        PLAYBACK_STATE_REQUESTS.labels(outcome="success").inc()
+        self._update(user_id, state)
+        return state
+
+    def record_playback(self, user_id: str, uri: str, device_id: str = None):
+        """
+        Records a playback we just started, so consumers see it (and later
+        jobs for the same context can skip) without another poll.
+        """
+        context = uri if uri.startswith(("spotify:playlist:", "spotify:album:", "spotify:artist:")) else None
+        self._update(user_id, {
+            "is_playing": True,
+            "context_uri": context,
+            "item_uri": None if context else uri,
+            "item_name": None,
+            "device_id": device_id,
+            "progress_ms": 0,
+            "duration_ms": None,
+        })
+
+    def is_playing(self, user_id: str, uri: str, max_age: float = PLAYBACK_STATE_MAX_AGE) -> bool:
+        """True if a state at most `max_age` old shows `uri` (context or track) playing."""
+        state = self.peek(user_id, max_age)
+        return bool(state and state["is_playing"] and uri in (state["context_uri"], state["item_uri"]))
+
+    def _update(self, user_id: str, state: dict):
+        entry = self.states.peek(user_id)
+        self.states.set(user_id, (time.time(), state))
+        if _changed(entry[1] if entry else None, state):
+            for queue in self._subscribers.get(user_id, ()):
+                _put_latest(queue, state)
+
+    async def subscribe(self, user_id: str = DEFAULT_USER):
+        """
+        Yields the user's current playback state, then every change. The
+        user is polled for as long as at least one subscriber is attached.
+        """
+        queue = asyncio.Queue(maxsize=8)
+        subscribers = self._subscribers.setdefault(user_id, set())
+        subscribers.add(queue)
+        if user_id not in self._pollers:
+            self._pollers[user_id] = asyncio.ensure_future(self._poll(user_id))
+        try:
+            entry = self.states.peek(user_id)
+            if entry is not None:
+                yield entry[1]
+            while True:
+                yield await queue.get()
+        finally:
+            subscribers.discard(queue)
+            if not subscribers:
+                self._subscribers.pop(user_id, None)
+                poller = self._pollers.pop(user_id, None)
+                if poller is not None:
+                    poller.cancel()
+
+    async def _poll(self, user_id: str):
+        interval = self.poll_seconds
+        while True:
+            try:
+                # Other consumers' lookups count as polls too.
+                state = await self.get(user_id, max_age=interval / 2)
+            except Exception as e:
+                logging.debug(f"Playback state poll for {user_id} failed: {e}")
+                interval = min(self.max_poll_seconds, interval * 2)
+            else:
+                interval = self._next_interval(state, interval)
+            await asyncio.sleep(interval)
+
+    def _next_interval(self, state: dict, interval: float) -> float:
+        if not state["is_playing"]:
+            return min(self.max_poll_seconds, max(interval, self.poll_seconds) * 2)
+        if state["duration_ms"] and state["progress_ms"] is not None:
+            # Catch the track change shortly after it happens.
+            remaining = (state["duration_ms"] - state["progress_ms"]) / 1000 + 0.5
+            return max(1.0, min(self.poll_seconds, remaining))
+        return self.poll_seconds
+
+    async def close(self):
+        """Stops every poller (on shutdown)."""
+        pollers, self._pollers = list(self._pollers.values()), {}
+        for poller in pollers:
+            poller.cancel()
+        await asyncio.gather(*pollers, return_exceptions=True)
+
+
+def _put_latest(queue: asyncio.Queue, state: dict):
+    """Queues a state for a subscriber, dropping its oldest one if it is not keeping up."""
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(state)
+
+
+playback_tracker = PlaybackStateTracker()
+register_cache("playback_states", playback_tracker.states)
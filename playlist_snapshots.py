@@ -0,0 +1,161 @@
+import asyncio
+import os
+import logging
+from array import array
+from cache import TTLCache
+from metrics import Counter, Histogram, register_cache, timed
+from spotify_async import get_spotify_client
+from token_manager import DEFAULT_USER
+
+# A snapshot is served without asking Spotify for this long; after that its
+# snapshot_id is checked and the tracks are only re-fetched if it changed.
+PLAYLIST_SNAPSHOT_TTL = float(os.getenv("PLAYLIST_SNAPSHOT_TTL", "600"))
+PLAYLIST_SNAPSHOT_CACHE_SIZE = int(os.getenv("PLAYLIST_SNAPSHOT_CACHE_SIZE", "512"))
+
+TRACK_PAGE_SIZE = 100  # Spotify's maximum for playlist items
+PAGE_CONCURRENCY = 8
+
+TRACK_FIELDS = "uri,name,duration_ms"
+PLAYLIST_FIELDS = f"snapshot_id,name,tracks(total,items(track({TRACK_FIELDS})))"
+PAGE_FIELDS = f"items(track({TRACK_FIELDS}))"
+
+SNAPSHOT_LOADS = Counter("playlist_snapshot_loads_total", "Playlist snapshot loads by result.", ("result",))
+SNAPSHOT_FETCH_SECONDS = Histogram("playlist_snapshot_fetch_seconds", "Time to fetch every track of a playlist.")
+
+
+class PlaylistSnapshot:
+    """
+    Track list of a playlist at one snapshot_id.
+
+    Tracks are kept column-wise (URIs, names, and durations in a 4-byte
+    unsigned array, ample for milliseconds) instead of one dict per track,
+    so long playlists stay small in memory and the total duration is a
+    single sum.
+    """
+
+    __slots__ = ("playlist_id", "snapshot_id", "name", "uris", "names", "durations_ms", "total_duration_ms")
+
+    def __init__(self, playlist_id: str, snapshot_id: str, name: str, tracks):
+        """
+        Args:
+            - tracks: Iterable of Spotify track objects ('uri', 'name', 'duration_ms').
+        """
+        tracks = [track for track in tracks if track and track.get("uri")]
+        self.playlist_id = playlist_id
+        self.snapshot_id = snapshot_id
+        self.name = name
+        self.uris = tuple(track["uri"] for track in tracks)
+        self.names = tuple(track.get("name") or "" for track in tracks)
+        self.durations_ms = array("I", (track.get("duration_ms") or 0 for track in tracks))
+        self.total_duration_ms = sum(self.durations_ms)
+
+    def __len__(self):
+        return len(self.uris)
+
+    def tracks(self):
+        """Yields the tracks as {'uri', 'name', 'duration_ms'} dicts."""
+        for uri, name, duration_ms in zip(self.uris, self.names, self.durations_ms):
+            yield {"uri": uri, "name": name, "duration_ms": duration_ms}
+
+    def to_dict(self) -> dict:
+        return {
+            "playlist_uri": f"spotify:playlist:{self.playlist_id}",
+            "name": self.name,
+            "snapshot_id": self.snapshot_id,
+            "total_tracks": len(self),
+            "total_duration_ms": self.total_duration_ms,
+            "tracks": list(self.tracks()),
+        }
+
+
+# playlist id -> PlaylistSnapshot, fresh for PLAYLIST_SNAPSHOT_TTL.
+playlist_snapshots = TTLCache(maxsize=PLAYLIST_SNAPSHOT_CACHE_SIZE, ttl=PLAYLIST_SNAPSHOT_TTL)
+# Last snapshot of every playlist, kept longer to revalidate by snapshot_id.
+_known_snapshots = TTLCache(maxsize=PLAYLIST_SNAPSHOT_CACHE_SIZE, ttl=86400)
+register_cache("playlist_snapshots", playlist_snapshots)
+
+
+def playlist_id_from_uri(playlist: str) -> str:
+    """Accepts a playlist id, a spotify:playlist: URI or an open.spotify.com URL."""
+    playlist = playlist.strip()
+    if playlist.startswith("spotify:playlist:"):
+        playlist = playlist[len("spotify:playlist:"):]
+    elif "open.spotify.com/playlist/" in playlist:
+        playlist = playlist.split("open.spotify.com/playlist/", 1)[1].split("?", 1)[0]
+    if not playlist or not playlist.isalnum():
+        raise ValueError("Invalid playlist URI provided.")
+    return playlist
+
+
+def cached_duration(playlist_uri: str):
+    """Returns a playlist's total length in seconds if its snapshot is in memory, otherwise None."""
+    if not playlist_uri.startswith("spotify:playlist:"):
+        return None
+    try:
+        snapshot = _known_snapshots.peek(playlist_id_from_uri(playlist_uri))
+    except ValueError:
+        return None
+    return snapshot.total_duration_ms / 1000 if snapshot else None
+
+
+async def get_playlist_snapshot(playlist: str, user_id: str = DEFAULT_USER) -> PlaylistSnapshot:
+    """
+    Returns the track list of a playlist, from memory while fresh.
+
+    Args:
+        - playlist (str): Playlist id, URI or URL.
+        - user_id (str): Whose session makes the request on a miss; snapshots
+          are shared by all users.
+    """
+    playlist_id = playlist_id_from_uri(playlist)
+    return await playlist_snapshots.get_or_load(playlist_id, lambda: _load_snapshot(playlist_id, user_id))
+
+
+async def _load_snapshot(playlist_id: str, user_id: str) -> PlaylistSnapshot:
+    """Revalidates the last known snapshot by snapshot_id, fetching every track only if it changed."""
+    client = get_spotify_client(user_id)
+    known = _known_snapshots.get(playlist_id)
+    if known is not None:
+        current = await client.playlist(playlist_id, fields="snapshot_id")
+        if current.get("snapshot_id") == known.snapshot_id:
+            SNAPSHOT_LOADS.labels(result="unchanged").inc()
+            logging.debug(f"Playlist {playlist_id} unchanged at snapshot {known.snapshot_id}.")
+            _known_snapshots.set(playlist_id, known)
+            return known
+
+    snapshot = await _fetch_snapshot(client, playlist_id)
+    SNAPSHOT_LOADS.labels(result="changed" if known is not None else "new").inc()
+    _known_snapshots.set(playlist_id, snapshot)
+    return snapshot
+
+
+@timed(SNAPSHOT_FETCH_SECONDS)
+async def _fetch_snapshot(client, playlist_id: str) -> PlaylistSnapshot:
+    """
+    Fetches the playlist with its first page of tracks, then the remaining
+    pages concurrently (at most PAGE_CONCURRENCY at a time).
+    """
+    playlist = await client.playlist(playlist_id, fields=PLAYLIST_FIELDS)
+    first_page = playlist.get("tracks") or {}
+    total = first_page.get("total", 0)
+    items = list(first_page.get("items") or [])
+
+    semaphore = asyncio.Semaphore(PAGE_CONCURRENCY)
+
+    async def fetch_page(offset):
+        async with semaphore:
+            page = await client.playlist_tracks(playlist_id, offset=offset, limit=TRACK_PAGE_SIZE, fields=PAGE_FIELDS)
+        return page.get("items") or []
+
+    pages = await asyncio.gather(*(fetch_page(offset) for offset in range(len(items), total, TRACK_PAGE_SIZE)))
+    for page in pages:
+        items.extend(page)
+    return PlaylistSnapshot(playlist_id, playlist.get("snapshot_id"), playlist.get("name"),
+                            (item.get("track") for item in items if item))
+
+
+async def refresh_playlist_snapshot(playlist: str, user_id: str = DEFAULT_USER) -> PlaylistSnapshot:
+    """Revalidates a playlist now, e.g. ahead of a scheduled programme; unchanged playlists cost one request."""
+    playlist_id = playlist_id_from_uri(playlist)
+    playlist_snapshots.delete(playlist_id)
+    return await get_playlist_snapshot(playlist_id, user_id)
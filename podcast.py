@@ -1,26 +1,93 @@
 from fastapi import HTTPException
 import logging
-import spotipy
+import os
+from spotify_async import SpotifyAPIError
+from cache import TTLCache
+from metrics import Counter, Histogram, register_cache, timed
 
-def search_podcast(sp, refresh_token_if_needed, query: str):
-    refresh_token_if_needed()
-    if not sp:
+SEARCH_PODCAST_SECONDS = Histogram("search_podcast_seconds", "Time to answer a podcast search.")
+PREFIX_REUSES = Counter("podcast_search_prefix_reuses_total", "Searches answered from a cached shorter query.")
+
+PODCAST_CACHE_TTL = float(os.getenv("PODCAST_CACHE_TTL", "600"))
+
+RESULT_LIMIT = 5
+SEARCH_PAGE_SIZE = 20  # Shows fetched per Spotify request
+MAX_SEARCH_OFFSET = 1000  # Spotify does not page search results beyond this
+MIN_PREFIX_LENGTH = 3
+
+# "<offset>:<normalized query>" -> {"items": [...], "total": int}
+search_cache = TTLCache(maxsize=2048, ttl=PODCAST_CACHE_TTL)
+register_cache("podcast_search", search_cache)
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+async def get_search_page(client, query: str, offset: int = 0):
+    """Returns one cached page of show results for a normalized query."""
+    return await search_cache.get_or_load(f"{offset}:{query}", lambda: _fetch_page(client, query, offset))
+
+async def _fetch_page(client, query: str, offset: int):
+    search_results = await client.search(query, search_type="show", limit=SEARCH_PAGE_SIZE, offset=offset)
+    shows = search_results.get('shows', {})
+    items = [{
+        "name": podcast['name'],
+        "description": podcast['description'],
+        "url": podcast['external_urls']['spotify']
+    } for podcast in shows.get('items', []) if podcast]
+    return {"items": items, "total": shows.get('total', len(items))}
+
+def _items_from_prefix(query: str):
+    """
+    Answers a query from the cached first page of a shorter query it extends
+    ("dail" -> "daily") by filtering that page. Only used when the cached page
+    holds every result of the shorter query, or when the filtered page still
+    fills a full response.
+    """
+    tokens = query.split()
+    for end in range(len(query) - 1, MIN_PREFIX_LENGTH - 1, -1):
+        page = search_cache.peek(f"0:{query[:end]}")
+        if page is None:
+            continue
+        matches = [item for item in page["items"]
+                   if all(token in f"{item['name']} {item['description']}".lower() for token in tokens)]
+        if page["total"] <= len(page["items"]) or len(matches) >= RESULT_LIMIT:
+            PREFIX_REUSES.inc()
+            return matches
+    return None
+
+async def iter_podcasts(client, query: str, max_results: int = MAX_SEARCH_OFFSET):
+    """
+    Lazily yields shows for a query, fetching the next page only when the
+    consumer asks for more results.
+    """
+    query = normalize_query(query)
+    offset = 0
+    while offset < max_results:
+        page = await get_search_page(client, query, offset)
+        for item in page["items"][:max_results - offset]:
+            yield item
+        offset += SEARCH_PAGE_SIZE
+        if not page["items"] or offset >= min(page["total"], MAX_SEARCH_OFFSET):
+            break
+
+@timed(SEARCH_PODCAST_SECONDS)
+async def search_podcast(client, query: str):
+    if not client:
         raise HTTPException(status_code=500, detail="Spotify client is not initialized")
 
+    query = normalize_query(query)
     try:
-        search_results = sp.search(q=query, type="show", limit=5)
-        podcasts = search_results.get('shows', {}).get('items', [])
+        podcasts = None
+        if search_cache.peek(f"0:{query}") is None:
+            podcasts = _items_from_prefix(query)
+        if podcasts is None:
+            podcasts = (await get_search_page(client, query))["items"]
+
         if not podcasts:
             return {"message": "No podcasts found for the query."}
 
-        podcast_list = [{
-            "name": podcast['name'],
-            "description": podcast['description'],
-            "url": podcast['external_urls']['spotify']
-        } for podcast in podcasts]
-
-        return {"podcasts": podcast_list}
+        return {"podcasts": podcasts[:RESULT_LIMIT]}
 
-    except spotipy.exceptions.SpotifyException as e:
+    except SpotifyAPIError as e:
         logging.error(f"Spotify API error: {str(e)}")
         raise HTTPException(status_code=500, detail="Spotify API error")
\ No newline at end of file
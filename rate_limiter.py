@@ -0,0 +1,108 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+import logging
+from metrics import Counter, Histogram
+
+# Lower values are served first.
+PRIORITY_PLAYBACK = 0
+PRIORITY_BACKGROUND = 1
+
+RATE_LIMIT_WAIT_SECONDS = Histogram("spotify_rate_limit_wait_seconds",
+                                    "Time Spotify requests spent queued in the rate limiter.", ("priority",))
+RATE_LIMIT_PAUSES = Counter("spotify_rate_limit_pauses_total", "Global pauses triggered by 429 Retry-After.")
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every Spotify request of the process.
+
+    Requests acquire a token before they are sent. When the bucket is empty
+    (or the limiter is paused), they queue by priority and are released in
+    order as tokens refill, so playback starts overtake queued browse/search
+    calls. A 429 calls `pause(retry_after)`, which holds back *all* requests
+    until Spotify's Retry-After has passed, instead of each request retrying
+    on its own schedule.
+    """
+
+    def __init__(self, rate: float = 50, burst: int = 50, jitter: float = 0.25):
+        """
+        Args:
+            - rate (float): Tokens added per second; 0 disables the bucket
+              (pauses and priorities still apply).
+            - burst (int): Bucket capacity.
+            - jitter (float): Max random seconds added to a pause, so that
+              separate processes do not resume in lock-step.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.jitter = jitter
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._pump = None
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def pause(self, seconds: float):
+        """Stops releasing requests for `seconds` (plus jitter)."""
+        until = time.monotonic() + seconds + random.uniform(0, self.jitter)
+        if until > self._paused_until:
+            self._paused_until = until
+            # Drain the bucket so requests resume at `rate` after the pause
+            # rather than as a full burst straight back into the limit.
+            self._tokens = 0.0
+            self._updated = until
+            RATE_LIMIT_PAUSES.inc()
+            logging.warning(f"Spotify rate limit hit, pausing requests for {seconds:.1f} seconds.")
+
+    async def acquire(self, priority: int = PRIORITY_BACKGROUND):
+        """Waits until a request with this priority may be sent."""
+        if not self._waiters and self._try_take():
+            RATE_LIMIT_WAIT_SECONDS.labels(priority=priority).observe(0)
+            return
+
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.ensure_future(self._release_waiters())
+        try:
+            await future
+        finally:
+            RATE_LIMIT_WAIT_SECONDS.labels(priority=priority).observe(time.monotonic() - start)
+
+    def _try_take(self) -> bool:
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        if self.rate <= 0:
+            return True
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def _release_waiters(self):
+        while self._waiters:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            if not self._try_take():
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            while future.done() and self._waiters:
+                # The caller gave up (cancelled); hand the token to the next one.
+                _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
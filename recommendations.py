@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import os
+import time
+from ai import get_ai_playlist_recommendation, get_ai_podcast_recommendation, normalize_key
+from audit_log import audit_log
+from cache import TTLCache
+from metrics import Counter, Histogram, register_cache
+from mood_engine import mood_engine
+from scheduled_playback import get_spotify_playlists
+from scheduler import is_leader
+from token_manager import DEFAULT_USER
+
+# How often the table is recomputed, and how long an entry is served after
+# its last successful refresh.
+RECOMMENDATION_REFRESH_SECONDS = float(os.getenv("RECOMMENDATION_REFRESH_SECONDS", "1800"))
+RECOMMENDATION_MAX_AGE = float(os.getenv("RECOMMENDATION_MAX_AGE", "7200"))
+RECOMMENDATION_SNAPSHOT_PATH = os.getenv("RECOMMENDATION_SNAPSHOT_PATH", "recommendations.json")
+# Only the scheduler leader precomputes; the other workers re-read its snapshot this often.
+RECOMMENDATION_RELOAD_SECONDS = float(os.getenv("RECOMMENDATION_RELOAD_SECONDS", "30"))
+
+# Precomputed on top of the time-of-day moods (comma-separated).
+RECOMMENDATION_MOODS = [m for m in os.getenv("RECOMMENDATION_MOODS", "").split(",") if m.strip()]
+RECOMMENDATION_PODCAST_SUBJECTS = [s for s in os.getenv("RECOMMENDATION_PODCAST_SUBJECTS", "").split(",") if s.strip()]
+
+PRECOMPUTE_CONCURRENCY = 4
+
+# Hedged mode: a request whose AI answer takes longer than this also asks
+# Spotify and returns whichever valid answer arrives first. 0 disables it.
+AI_HEDGE_SECONDS = float(os.getenv("AI_HEDGE_SECONDS", "0"))
+
+# Fallback answers are kept shorter, so the mood goes back to AI soon.
+RECOMMENDATION_FALLBACK_TTL = float(os.getenv("RECOMMENDATION_FALLBACK_TTL", "300"))
+
+# "mood:<mood>" / "podcast:<subject>" -> the response served by the route.
+# Only the scheduler leader writes the snapshot; the other workers reload it.
+recommendation_table = TTLCache(maxsize=1024, ttl=RECOMMENDATION_MAX_AGE, path=RECOMMENDATION_SNAPSHOT_PATH,
+                                save_if=is_leader)
+register_cache("recommendations", recommendation_table)
+
+PRECOMPUTE_SECONDS = Histogram(
+    "recommendation_precompute_seconds", "Duration of a full recommendation precompute run.",
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+HEDGED_ANSWERS = Counter("recommendation_hedged_answers_total", "Requests answered by the hedged Spotify fallback.")
+
+
+def precomputed_moods() -> list:
+    """Returns the moods kept in the table: every mood of the default mood rules plus RECOMMENDATION_MOODS."""
+    moods = mood_engine.default_moods() + RECOMMENDATION_MOODS
+    return list(dict.fromkeys(normalize_key(mood) for mood in moods))
+
+async def _ai_playlists(mood: str, user_id: str):
+    try:
+        return await get_ai_playlist_recommendation(mood, user_id=user_id)
+    except Exception as e:
+        logging.error(f"AI Playlist Request Failed: {e}, using Spotify instead.")
+        return None
+
+async def _compute_mood(mood: str, user_id: str = DEFAULT_USER, hedge_seconds: float = 0):
+    """
+    Verified AI playlists for the mood, falling back to Spotify's category
+    playlists when Gemini fails or none of its suggestions exist.
+
+    Args:
+        - hedge_seconds (float): If > 0 and the AI answer is not ready by
+          then, Spotify is asked in parallel and the first valid answer wins.
+    """
+    if hedge_seconds <= 0:
+        ai_playlist = await _ai_playlists(mood, user_id)
+        if ai_playlist:
+            return ai_playlist
+        logging.warning(f"AI failed for mood '{mood}', falling back to Spotify.")
+        return await get_spotify_playlists(mood, user_id=user_id)
+
+    ai_task = asyncio.ensure_future(_ai_playlists(mood, user_id))
+    done, _ = await asyncio.wait({ai_task}, timeout=hedge_seconds)
+    if done and ai_task.result():
+        return ai_task.result()
+
+    fallback_task = asyncio.ensure_future(get_spotify_playlists(mood, user_id=user_id))
+    pending = {ai_task, fallback_task} - done
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if ai_task in done and ai_task.result():
+                return ai_task.result()
+            if fallback_task in done and not fallback_task.exception() and fallback_task.result():
+                HEDGED_ANSWERS.inc()
+                return fallback_task.result()
+        # Neither gave a valid answer: surface the Spotify outcome, as without hedging.
+        return fallback_task.result()
+    finally:
+        # The AI recommendation keeps loading in its cache behind a shield, so
+        # a late answer is still there for the next request.
+        for task in pending:
+            task.cancel()
+
+def _mood_ttl(result):
+    """Spotify fallback lists expire after RECOMMENDATION_FALLBACK_TTL, AI answers after the table's max age."""
+    return None if isinstance(result, dict) else RECOMMENDATION_FALLBACK_TTL
+
+async def mood_recommendation(mood: str, user_id: str = DEFAULT_USER):
+    """
+    Returns the playlists for a mood from the precomputed table. A mood that
+    is not in the table is computed on the request path (hedged when
+    AI_HEDGE_SECONDS is set) and then kept.
+
+    Args:
+        - mood (str): Any mood; it is normalized before lookup.
+        - user_id (str): Whose session makes Spotify calls on a cold miss.
+
+    Returns:
+        - The AI recommendation dict, or a list of Spotify playlists.
+    """
+    mood = normalize_key(mood)
+    key = f"mood:{mood}"
+    precomputed = recommendation_table.peek(key) is not None
+    start = time.perf_counter()
+    try:
+        result = await recommendation_table.get_or_load(
+            key, lambda: _compute_mood(mood, user_id, hedge_seconds=AI_HEDGE_SECONDS),
+            ttl=_mood_ttl,
+        )
+    except Exception as e:
+        audit_log.record("recommendation", user_id, key, "failed", time.perf_counter() - start, error=str(e))
+        raise
+    audit_log.record("recommendation", user_id, key, "ai" if isinstance(result, dict) else "spotify",
+                     time.perf_counter() - start, precomputed=precomputed)
+    return result
+
+async def podcast_recommendation(subject: str, user_id: str = DEFAULT_USER):
+    """Returns the AI podcast recommendation for a subject, precomputed when possible (audited for `user_id`)."""
+    subject = normalize_key(subject)
+    key = f"podcast:{subject}"
+    result = recommendation_table.get(key)
+    precomputed = result is not None
+    start = time.perf_counter()
+    if result is None:
+        result = await get_ai_podcast_recommendation(subject)
+        if "error" not in result:
+            recommendation_table.set(key, result)
+    audit_log.record("recommendation", user_id, key, "failed" if "error" in result else "ai",
+                     time.perf_counter() - start, precomputed=precomputed)
+    return result
+
+async def reload_recommendations():
+    """Picks up the table written by the worker process that precomputes it."""
+    recommendation_table.reload()
+
+async def precompute_recommendations():
+    """
+    Recomputes every precomputed mood and podcast subject and writes a
+    snapshot of the table. Entries that fail keep their previous value
+    until RECOMMENDATION_MAX_AGE; moods answered by the Spotify fallback are
+    kept for RECOMMENDATION_FALLBACK_TTL only, as on the request path.
+    """
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(PRECOMPUTE_CONCURRENCY)
+
+    async def refresh(key, compute, ttl=None):
+        async with semaphore:
+            try:
+                result = await compute()
+            except Exception as e:
+                logging.error(f"Precomputing {key} failed: {e}")
+                return False
+        if isinstance(result, dict) and "error" in result:
+            logging.error(f"Precomputing {key} failed: {result['error']}")
+            return False
+        recommendation_table.set(key, result, ttl(result) if ttl else None)
+        return True
+
+    tasks = [refresh(f"mood:{mood}", lambda mood=mood: _compute_mood(mood), _mood_ttl) for mood in precomputed_moods()]
+    tasks += [
+        refresh(f"podcast:{subject}", lambda subject=subject: get_ai_podcast_recommendation(subject))
+        for subject in dict.fromkeys(normalize_key(s) for s in RECOMMENDATION_PODCAST_SUBJECTS)
+    ]
+    results = await asyncio.gather(*tasks)
+    await asyncio.to_thread(recommendation_table.save)
+
+    elapsed = time.perf_counter() - start
+    PRECOMPUTE_SECONDS.observe(elapsed)
+    logging.info(f"Precomputed {sum(results)}/{len(results)} recommendations in {elapsed:.1f}s")
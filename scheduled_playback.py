@@ -1,193 +1,314 @@
-from datetime import datetime
-from spotipy.oauth2 import SpotifyOAuth
-import spotipy
+import asyncio
 import os
-import logging
-from requests.exceptions import ConnectionError
-import urllib3
 import time
-import requests
+import logging
+from spotify_async import SpotifyAPIError, get_spotify_client
+from audit_log import audit_log
+from cache import TTLCache
+from metrics import Counter, Histogram, register_cache, timed
+from playback_state import SKIPPED_PLAYBACKS, playback_tracker
+from token_manager import DEFAULT_USER, refresh_token_if_needed
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-sp_oauth = SpotifyOAuth(
-    client_id=os.getenv("SPOTIPY_CLIENT_ID"),
-    client_secret=os.getenv("SPOTIPY_CLIENT_SECRET"),
-    redirect_uri=os.getenv("SPOTIPY_REDIRECT_URI"),
-    scope="user-modify-playback-state user-read-playback-state user-read-currently-playing"
-)
+SPOTIFY_SCOPE = "user-modify-playback-state user-read-playback-state user-read-currently-playing"
 
-print(os.getenv("SPOTIPY_CLIENT_ID"))
-print(os.getenv("SPOTIPY_CLIENT_SECRET"))
-print(os.getenv("SPOTIPY_REDIRECT_URI"))
+_sp_oauth = None
 
-sp = None 
+# Start hour of each time-of-day window and the mood played during it; the
+# default rules of the mood engine (see mood_engine.py).
+MOOD_WINDOWS = [
+    (6, "energy boost"),  # Morning vibes ☀️
+    (12, "focus"),  # Work & study time 🎯
+    (18, "chill"),  # Wind-down & relax 🌆
+    (22, "sleep"),  # Night-time calming music 😴
+]
 
-def initialize_spotify_client():
-    """Initialize the Spotify client."""
-    global sp
-    sp = spotipy.Spotify(auth_manager=sp_oauth)
-    logging.info("Spotify client initialized successfully.")
+PLAYLIST_CACHE_TTL = float(os.getenv("PLAYLIST_CACHE_TTL", "900"))
+PREFETCH_LEAD_SECONDS = int(os.getenv("PREFETCH_LEAD_SECONDS", "120"))
 
-import os
-import logging
-from spotify_client import load_token_info, save_token_info, clear_token_info
-import requests
-from scheduled_playback import sp_oauth
+# "<category>:<limit>" -> playlists, and the ETag they were served with.
+category_cache = TTLCache(maxsize=128, ttl=PLAYLIST_CACHE_TTL)
+_category_validators = TTLCache(maxsize=128, ttl=86400)
+
+DEVICE_CACHE_TTL = float(os.getenv("DEVICE_CACHE_TTL", "60"))
+DEVICE_REFRESH_SECONDS = float(os.getenv("DEVICE_REFRESH_SECONDS", "30"))
 
-SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
+# user id -> device list, kept fresh by refresh_devices in the background.
+device_cache = TTLCache(maxsize=1024, ttl=DEVICE_CACHE_TTL)
 
-def refresh_token_if_needed():
+# start_playback calls in flight at once for a fan-out playback (one schedule
+# playing on a group of devices, see play_fanout).
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "100"))
+
+register_cache("category_playlists", category_cache)
+register_cache("devices", device_cache)
+
+PLAY_PLAYLIST_SECONDS = Histogram("play_playlist_seconds", "Time to start playback of a playlist.")
+GET_PLAYLISTS_SECONDS = Histogram("get_spotify_playlists_seconds", "Time to resolve playlists for a mood.")
+FANOUT_SPREAD_SECONDS = Histogram(
+    "fanout_spread_seconds", "Time between the first and the last device starting in a fan-out playback.",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+FANOUT_STARTS = Counter("fanout_starts_total", "Device starts of fan-out playbacks by outcome.", ("outcome",))
+
+def get_oauth():
     """
-    Refreshes the Spotify access token if it's expired.
-    If the refresh token is invalid, forces user to log in again.
+    Returns the shared SpotifyOAuth helper, creating it on first use.
+    spotipy is only imported here, so it is not loaded until the OAuth flow needs it.
     """
-    token_info = load_token_info()
-    
-    if not token_info:
-        logging.warning("No token info found. User must log in.")
+    global _sp_oauth
+    if _sp_oauth is None:
+        from spotipy.oauth2 import SpotifyOAuth
+        _sp_oauth = SpotifyOAuth(
+            client_id=os.getenv("SPOTIPY_CLIENT_ID"),
+            client_secret=os.getenv("SPOTIPY_CLIENT_SECRET"),
+            redirect_uri=os.getenv("SPOTIPY_REDIRECT_URI"),
+            scope=SPOTIFY_SCOPE
+        )
+    return _sp_oauth
+
+async def get_devices(user_id: str = DEFAULT_USER):
+    """Returns the user's Spotify devices, from device_cache while fresh."""
+    return await device_cache.get_or_load(user_id, lambda: get_spotify_client(user_id).devices())
+
+async def refresh_devices(user_id: str = DEFAULT_USER):
+    """Fetches the device list and stores it in device_cache. Returns None on failure."""
+    try:
+        devices = await get_spotify_client(user_id).devices()
+    except Exception as e:
+        logging.debug(f"Device refresh failed: {e}")
         return None
+    device_cache.set(user_id, devices)
+    return devices
 
-    expires_at = token_info.get("expires_at", 0)
-    refresh_token = token_info.get("refresh_token")
-    
-    if not refresh_token:
-        logging.error("No refresh token available. User must re-authenticate.")
-        clear_token_info()  # Delete invalid token
-        return None  # Force login
-
-    # Check if token is expired
-    from datetime import datetime
-    if datetime.now().timestamp() < expires_at:
-        logging.info("Token is still valid.")
-        return token_info
-
-    logging.info("Access token expired. Refreshing...")
-
-    # Attempt to refresh the token
-    payload = {
-        "grant_type": "refresh_token",
-        "refresh_token": refresh_token,
-        "client_id": sp_oauth.client_id,
-        "client_secret": sp_oauth.client_secret,
-    }
+def pick_device(devices):
+    """Prefers the active device, otherwise the first one available."""
+    for device in devices:
+        if device.get("is_active"):
+            return device["id"]
+    return devices[0]["id"]
 
-    response = requests.post(SPOTIFY_TOKEN_URL, data=payload)
+async def prepare_playback(playlist_uri, user_id: str = DEFAULT_USER, targets=None):
+    """
+    Pre-fire hook for scheduled jobs: refreshes the user's token, resolves the
+    target device, warms a pooled connection and looks up what is playing
+    (shared with other consumers of the playback state). Returns the keyword
+    arguments for play_playlist. Fan-out jobs (with `targets`) are prepared by
+    prepare_fanout instead.
+    """
+    if targets:
+        await prepare_fanout(targets)
+        return {}
+    await refresh_token_if_needed(user_id)
+    devices, state = await asyncio.gather(refresh_devices(user_id), playback_tracker.get(user_id),
+                                          return_exceptions=True)
+    context = {"skip_if_playing": not isinstance(state, Exception)}
+    if devices and not isinstance(devices, Exception):
+        context["device_id"] = pick_device(devices)
+    return context
+
+async def prepare_fanout(targets):
+    """
+    Pre-fire hook for fan-out jobs: refreshes the token of every account in
+    `targets` and opens a pooled connection per start_playback call that will
+    be in flight, so the starts skip token refreshes and handshakes.
+    """
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
 
-    if response.status_code == 200:
-        new_token_info = response.json()
-        new_token_info["expires_at"] = datetime.now().timestamp() + new_token_info["expires_in"]
-        save_token_info(new_token_info)
-        logging.info("Token refreshed successfully.")
-        return new_token_info
+    async def refresh(user_id):
+        async with semaphore:
+            await refresh_token_if_needed(user_id)
 
-    elif response.status_code == 400 and "invalid_grant" in response.text:
-        logging.error("Refresh token revoked. User must log in again.")
-        clear_token_info()  # Delete old token to force new login
-        return None
+    accounts = dict.fromkeys(user_id for user_id, _ in targets)
+    await asyncio.gather(*(refresh(user_id) for user_id in accounts), return_exceptions=True)
+    await get_spotify_client().warm_connections(min(len(targets), FANOUT_CONCURRENCY))
 
-    else:
-        logging.error(f"Token refresh failed: {response.text}")
-        return None
+def _playback_body(playlist_uri: str) -> dict:
+    if playlist_uri.startswith(("spotify:playlist:", "spotify:album:", "spotify:artist:")):
+        return {"context_uri": playlist_uri}
+    return {"uris": [playlist_uri]}
 
-def play_playlist(playlist_uri, retry_count=3, delay=5):
-    global sp
+async def play_fanout(playlist_uri: str, targets, retry_count=3, delay=5):
+    """
+    Starts the same playback on a group of devices, possibly of several
+    accounts, with at most FANOUT_CONCURRENCY start_playback calls in flight.
 
-    if not sp:
-        initialize_spotify_client() 
+    Args:
+        - targets: List of (user_id, device_id) pairs.
 
-    refresh_token_if_needed()
-    if not isinstance(sp, spotipy.Spotify):
-        raise Exception("Spotify client is not initialized.")
+    Returns:
+        - Dict with the number of 'devices' and 'started', the 'failed'
+          devices with their error, and 'first_ms' / 'last_ms' / 'spread_ms':
+          when the first and the last device started, measured from the
+          start of the fan-out, and the time between them.
 
+    Raises the first error if no device started.
+    """
+    body = _playback_body(playlist_uri)
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+    begin = time.perf_counter()
+
+    async def start(user_id, device_id):
+        async with semaphore:
+            await get_spotify_client(user_id).start_playback(device_id=device_id, retry_count=retry_count,
+                                                             delay=delay, **body)
+        return time.perf_counter() - begin
+
+    results = await asyncio.gather(*(start(user_id, device_id) for user_id, device_id in targets),
+                                   return_exceptions=True)
+    started = []
+    failed = []
+    for (user_id, device_id), result in zip(targets, results):
+        if isinstance(result, Exception):
+            failed.append({"user_id": user_id, "device_id": device_id, "error": str(result)})
+        else:
+            started.append(result)
+            playback_tracker.record_playback(user_id, playlist_uri, device_id)
+    FANOUT_STARTS.labels(outcome="started").inc(len(started))
+    FANOUT_STARTS.labels(outcome="failed").inc(len(failed))
+    if not started:
+        audit_log.record("fanout", targets[0][0], playlist_uri, "failed", time.perf_counter() - begin,
+                         devices=len(targets), failed=len(failed))
+        logging.error(f"Fan-out of {playlist_uri} failed on all {len(targets)} devices.")
+        raise next(result for result in results if isinstance(result, Exception))
+
+    first, last = min(started), max(started)
+    FANOUT_SPREAD_SECONDS.observe(last - first)
+    audit_log.record("fanout", targets[0][0], playlist_uri, "partial" if failed else "started",
+                     time.perf_counter() - begin, devices=len(targets), failed=len(failed),
+                     spread_ms=round((last - first) * 1000, 1))
+    if failed:
+        logging.warning(f"Fan-out of {playlist_uri} failed on {len(failed)} of {len(targets)} devices.")
+    logging.debug(f"Started {playlist_uri} on {len(started)} devices within {(last - first) * 1000:.0f}ms.")
+    return {
+        "devices": len(targets),
+        "started": len(started),
+        "failed": failed,
+        "first_ms": round(first * 1000, 1),
+        "last_ms": round(last * 1000, 1),
+        "spread_ms": round((last - first) * 1000, 1),
+    }
+
+@timed(PLAY_PLAYLIST_SECONDS)
+async def play_playlist(playlist_uri, retry_count=3, delay=5, device_id=None, user_id: str = DEFAULT_USER,
+                        skip_if_playing: bool = False, targets=None):
+    """
+    Starts playback of a playlist, album, artist or track URI.
+    With skip_if_playing, nothing is sent when a recent playback state shows
+    the URI already playing. With `targets`, a list of (user_id, device_id)
+    pairs, it starts on all of them at once instead (see play_fanout).
+    """
     if not playlist_uri or not isinstance(playlist_uri, str):
         raise ValueError("Invalid playlist URI provided.")
 
-    devices = None
-    for attempt in range(retry_count):
+    if targets:
+        return await play_fanout(playlist_uri, targets, retry_count=retry_count, delay=delay)
+
+    if skip_if_playing and playback_tracker.is_playing(user_id, playlist_uri):
+        SKIPPED_PLAYBACKS.inc()
+        audit_log.record("play", user_id, playlist_uri, "skipped")
+        logging.debug(f"{playlist_uri} is already playing, skipping start_playback.")
+        return
+
+    client = get_spotify_client(user_id)
+    start = time.perf_counter()
+
+    if device_id is None:
         try:
-            devices = sp.devices()
-            if devices['devices']:
-                break
-            else:
-                raise Exception("No active Spotify devices available for playback.")
-        except requests.exceptions.ConnectionError as e:
-            logging.error(f"Connection error: {e}. Attempt {attempt + 1} of {retry_count}.")
-            if attempt < retry_count - 1:
-                time.sleep(delay)
-            else:
-                logging.error("Max retries reached. Unable to fetch devices.")
-                raise
+            devices = await get_devices(user_id)
         except Exception as e:
+            audit_log.record("play", user_id, playlist_uri, "failed", time.perf_counter() - start, error=str(e))
             logging.error(f"Unexpected error while fetching devices: {e}")
             raise
+        if not devices:
+            audit_log.record("play", user_id, playlist_uri, "failed", time.perf_counter() - start,
+                             error="no devices")
+            raise Exception("No active Spotify devices available for playback.")
+        device_id = pick_device(devices)
+
+    body = _playback_body(playlist_uri)
+    requested_device = device_id
 
-    for attempt in range(retry_count):
+    try:
         try:
-            if playlist_uri.startswith(("spotify:playlist:", "spotify:album:", "spotify:artist:")):
-                sp.start_playback(context_uri=playlist_uri)
-            else:
-                sp.start_playback(uris=[playlist_uri])
-
-            logging.info(f"Started playback for {playlist_uri}")
-            return
-        except (ConnectionError, urllib3.exceptions.ProtocolError, 
-                urllib3.exceptions.MaxRetryError, spotipy.exceptions.SpotifyException) as e:
-            logging.error(f"Failed to start playback (Attempt {attempt + 1}/{retry_count}): {str(e)}")
-            if attempt < retry_count - 1:
-                logging.warning(f"Retrying in {delay * (2 ** attempt)} seconds...")
-                time.sleep(delay * (2 ** attempt))
-            else:
-                logging.error("Max retry attempts reached. Playback failed.")
+            await client.start_playback(device_id=device_id, retry_count=retry_count, delay=delay, **body)
+        except SpotifyAPIError as e:
+            if e.status_code != 404:
                 raise
-        except Exception as e:
-            logging.error(f"Unexpected error: {e}")
-            raise
-
-def get_spotify_playlists(mood: str, limit: int = 5):
+            # The cached device went away; let Spotify pick one instead.
+            device_cache.delete(user_id)
+            device_id = None
+            await client.start_playback(retry_count=retry_count, delay=delay, **body)
+    except Exception as e:
+        audit_log.record("play", user_id, playlist_uri, "failed", time.perf_counter() - start,
+                         device_id=requested_device, error=str(e))
+        logging.error(f"Failed to start playback for {playlist_uri}: {e}")
+        raise
+
+    audit_log.record("play", user_id, playlist_uri, "started", time.perf_counter() - start,
+                     device_id=requested_device, device_fallback=device_id is None)
+    playback_tracker.record_playback(user_id, playlist_uri, device_id)
+    logging.debug(f"Started playback for {playlist_uri}")
+
+@timed(GET_PLAYLISTS_SECONDS)
+async def get_spotify_playlists(mood: str, limit: int = 5, user_id: str = DEFAULT_USER):
     """
     Fetches Spotify playlists based on the provided mood.
+    Results are served from category_cache while fresh.
 
     Args:
         - mood (str): The mood/category (e.g., 'focus', 'workout', 'chill').
         - limit (int): Number of playlists to fetch.
+        - user_id (str): Whose session makes the request on a cache miss; the
+          cached playlists are shared by all users.
 
     Returns:
         - List of playlist dictionaries with 'name', 'uri', and 'url'.
     """
-    token_info = refresh_token_if_needed()  # Ensure we have a fresh token
-    if not token_info:
-        raise Exception("Spotify authentication required. Please log in.")
-
-    token = token_info["access_token"]
-
-    url = f"https://api.spotify.com/v1/browse/categories/{mood.lower()}/playlists"
-    headers = {"Authorization": f"Bearer {token}"}
-
-    response = requests.get(url, headers=headers, params={"limit": limit})
-
-    if response.status_code == 200:
-        playlists = response.json().get("playlists", {}).get("items", [])
-        if not playlists:
-            logging.warning(f"No playlists found for mood: {mood}. Trying fallback categories.")
-            return get_spotify_playlists("chill")  # Fallback to a general mood
-
-        return [{"name": p["name"], "uri": p["uri"], "url": p["external_urls"]["spotify"]} for p in playlists]
+    category = mood.lower()
+    try:
+        playlists = await category_cache.get_or_load(
+            f"{category}:{limit}", lambda: _fetch_category_playlists(category, limit, user_id)
+        )
+    except SpotifyAPIError as e:
+        logging.error(f"Failed to fetch Spotify playlists: {e.message}")
+        raise
+
+    if not playlists and category != "chill":
+        logging.warning(f"No playlists found for mood: {mood}. Trying fallback categories.")
+        return await get_spotify_playlists("chill", user_id=user_id)  # Fallback to a general mood
+
+    return playlists
+
+async def _fetch_category_playlists(category: str, limit: int, user_id: str = DEFAULT_USER):
+    """Fetches a category, revalidating with the last ETag when there is one."""
+    key = f"{category}:{limit}"
+    known = _category_validators.get(key)
+    items, etag = await get_spotify_client(user_id).category_playlists_if_changed(
+        category, limit=limit, etag=known["etag"] if known else None
+    )
+    if items is None:
+        logging.debug(f"Playlists for {category} not modified.")
+        playlists = known["playlists"]
+    else:
+        playlists = [{"name": p["name"], "uri": p["uri"], "url": p["external_urls"]["spotify"]} for p in items]
 
-    logging.error(f"Failed to fetch Spotify playlists: {response.text}")
-    raise Exception(f"Spotify API error: {response.status_code} - {response.text}")
+    if etag:
+        _category_validators.set(key, {"etag": etag, "playlists": playlists})
+    return playlists
 
-def get_time_based_mood():
+async def prefetch_mood_playlists(mood: str, limit: int = 5):
     """
-    Returns a recommended mood based on the current time of day.
+    Refreshes the cached playlists of a mood ahead of its time window, so the
+    entry stays warm for the first PLAYLIST_CACHE_TTL seconds of the window.
     """
-    hour = datetime.now().hour
-
-    if 6 <= hour < 12:
-        return "energy boost"  # Morning vibes ☀️
-    elif 12 <= hour < 18:
-        return "focus"  # Work & study time 🎯
-    elif 18 <= hour < 22:
-        return "chill"  # Wind-down & relax 🌆
-    else:
-        return "sleep"  # Night-time calming music 😴 
+    category = mood.lower()
+    key = f"{category}:{limit}"
+    try:
+        playlists = await _fetch_category_playlists(category, limit)
+    except Exception as e:
+        logging.error(f"Prefetch of playlists for {mood} failed: {e}")
+        return
+    category_cache.set(key, playlists, ttl=PREFETCH_LEAD_SECONDS + PLAYLIST_CACHE_TTL)
+    logging.info(f"Prefetched {len(playlists)} playlists for mood: {mood}")
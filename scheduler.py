@@ -1,27 +1,483 @@
-from apscheduler.triggers.date import DateTrigger
-from datetime import datetime
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from datetime import datetime, timedelta
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from audit_log import audit_log
+from dispatcher import Dispatcher
+from bisect import bisect_left
+from job_store import JobStore, JOB_STORE_PATH, SCHEDULE_MAX_SLOT_SECONDS, slot_end
+from leases import WORKER_ID
+from metrics import Counter, Histogram
+from playlist_snapshots import cached_duration
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import os
+import time
 
-scheduler = BackgroundScheduler()
+# How often each worker polls the job store for due jobs.
+POLL_INTERVAL_SECONDS = float(os.getenv("SCHEDULER_POLL_SECONDS", "1"))
 
-def start_scheduler():
+# "i/N": this worker only claims jobs from the i-th of N shards.
+SCHEDULER_SHARD = os.getenv("SCHEDULER_SHARD", "0/1")
+
+CLAIM_BATCH_SIZE = 100
+
+# With several worker processes on one job store (e.g. uvicorn --workers N),
+# only the holder of this lease claims jobs and runs the leader-only periodic
+# jobs; the others just serve requests. A leader that dies is replaced once
+# its lease has expired.
+LEADER_LEASE_SECONDS = float(os.getenv("SCHEDULER_LEADER_LEASE_SECONDS", "15"))
+
+# Jobs are claimed and prepared (token, device, connections) this many
+# seconds before they are due, so firing is a single start_playback call.
+PREFIRE_SECONDS = float(os.getenv("SCHEDULER_PREFIRE_SECONDS", "5"))
+
+# Max playbacks firing / preparing at once, and how late a job may still start.
+FIRE_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "100"))
+PREPARE_WORKERS = int(os.getenv("SCHEDULER_PREPARE_WORKERS", "16"))
+FIRE_DEADLINE_SECONDS = float(os.getenv("SCHEDULER_DEADLINE_SECONDS", "120"))
+
+JOB_SECONDS = Histogram("scheduler_job_seconds", "Execution time of scheduled playback jobs.")
+JOBS = Counter("scheduler_jobs_total", "Scheduled playback jobs by outcome.", ("outcome",))
+FIRE_SKEW_SECONDS = Histogram(
+    "scheduler_fire_skew_seconds", "Delay between a job's run_at and the start of its playback.",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+)
+
+# Fired one-off jobs (done or failed) are deleted after this many days; their
+# outcomes stay in the audit log.
+JOB_RETENTION_DAYS = float(os.getenv("JOB_RETENTION_DAYS", "7"))
+
+# Overlapping jobs listed in a conflict error.
+MAX_REPORTED_CONFLICTS = 10
+
+# Devices one fan-out schedule may play on.
+MAX_FANOUT_DEVICES = int(os.getenv("FANOUT_MAX_DEVICES", "1000"))
+
+
+class ScheduleConflict(Exception):
+    """Raised when a new schedule overlaps a playback the user already has scheduled."""
+
+    def __init__(self, conflicts):
+        super().__init__(f"Overlaps {len(conflicts)} scheduled playback(s).")
+        self.conflicts = conflicts
+
+scheduler = AsyncIOScheduler()
+job_store = None
+dispatcher = None
+
+_job_func = None
+_prepare_func = None
+_leader = False
+_finished = []  # (job_id, status, next_run_at) waiting to be written back
+
+
+def get_job_store() -> JobStore:
+    """Returns the job store, opening the database on first use."""
+    global job_store
+    if job_store is None:
+        job_store = JobStore(JOB_STORE_PATH)
+    return job_store
+
+
+def _parse_shard(value: str):
+    index, count = value.split("/")
+    return int(index), int(count)
+
+
+def _leader_lease() -> str:
+    # One leader per shard, so sharded workers keep splitting the jobs.
+    return f"scheduler-leader:{SCHEDULER_SHARD}"
+
+
+def is_leader() -> bool:
+    """Whether this process holds the scheduler lease of its shard."""
+    return _leader
+
+
+async def renew_leadership():
+    """Takes the scheduler lease if it is free or expired, or renews it if this process holds it."""
+    global _leader
+    leader = await asyncio.to_thread(get_job_store().acquire_lease, _leader_lease(), WORKER_ID, LEADER_LEASE_SECONDS)
+    if leader != _leader:
+        logging.info(f"{WORKER_ID} {'is now' if leader else 'is no longer'} the scheduler leader.")
+    _leader = leader
+
+
+def _leader_only(func):
+    """Wraps a periodic job so that it only runs in the leader process."""
+    @functools.wraps(func)
+    async def run(*args, **kwargs):
+        if _leader:
+            return await _call(func, *args, **kwargs)
+    return run
+
+
+def start_scheduler(job_func=None, prepare_func=None):
+    """
+    Starts the scheduler, which polls the job store, and the Dispatcher that
+    fires the claimed jobs. Must be called from the running event loop (e.g.
+    the FastAPI lifespan).
+
+    Args:
+        - job_func: Callable or coroutine function invoked with the playlist URI
+          and the `user_id` keyword of each due job, plus `targets` (a list
+          of (user_id, device_id) pairs) for fan-out jobs.
+        - prepare_func: Optional pre-fire hook, called the same way
+          PREFIRE_SECONDS before the job is due. It returns a dict of extra
+          keyword arguments for job_func.
+
+    Every process starts the scheduler, but only the one that wins the
+    leader lease dispatches jobs (see LEADER_LEASE_SECONDS).
+    """
+    global _job_func, _prepare_func, dispatcher, _leader
+    if job_func is not None:
+        _job_func = job_func
+    _prepare_func = prepare_func
+    _leader = get_job_store().acquire_lease(_leader_lease(), WORKER_ID, LEADER_LEASE_SECONDS)
+
+    dispatcher = Dispatcher(_fire_job, prepare=_prepare_job if prepare_func else None, on_done=_job_done,
+                            workers=FIRE_WORKERS, prepare_workers=PREPARE_WORKERS, deadline=FIRE_DEADLINE_SECONDS)
+    dispatcher.start()
+
+    scheduler.add_job(
+        dispatch_due_jobs,
+        IntervalTrigger(seconds=POLL_INTERVAL_SECONDS),
+        id="dispatch-due-jobs",
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True,
+    )
+    schedule_periodic(renew_leadership, LEADER_LEASE_SECONDS / 3, "renew-leadership")
     scheduler.start()
+    logging.info(f"Scheduler started as {WORKER_ID}{' (leader)' if _leader else ''} "
+                 f"({get_job_store().pending_count()} pending jobs).")
+
+def schedule_periodic(func, seconds: float, job_id: str, run_now: bool = False, leader_only: bool = False):
+    """
+    Runs `func` every `seconds` seconds, and right away with `run_now`. With
+    leader_only, it is skipped in every process but the scheduler leader
+    (for jobs whose work is shared by all workers).
+    """
+    # next_run_time=None would add the job paused, so it is only passed to run now.
+    extra = {"next_run_time": datetime.now()} if run_now else {}
+    scheduler.add_job(_leader_only(func) if leader_only else func, IntervalTrigger(seconds=seconds), id=job_id,
+                      max_instances=1, coalesce=True, replace_existing=True, **extra)
 
-def stop_scheduler():
+async def stop_scheduler():
+    global _leader
     scheduler.shutdown()
+    if dispatcher is not None:
+        # Jobs claimed in the prefire window but not fired yet go back to
+        # pending, so the next leader (or this one after a restart) fires them.
+        unfired = [job["id"] for job in dispatcher.unfired()]
+        await dispatcher.stop()
+        if unfired:
+            await asyncio.to_thread(get_job_store().release_claims, unfired, WORKER_ID)
+    await _flush_finished()
+    if _leader:
+        # Another worker can take over right away instead of after the lease expires.
+        await asyncio.to_thread(get_job_store().release_lease, _leader_lease(), WORKER_ID)
+        _leader = False
 
-def schedule_playlist(play_playlist, playlist_uri: str, play_time: str):
-    now = datetime.now()
+async def dispatch_due_jobs():
+    """
+    Records the outcomes of fired jobs, then, in the leader process, claims
+    every job due within PREFIRE_SECONDS and hands it to the dispatcher.
+    Claims are atomic as well, so a leader that lost its lease mid-claim
+    cannot fire a job twice. Jobs still claimed by a previous leader are
+    taken over as soon as it no longer holds the lease.
+    """
+    await _flush_finished()
+    if _job_func is None or dispatcher is None or not _leader:
+        return
+
+    shard_index, shard_count = _parse_shard(SCHEDULER_SHARD)
+    while True:
+        jobs = await asyncio.to_thread(
+            get_job_store().claim_due_jobs, WORKER_ID, limit=CLAIM_BATCH_SIZE, shard_index=shard_index,
+            shard_count=shard_count, horizon=PREFIRE_SECONDS, lease=_leader_lease(),
+        )
+        dispatcher.submit(jobs)
+        if len(jobs) < CLAIM_BATCH_SIZE:
+            break
+
+async def purge_finished_jobs():
+    """Deletes the fired one-off jobs older than JOB_RETENTION_DAYS from the job store."""
+    await asyncio.to_thread(get_job_store().purge_finished, time.time() - JOB_RETENTION_DAYS * 86400)
+
+async def _call(func, *args, **kwargs):
+    result = func(*args, **kwargs)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+def _job_arguments(job) -> dict:
+    arguments = {"user_id": job["user_id"]}
+    if job.get("targets"):
+        arguments["targets"] = json.loads(job["targets"])
+    return arguments
+
+async def _prepare_job(job):
+    return await _call(_prepare_func, job["playlist_uri"], **_job_arguments(job))
+
+async def _fire_job(job, **context):
+    start = time.perf_counter()
+    try:
+        await _call(_job_func, job["playlist_uri"], **_job_arguments(job), **context)
+    finally:
+        JOB_SECONDS.observe(time.perf_counter() - start)
+    skew = time.time() - job["run_at"]
+    FIRE_SKEW_SECONDS.observe(skew)
+    logging.debug(f"Job {job['id']} started playback {skew * 1000:.0f}ms after its scheduled time.")
+
+def _job_done(job, outcome: str):
+    JOBS.labels(outcome=outcome).inc()
+    audit_log.record("scheduled_play", job["user_id"], job["playlist_uri"], outcome, job_id=job["id"],
+                     run_at=job["run_at"], cron=job.get("cron"))
+    if job.get("cron"):
+        # Recurring jobs go back in the queue whether or not this run worked.
+        next_run = _cron_trigger(job["cron"]).get_next_fire_time(None, datetime.now().astimezone())
+        _finished.append((job["id"], "pending", next_run.timestamp()))
+    else:
+        _finished.append((job["id"], "done" if outcome == "success" else "failed", None))
+
+async def _flush_finished():
+    """Writes the outcomes collected since the last poll in one transaction."""
+    global _finished
+    if not _finished:
+        return
+    batch, _finished = _finished, []
+    await asyncio.to_thread(get_job_store().finish_many, batch)
+
+_cron_triggers = {}
+
+def _cron_trigger(expression: str) -> CronTrigger:
+    """Parses a crontab expression ("30 7 * * mon-fri"), memoized per expression."""
+    trigger = _cron_triggers.get(expression)
+    if trigger is None:
+        trigger = _cron_triggers[expression] = CronTrigger.from_crontab(expression)
+    return trigger
+
+def _next_play_time(play_time: str, now: datetime) -> datetime:
     play_time_obj = datetime.strptime(play_time, "%H:%M").replace(
         year=now.year, month=now.month, day=now.day
     )
     if play_time_obj < now:
-        play_time_obj = play_time_obj.replace(day=now.day + 1)
-    
-    trigger = DateTrigger(run_date=play_time_obj)
-    scheduler.add_job(play_playlist, trigger, args=[playlist_uri])
-    
+        play_time_obj += timedelta(days=1)
+    return play_time_obj
+
+def _slot_end(playlist_uri: str, run_at: float) -> float:
+    """End of a job's slot: run_at plus the playlist's length when its snapshot is cached."""
+    duration = cached_duration(playlist_uri)
+    return slot_end(run_at, run_at + duration if duration else None)
+
+def _describe_job(job: dict) -> dict:
+    description = {
+        "job_id": job["id"],
+        "playlist_uri": job["playlist_uri"],
+        "run_at": datetime.fromtimestamp(job["run_at"]).isoformat(),
+        "end_at": datetime.fromtimestamp(job["end_at"]).isoformat(),
+        "cron": job["cron"],
+        "status": job["status"],
+    }
+    if job.get("targets"):
+        description["devices"] = [{"user_id": user_id, "device_id": device_id}
+                                  for user_id, device_id in json.loads(job["targets"])]
+    return description
+
+def _parse_devices(devices, user_id: str, allow_user_override: bool):
+    """
+    Validates the device group of a fan-out schedule.
+
+    Args:
+        - devices: List of device ids of `user_id`, or of {'device_id',
+          'user_id'} objects for devices of other accounts (only with
+          allow_user_override).
+
+    Returns:
+        - List of unique (user_id, device_id) pairs, in input order.
+    """
+    if not isinstance(devices, list) or not devices:
+        raise ValueError("'devices' must be a non-empty list.")
+    if len(devices) > MAX_FANOUT_DEVICES:
+        raise ValueError(f"At most {MAX_FANOUT_DEVICES} devices per schedule.")
+    targets = {}
+    for device in devices:
+        if isinstance(device, dict):
+            target = (device.get("user_id", user_id), device.get("device_id"))
+        else:
+            target = (user_id, device)
+        if not all(isinstance(value, str) and value for value in target):
+            raise ValueError("Invalid device provided.")
+        if target[0] != user_id and not allow_user_override:
+            raise ValueError("Cannot schedule playback for another user.")
+        targets[target] = None
+    return list(targets)
+
+def list_schedules(user_id: str, start: float, end: float, limit: int = 100):
+    """Returns the user's scheduled playbacks whose slot overlaps [start, end), in fire order."""
+    return [_describe_job(job) for job in get_job_store().jobs_between(user_id, start, end, limit=limit)]
+
+def next_schedules(user_id: str, limit: int = 10):
+    """Returns the user's next `limit` pending playbacks."""
+    return [_describe_job(job) for job in get_job_store().jobs_for_user(user_id, limit=limit)]
+
+def cancel_schedule(job_id: str, user_id: str) -> bool:
+    """Cancels one of the user's pending playbacks. Returns False if there was none with that id."""
+    return get_job_store().cancel(job_id, user_id=user_id)
+
+def _batch_conflicts(rows):
+    """
+    Finds the rows of a batch that overlap a scheduled job of the same user,
+    or an earlier-starting row of the batch that was kept.
+
+    Args:
+        - rows: List of (playlist_uri, run_at, user_id, cron, end_at, targets) tuples.
+
+    Returns:
+        - {row position: (job ids, batch row position or None)} for every
+          conflicting row.
+    """
+    by_user = {}
+    for position, row in enumerate(rows):
+        by_user.setdefault(row[2], []).append(position)
+
+    conflicts = {}
+    store = get_job_store()
+    for user_id, positions in by_user.items():
+        positions.sort(key=lambda position: rows[position][1])
+        start = rows[positions[0]][1]
+        end = max(rows[position][4] for position in positions)
+        # One range query per user; the rows are then matched in memory.
+        existing = store.jobs_between(user_id, start, end)
+        existing_starts = [job["run_at"] for job in existing]
+
+        kept_end, kept_position = None, None
+        for position in positions:
+            _, run_at, _, _, end_at, _ = rows[position]
+            first = bisect_left(existing_starts, run_at - SCHEDULE_MAX_SLOT_SECONDS)
+            last = bisect_left(existing_starts, end_at)
+            overlapping = [job["id"] for job in existing[first:last] if job["end_at"] > run_at]
+            in_batch = kept_position if kept_end is not None and kept_end > run_at else None
+            if overlapping or in_batch is not None:
+                conflicts[position] = (overlapping[:MAX_REPORTED_CONFLICTS], in_batch)
+            else:
+                kept_end, kept_position = end_at, position
+    return conflicts
+
+def schedule_playlists_batch(items, user_id: str = "default", allow_user_override: bool = False,
+                             allow_overlap: bool = False):
+    """
+    Validates a batch of schedules in one pass and stores the valid ones in a
+    single bulk insert.
+
+    Args:
+        - items: Iterable of dicts with a 'playlist_uri' and either a
+          'play_time' ("HH:MM", fires once) or a 'cron' crontab expression
+          (e.g. "30 7 * * mon-fri", fires on every match). With
+          allow_user_override (trusted callers only), an item may
+          schedule for another account with its own 'user_id'. With
+          'devices', a list of device ids, the item plays on all of them
+          at once (see _parse_devices).
+        - allow_overlap (bool): Store items even if their slot overlaps
+          another playback of the same user. Otherwise they are reported
+          with status "conflict" (for recurring items, only the next run is
+          checked).
+
+    Returns:
+        - List of per-item results, in input order.
+    """
+    now = datetime.now()
+    aware_now = now.astimezone()
+    results = []
+    rows = []
+    run_times = {}  # Batches repeat the same times and cron rules
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("Schedule must be an object.")
+            playlist_uri = item.get("playlist_uri")
+            if not playlist_uri or not isinstance(playlist_uri, str):
+                raise ValueError("Invalid playlist URI provided.")
+
+            item_user_id = item.get("user_id", user_id)
+            if not isinstance(item_user_id, str):
+                raise ValueError("Invalid user id provided.")
+            if item_user_id != user_id and not allow_user_override:
+                raise ValueError("Cannot schedule playback for another user.")
+
+            cron = item.get("cron")
+            play_time = item.get("play_time")
+            if bool(cron) == bool(play_time):
+                raise ValueError("Provide exactly one of 'play_time' or 'cron'.")
+            if not isinstance(cron or play_time, str):
+                raise ValueError("'play_time' and 'cron' must be strings.")
+
+            devices = item.get("devices")
+            targets = _parse_devices(devices, item_user_id, allow_user_override) if devices is not None else None
+
+            run_at = run_times.get((cron, play_time))
+            if run_at is None:
+                if cron:
+                    next_run = _cron_trigger(cron).get_next_fire_time(None, aware_now)
+                    if next_run is None:
+                        raise ValueError("Cron expression never fires.")
+                else:
+                    next_run = _next_play_time(play_time, now)
+                run_at = run_times[(cron, play_time)] = (next_run.timestamp(), next_run.isoformat())
+        except (ValueError, TypeError) as e:
+            results.append({"index": index, "status": "error", "error": str(e)})
+            continue
+
+        rows.append((playlist_uri, run_at[0], item_user_id, cron, _slot_end(playlist_uri, run_at[0]), targets))
+        results.append({"index": index, "status": "scheduled", "run_at": run_at[1]})
+
+    if rows and not allow_overlap:
+        conflicts = _batch_conflicts(rows)
+        if conflicts:
+            scheduled = [result for result in results if result["status"] == "scheduled"]
+            for position, (job_ids, in_batch) in conflicts.items():
+                result = scheduled[position]
+                result["status"] = "conflict"
+                if in_batch is not None:
+                    result["error"] = f"Overlaps item {scheduled[in_batch]['index']} of this batch."
+                else:
+                    result["error"] = "Overlaps a scheduled playback."
+                    result["conflicts"] = job_ids
+            rows = [row for position, row in enumerate(rows) if position not in conflicts]
+
+    job_ids = iter(get_job_store().add_many(rows) if rows else ())
+    for result in results:
+        if result["status"] == "scheduled":
+            result["job_id"] = next(job_ids)
+    return results
+
+def schedule_playlist(play_playlist, playlist_uri: str, play_time: str, user_id: str = "default",
+                      allow_overlap: bool = False, devices=None):
+    """
+    Schedules one playback, on all of the user's `devices` at once if given.
+    Raises ScheduleConflict if its slot overlaps another playback of the
+    user, unless allow_overlap is set.
+    """
+    global _job_func
+    if _job_func is None:
+        _job_func = play_playlist
+
+    targets = _parse_devices(devices, user_id, False) if devices else None
+    play_time_obj = _next_play_time(play_time, datetime.now())
+    run_at = play_time_obj.timestamp()
+    end_at = _slot_end(playlist_uri, run_at)
+    if not allow_overlap:
+        conflicts = get_job_store().jobs_between(user_id, run_at, end_at, limit=MAX_REPORTED_CONFLICTS)
+        if conflicts:
+            raise ScheduleConflict([_describe_job(job) for job in conflicts])
+    job_id = get_job_store().add(playlist_uri, run_at, user_id=user_id, end_at=end_at, targets=targets)
+
     return {
-        "message": f"Playlist {playlist_uri} scheduled to play at {play_time_obj.strftime('%Y-%m-%d %H:%M:%S')}"
+        "message": f"Playlist {playlist_uri} scheduled to play at {play_time_obj.strftime('%Y-%m-%d %H:%M:%S')}",
+        "job_id": job_id
     }
-    
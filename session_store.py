@@ -0,0 +1,169 @@
+import hashlib
+import os
+import secrets
+import sqlite3
+import sys
+import threading
+import time
+from leases import SCHEMA as LEASES_SCHEMA, acquire_lease, release_lease
+
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", "sessions.db")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id TEXT PRIMARY KEY,
+    access_token TEXT NOT NULL,
+    refresh_token TEXT,
+    expires_at REAL NOT NULL,
+    scope TEXT,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS session_keys (
+    key_hash TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    created_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_session_keys_user ON session_keys (user_id);
+CREATE TABLE IF NOT EXISTS mood_settings (
+    user_id TEXT PRIMARY KEY,
+    timezone TEXT,
+    rules TEXT,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_mood_settings_updated ON mood_settings (updated_at);
+"""
+
+
+def _hash_key(key: str) -> str:
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class SessionStore:
+    """
+    SQLite-backed store of Spotify sessions, one row per Spotify user id.
+
+    Only the fields needed to call and refresh the API are kept, so a
+    session is a few hundred bytes on disk. Session keys (the value of the
+    browser cookie) are stored as SHA-256 hashes and map to a user id.
+    """
+
+    def __init__(self, path: str = SESSION_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA + LEASES_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get(self, user_id: str):
+        """Returns the token info of a user, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT access_token, refresh_token, expires_at, scope FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        token_info = {"access_token": row["access_token"], "token_type": "Bearer", "expires_at": row["expires_at"]}
+        if row["refresh_token"]:
+            token_info["refresh_token"] = row["refresh_token"]
+        if row["scope"]:
+            # Every session carries the same scope string; share one copy.
+            token_info["scope"] = sys.intern(row["scope"])
+        return token_info
+
+    def put(self, user_id: str, token_info: dict):
+        self.put_many([(user_id, token_info)])
+
+    def put_many(self, sessions):
+        """
+        Inserts or replaces many sessions in a single transaction.
+
+        Args:
+            - sessions: Iterable of (user_id, token_info) pairs.
+        """
+        now = time.time()
+        rows = [
+            (user_id, info["access_token"], info.get("refresh_token"), info.get("expires_at", 0), info.get("scope"), now)
+            for user_id, info in sessions
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO sessions (user_id, access_token, refresh_token, expires_at, scope, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, user_id: str):
+        """Removes a user's session and every session key pointing to it."""
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+            self._conn.execute("DELETE FROM session_keys WHERE user_id = ?", (user_id,))
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions")
+            self._conn.execute("DELETE FROM session_keys")
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def create_key(self, user_id: str) -> str:
+        """Creates and returns a new random session key for the user."""
+        key = secrets.token_urlsafe(32)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO session_keys (key_hash, user_id, created_at) VALUES (?, ?, ?)",
+                (_hash_key(key), user_id, time.time()),
+            )
+        return key
+
+    def user_for_key(self, key: str):
+        """Returns the user id a session key belongs to, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT user_id FROM session_keys WHERE key_hash = ?", (_hash_key(key),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """Takes or renews a named lease shared by every process using this store (see leases.py)."""
+        with self._lock:
+            return acquire_lease(self._conn, name, holder, ttl)
+
+    def release_lease(self, name: str, holder: str):
+        with self._lock:
+            release_lease(self._conn, name, holder)
+
+    def put_mood_settings(self, user_id: str, timezone: str = None, rules: str = None):
+        """
+        Stores a user's mood time zone and rules (JSON). A row without either
+        is kept as a reset, so other processes see the change.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO mood_settings (user_id, timezone, rules, updated_at) VALUES (?, ?, ?, ?)",
+                (user_id, timezone, rules, time.time()),
+            )
+
+    def mood_settings_since(self, since: float = 0):
+        """Returns (user_id, timezone, rules) of the mood settings stored after `since`."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT user_id, timezone, rules FROM mood_settings WHERE updated_at > ? ORDER BY updated_at", (since,)
+            ).fetchall()
+
+    def delete_key(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM session_keys WHERE key_hash = ?", (_hash_key(key),))
@@ -0,0 +1,334 @@
+import asyncio
+import copy
+import functools
+import json
+import os
+import random
+import time
+import logging
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING
+from audit_log import audit_log
+from cache import TTLCache
+from metrics import Counter, Histogram
+from rate_limiter import RateLimiter, PRIORITY_PLAYBACK, PRIORITY_BACKGROUND
+
+if TYPE_CHECKING:
+    import aiohttp  # Imported lazily at runtime, see AsyncSpotifyClient._session
+
+SPOTIFY_API_BASE = os.getenv("SPOTIFY_API_BASE", "https://api.spotify.com/v1")
+SPOTIFY_TOKEN_URL = os.getenv("SPOTIFY_TOKEN_URL", "https://accounts.spotify.com/api/token")
+
+# Upper bound of pooled connections shared by every request in the process.
+MAX_CONNECTIONS = int(os.getenv("SPOTIFY_MAX_CONNECTIONS", "100"))
+
+# Per-user clients kept for reuse (see get_spotify_client).
+USER_CLIENT_POOL_SIZE = int(os.getenv("SPOTIFY_USER_CLIENTS", "10000"))
+
+# Process-wide request budget towards Spotify (requests/second and burst size).
+SPOTIFY_RATE_LIMIT = float(os.getenv("SPOTIFY_RATE_LIMIT", "50"))
+SPOTIFY_RATE_BURST = int(os.getenv("SPOTIFY_RATE_BURST", "20"))
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Operations on the path to starting playback jump the rate-limit queue.
+PLAYBACK_OPS = {"start_playback", "devices", "token"}
+
+SPOTIFY_REQUEST_SECONDS = Histogram("spotify_request_seconds", "Latency of Spotify API requests per attempt.", ("op",))
+SPOTIFY_RESPONSES = Counter("spotify_responses_total", "Spotify API responses by status code.", ("op", "status"))
+SPOTIFY_RETRIES = Counter("spotify_retries_total", "Retried Spotify API requests.", ("op",))
+
+
+class SpotifyAPIError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"Spotify API error: {status_code} - {message}")
+        self.status_code = status_code
+        self.message = message
+
+
+class AsyncSpotifyClient:
+    """
+    asyncio-native client for the parts of the Spotify Web API we use.
+
+    All calls share one keep-alive connection pool (aiohttp) and go through a
+    RateLimiter, which also pauses every request when Spotify answers 429 with
+    Retry-After. Connection errors and 5xx are retried with jittered
+    exponential backoff using asyncio.sleep, so retries never block the event
+    loop and do not synchronize.
+    """
+
+    def __init__(self, token_provider=None, base_url: str = SPOTIFY_API_BASE,
+                 token_url: str = SPOTIFY_TOKEN_URL, retry_count: int = 3, delay: float = 0.5,
+                 timeout: float = 10.0, max_connections: int = MAX_CONNECTIONS, rate_limiter: RateLimiter = None):
+        """
+        Args:
+            - token_provider: Async callable returning the current access token (or None).
+            - retry_count (int): Attempts per request before giving up.
+            - delay (float): Base backoff in seconds, doubled on every attempt.
+            - rate_limiter (RateLimiter): Defaults to one built from
+              SPOTIFY_RATE_LIMIT / SPOTIFY_RATE_BURST.
+        """
+        self.token_provider = token_provider
+        self.base_url = base_url.rstrip("/")
+        self.token_url = token_url
+        self.retry_count = retry_count
+        self.delay = delay
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.rate_limiter = rate_limiter or RateLimiter(SPOTIFY_RATE_LIMIT, SPOTIFY_RATE_BURST)
+        self.user_id = None
+        self._http = None
+        self._pool_owner = None
+
+    def for_user(self, user_id: str) -> "AsyncSpotifyClient":
+        """
+        Returns a client acting for `user_id`. It shares this client's connection
+        pool and rate limiter; only the token lookup (token_provider(user_id)) differs.
+        """
+        client = self._view(functools.partial(self.token_provider, user_id))
+        client.user_id = user_id
+        return client
+
+    def with_token(self, access_token: str) -> "AsyncSpotifyClient":
+        """Returns a client using a fixed access token, e.g. right after the OAuth code exchange."""
+        async def token_provider():
+            return access_token
+        return self._view(token_provider)
+
+    def _view(self, token_provider) -> "AsyncSpotifyClient":
+        client = copy.copy(self)
+        client.token_provider = token_provider
+        client.user_id = None
+        client._pool_owner = self._pool_owner or self
+        client._http = None
+        return client
+
+    def _session(self) -> "aiohttp.ClientSession":
+        if self._pool_owner is not None:
+            return self._pool_owner._session()
+        # Created lazily so that it binds to the event loop that uses it. aiohttp
+        # is imported here as well; it is a large share of the app's import time.
+        import aiohttp
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=30),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._http
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+
+    async def warm_connections(self, count: int):
+        """
+        Opens up to `count` pooled connections ahead of a burst of requests,
+        so the burst does not wait for TCP and TLS handshakes. Uses
+        unauthenticated HEAD requests to the API base, whose answer is
+        ignored; they bypass the rate limiter as no app quota is spent.
+        """
+        import aiohttp
+        session = self._session()
+
+        async def open_connection():
+            try:
+                async with session.head(f"{self.base_url}/") as response:
+                    await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.debug(f"Connection warm-up failed: {e}")
+
+        await asyncio.gather(*(open_connection() for _ in range(min(count, self.max_connections))))
+
+    async def me(self, **retry):
+        """Returns the current user's Spotify profile."""
+        return await self._request("GET", "/me", op="me", **retry)
+
+    async def devices(self, **retry):
+        data = await self._request("GET", "/me/player/devices", op="devices", **retry)
+        return data.get("devices", [])
+
+    async def playback_state(self, **retry):
+        """Returns the user's current playback (GET /me/player); empty when nothing is playing."""
+        return await self._request("GET", "/me/player", op="player", **retry)
+
+    async def start_playback(self, context_uri: str = None, uris: list = None, device_id: str = None, **retry):
+        body = {"context_uri": context_uri} if context_uri else {"uris": uris}
+        params = {"device_id": device_id} if device_id else None
+        await self._request("PUT", "/me/player/play", op="start_playback", params=params, json_body=body, **retry)
+
+    async def category_playlists(self, category_id: str, limit: int = 5, **retry):
+        data = await self._request("GET", f"/browse/categories/{category_id}/playlists", op="browse",
+                                   params={"limit": limit}, **retry)
+        return data.get("playlists", {}).get("items", [])
+
+    async def category_playlists_if_changed(self, category_id: str, limit: int = 5, etag: str = None, **retry):
+        """
+        Conditional variant of category_playlists.
+
+        Returns:
+            - (items, etag). items is None when Spotify answered 304 Not Modified.
+        """
+        headers = {"If-None-Match": etag} if etag else None
+        status, response_headers, body = await self._request_raw(
+            "GET", f"/browse/categories/{category_id}/playlists", op="browse", params={"limit": limit},
+            headers=headers, **retry)
+        new_etag = response_headers.get("ETag", etag)
+        if status == 304:
+            return None, new_etag
+        return json.loads(body).get("playlists", {}).get("items", []), new_etag
+
+    async def playlist(self, playlist_id: str, fields: str = None, **retry):
+        params = {"fields": fields} if fields else None
+        return await self._request("GET", f"/playlists/{playlist_id}", op="playlist", params=params, **retry)
+
+    async def playlist_tracks(self, playlist_id: str, offset: int = 0, limit: int = 100, fields: str = None, **retry):
+        params = {"offset": offset, "limit": limit}
+        if fields:
+            params["fields"] = fields
+        return await self._request("GET", f"/playlists/{playlist_id}/tracks", op="playlist_tracks", params=params,
+                                   **retry)
+
+    async def search(self, query: str, search_type: str = "show", limit: int = 5, offset: int = 0, **retry):
+        return await self._request("GET", "/search", op="search",
+                                   params={"q": query, "type": search_type, "limit": limit, "offset": offset},
+                                   **retry)
+
+    async def refresh_access_token(self, refresh_token: str, client_id: str, client_secret: str):
+        """
+        Exchanges a refresh token for a new access token.
+
+        Returns:
+            - The token payload returned by Spotify.
+        """
+        payload = {
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+            "client_id": client_id,
+            "client_secret": client_secret,
+        }
+        status, _, body = await self._send("POST", self.token_url, op="token", data=payload)
+        if status != 200:
+            raise SpotifyAPIError(status, body.decode())
+        return json.loads(body)
+
+    async def _request(self, method: str, path: str, op: str = "other", params=None, json_body=None,
+                       retry_count: int = None, delay: float = None):
+        status, _, body = await self._request_raw(method, path, op=op, params=params, json_body=json_body,
+                                                  retry_count=retry_count, delay=delay)
+        if not body:
+            return {}
+        return json.loads(body)
+
+    async def _request_raw(self, method: str, path: str, op: str = "other", params=None, json_body=None,
+                           headers=None, retry_count: int = None, delay: float = None):
+        token = await self.token_provider() if self.token_provider else None
+        if not token:
+            raise SpotifyAPIError(401, "Spotify authentication required. Please log in.")
+
+        headers = {**(headers or {}), "Authorization": f"Bearer {token}"}
+        status, response_headers, body = await self._send(method, f"{self.base_url}{path}", op=op, params=params,
+                                                          json=json_body, headers=headers,
+                                                          retry_count=retry_count, delay=delay)
+        if status >= 400:
+            raise SpotifyAPIError(status, body.decode())
+        return status, response_headers, body
+
+    async def _send(self, method: str, url: str, op: str = "other", retry_count: int = None,
+                    delay: float = None, **kwargs):
+        """
+        Sends one request with retries.
+
+        Returns:
+            - (status, headers, body) of the final response.
+        """
+        import aiohttp
+        retry_count = self.retry_count if retry_count is None else retry_count
+        delay = self.delay if delay is None else delay
+
+        latency = SPOTIFY_REQUEST_SECONDS.labels(op=op)
+        priority = PRIORITY_PLAYBACK if op in PLAYBACK_OPS else PRIORITY_BACKGROUND
+        for attempt in range(retry_count):
+            last_attempt = attempt == retry_count - 1
+            await self.rate_limiter.acquire(priority)
+            start = time.perf_counter()
+            try:
+                async with self._session().request(method, url, **kwargs) as response:
+                    status, headers, body = response.status, response.headers, await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                latency.observe(time.perf_counter() - start)
+                SPOTIFY_RESPONSES.labels(op=op, status="error").inc()
+                logging.error(f"Connection error on {method} {url}: {e}. Attempt {attempt + 1} of {retry_count}.")
+                if last_attempt:
+                    raise
+                SPOTIFY_RETRIES.labels(op=op).inc()
+                audit_log.record("spotify_retry", self.user_id, op, "error", attempt=attempt + 1, error=str(e))
+                await asyncio.sleep(_backoff(delay, attempt))
+                continue
+
+            latency.observe(time.perf_counter() - start)
+            SPOTIFY_RESPONSES.labels(op=op, status=status).inc()
+            if status not in RETRYABLE_STATUS_CODES or last_attempt:
+                return status, headers, body
+
+            SPOTIFY_RETRIES.labels(op=op).inc()
+            audit_log.record("spotify_retry", self.user_id, op, str(status), attempt=attempt + 1)
+
+            wait = _backoff(delay, attempt)
+            if status == 429:
+                # The next acquire() waits out the pause together with every other request.
+                self.rate_limiter.pause(_retry_after(headers.get("Retry-After"), wait))
+                continue
+            logging.warning(f"{method} {url} returned {status}, retrying in {wait:.2f} seconds...")
+            await asyncio.sleep(wait)
+
+
+def _retry_after(value: str, default: float) -> float:
+    """Seconds to wait from a Retry-After header (delay-seconds or HTTP-date), or `default`."""
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        logging.warning(f"Ignoring invalid Retry-After header: {value!r}")
+        return default
+
+
+def _backoff(delay: float, attempt: int) -> float:
+    """Exponential backoff with "equal jitter": between half and all of delay * 2**attempt."""
+    wait = delay * (2 ** attempt)
+    return wait / 2 + random.uniform(0, wait / 2)
+
+
+_client = None
+_user_clients = TTLCache(maxsize=USER_CLIENT_POOL_SIZE, ttl=3600)
+
+
+def get_spotify_client(user_id: str = None) -> AsyncSpotifyClient:
+    """
+    Returns the process-wide client, creating it on first use. With a
+    `user_id`, returns that user's pooled client, which shares the same
+    connections and rate limit.
+    """
+    global _client
+    if _client is None:
+        from token_manager import get_access_token
+        _client = AsyncSpotifyClient(token_provider=get_access_token)
+    if user_id is None:
+        return _client
+    client = _user_clients.get(user_id)
+    if client is None:
+        client = _client.for_user(user_id)
+        _user_clients.set(user_id, client)
+    return client
+
+
+async def close_spotify_client():
+    global _client
+    _user_clients.clear()
+    if _client is not None:
+        await _client.close()
+        _client = None
@@ -0,0 +1,264 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import logging
+from audit_log import audit_log
+from cache import TTLCache
+from leases import WORKER_ID
+from session_store import SessionStore, SESSION_STORE_PATH
+from spotify_async import SpotifyAPIError, get_spotify_client
+from metrics import Counter, Histogram, register_cache, timed
+
+# Single-account token file used before sessions moved to SQLite; migrated on first use.
+TOKEN_FILE_PATH = "token_info.json"
+
+# Tokens are refreshed this many seconds before they actually expire.
+REFRESH_MARGIN_SECONDS = 60
+
+# Sessions kept in memory (LRU); the rest are read back from the session store.
+# A cached session or session key is read back at most SESSION_CACHE_SECONDS
+# after it was loaded, so token refreshes and logouts done by another worker
+# process are picked up within that time.
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+SESSION_CACHE_SECONDS = float(os.getenv("SESSION_CACHE_SECONDS", "30"))
+
+# A worker refreshing a token holds this lease in the session store, so the
+# other workers wait for its result instead of refreshing the same token.
+REFRESH_LEASE_SECONDS = 30
+REFRESH_WAIT_SECONDS = 0.1
+
+DEFAULT_USER = "default"
+
+TOKEN_LOOKUP_SECONDS = Histogram("token_lookup_seconds", "Time to return a valid token, including refreshes.")
+TOKEN_REFRESHES = Counter("token_refreshes_total", "Token refresh attempts by outcome.", ("outcome",))
+
+_MISSING = object()
+
+
+class TokenManager:
+    """
+    Single owner of Spotify tokens, keyed by Spotify user id.
+
+    Sessions live in a SQLite SessionStore; the recently used ones are kept
+    in an LRU cache of at most `cache_size` entries, so the common case costs
+    a dict lookup and idle sessions fall back to disk. A token close to its
+    deadline is refreshed in the background while callers keep using it;
+    once expired, all concurrent callers of that user await the same
+    in-flight refresh. Across worker processes, refreshes are serialized by a
+    lease in the session store and the refreshed token is shared through it.
+    """
+
+    def __init__(self, path: str = SESSION_STORE_PATH, refresh_func=None,
+                 margin: float = REFRESH_MARGIN_SECONDS, cache_size: int = SESSION_CACHE_SIZE,
+                 legacy_path: str = None):
+        """
+        Args:
+            - path (str): SQLite session database, opened on first use.
+            - refresh_func: Async callable taking a refresh token and returning
+              Spotify's token payload. Defaults to the shared Spotify client.
+            - cache_size (int): Max sessions held in memory.
+            - legacy_path (str): Old token_info.json to import on first use.
+        """
+        self.path = path
+        self.margin = margin
+        self.refresh_func = refresh_func or _refresh_with_spotify
+        self.legacy_path = legacy_path
+        self.sessions = TTLCache(maxsize=cache_size, ttl=SESSION_CACHE_SECONDS)
+        self._session_keys = TTLCache(maxsize=cache_size, ttl=SESSION_CACHE_SECONDS)
+        self._db = None
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def store(self) -> SessionStore:
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    db = SessionStore(self.path)
+                    if self.legacy_path:
+                        _migrate_token_file(self.legacy_path, db)
+                    self._db = db
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def get_token_info(self, user_id: str = DEFAULT_USER):
+        """Returns the stored token info of a user without refreshing it."""
+        token_info = self.sessions.get(user_id, _MISSING)
+        if token_info is _MISSING:
+            token_info = self.store().get(user_id)
+            # Unknown users are cached as None too, so they do not hit the disk every time.
+            self.sessions.set(user_id, token_info)
+        return token_info
+
+    def set_token_info(self, token_info: dict, user_id: str = DEFAULT_USER):
+        if not token_info:
+            logging.error("set_token_info() received an empty token. Not saving!")
+            return
+        if "expires_at" not in token_info and "expires_in" in token_info:
+            token_info["expires_at"] = time.time() + token_info["expires_in"]
+        self.store().put(user_id, token_info)
+        self.sessions.set(user_id, token_info)
+
+    def clear(self, user_id: str = None):
+        """Forgets the session of one user, or of every user if no id is given."""
+        if user_id is None:
+            self.store().clear()
+            self.sessions.clear()
+        else:
+            self.store().delete(user_id)
+            self.sessions.delete(user_id)
+        self._session_keys.clear()
+
+    def create_session(self, user_id: str) -> str:
+        """Returns a new session key (cookie value) that resolves to `user_id`."""
+        return self.store().create_key(user_id)
+
+    def user_for_session(self, key: str):
+        """Returns the user id of a session key, or None if it is unknown."""
+        user_id = self._session_keys.get(key, _MISSING)
+        if user_id is _MISSING:
+            user_id = self.store().user_for_key(key)
+            self._session_keys.set(key, user_id)
+        return user_id
+
+    def end_session(self, key: str):
+        self.store().delete_key(key)
+        self._session_keys.delete(key)
+
+    async def get_valid_token_info(self, user_id: str = DEFAULT_USER):
+        """
+        Returns a usable token info for the user, refreshing it if needed.
+        Returns None when the user has to log in again.
+        """
+        token_info = self.get_token_info(user_id)
+        if not token_info:
+            return None
+
+        remaining = token_info.get("expires_at", 0) - time.time()
+        if remaining > self.margin:
+            return token_info
+
+        if not token_info.get("refresh_token"):
+            logging.error("No refresh token available. User must re-authenticate.")
+            self.clear(user_id)
+            return None
+
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh(user_id, token_info))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+
+        if remaining > 0:
+            # Still valid: let the refresh finish in the background.
+            return token_info
+        return await asyncio.shield(task)
+
+    async def _refresh(self, user_id: str, token_info: dict):
+        """
+        Refreshes the token unless another worker process did so meanwhile;
+        while another worker holds the refresh lease, waits for its result.
+        """
+        store = self.store()
+        lease = f"token-refresh:{user_id}"
+        while True:
+            stored = await asyncio.to_thread(store.get, user_id)
+            if stored is None:
+                # Logged out meanwhile.
+                self.sessions.set(user_id, None)
+                return None
+            if stored["expires_at"] - time.time() > self.margin:
+                TOKEN_REFRESHES.labels(outcome="shared").inc()
+                self.sessions.set(user_id, stored)
+                return stored
+            # A holder that died frees the lease after REFRESH_LEASE_SECONDS.
+            if await asyncio.to_thread(store.acquire_lease, lease, WORKER_ID, REFRESH_LEASE_SECONDS):
+                break
+            await asyncio.sleep(REFRESH_WAIT_SECONDS)
+
+        try:
+            # The stored copy carries the latest refresh token.
+            stored.setdefault("refresh_token", token_info.get("refresh_token"))
+            return await self._refresh_token(user_id, stored)
+        finally:
+            await asyncio.to_thread(store.release_lease, lease, WORKER_ID)
+
+    async def _refresh_token(self, user_id: str, token_info: dict):
+        logging.info(f"Refreshing access token for user {user_id}.")
+        start = time.perf_counter()
+        try:
+            new_token_info = await self.refresh_func(token_info["refresh_token"])
+        except SpotifyAPIError as e:
+            if e.status_code == 400 and "invalid_grant" in e.message:
+                logging.error("Refresh token revoked. User must log in again.")
+                TOKEN_REFRESHES.labels(outcome="revoked").inc()
+                audit_log.record("token_refresh", user_id, outcome="revoked", duration=time.perf_counter() - start)
+                self.clear(user_id)
+            else:
+                logging.error(f"Token refresh failed: {e.message}")
+                TOKEN_REFRESHES.labels(outcome="error").inc()
+                audit_log.record("token_refresh", user_id, outcome="error", duration=time.perf_counter() - start,
+                                 error=e.message)
+            return None
+        except Exception as e:
+            logging.error(f"Token refresh failed: {e}")
+            TOKEN_REFRESHES.labels(outcome="error").inc()
+            audit_log.record("token_refresh", user_id, outcome="error", duration=time.perf_counter() - start,
+                             error=str(e))
+            return None
+
+        new_token_info.setdefault("refresh_token", token_info["refresh_token"])
+        new_token_info["expires_at"] = time.time() + new_token_info["expires_in"]
+        self.sessions.set(user_id, new_token_info)
+        await asyncio.to_thread(self.store().put, user_id, new_token_info)
+        TOKEN_REFRESHES.labels(outcome="success").inc()
+        audit_log.record("token_refresh", user_id, outcome="success", duration=time.perf_counter() - start)
+        logging.info("Token refreshed successfully.")
+        return new_token_info
+
+
+def _migrate_token_file(path: str, store: SessionStore):
+    """Imports a token_info.json written by older versions, then renames it."""
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except json.JSONDecodeError:
+        logging.error("Invalid token file format. Re-authentication is required.")
+        return
+    # Files written before tokens were keyed per user hold a single token.
+    if "access_token" in data:
+        data = {DEFAULT_USER: data}
+    store.put_many(data.items())
+    os.replace(path, path + ".migrated")
+    logging.info(f"Migrated {len(data)} session(s) from {path} to {store.path}.")
+
+
+async def _refresh_with_spotify(refresh_token: str):
+    return await get_spotify_client().refresh_access_token(
+        refresh_token, os.getenv("SPOTIPY_CLIENT_ID"), os.getenv("SPOTIPY_CLIENT_SECRET")
+    )
+
+
+token_manager = TokenManager(legacy_path=TOKEN_FILE_PATH)
+register_cache("sessions", token_manager.sessions)
+
+
+@timed(TOKEN_LOOKUP_SECONDS)
+async def refresh_token_if_needed(user_id: str = DEFAULT_USER):
+    """
+    Returns a fresh token info for the user, or None if they must log in.
+    """
+    return await token_manager.get_valid_token_info(user_id)
+
+
+async def get_access_token(user_id: str = DEFAULT_USER):
+    """Returns a valid access token for the async Spotify client, or None."""
+    token_info = await token_manager.get_valid_token_info(user_id)
+    return token_info["access_token"] if token_info else None